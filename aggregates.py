@@ -0,0 +1,109 @@
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# (facet, counted) relationship type pairs kept as materialized cross counts
+# by default, the ones behind the built-in insight queries
+DEFAULT_PAIRS = [("IN_AGE_GROUP", "FACES"), ("VALUES", "PREFERS")]
+
+class AggregateIndex:
+    """
+    Incrementally maintained persona counts for the insight queries.
+
+    For every relationship type it keeps how many personas link to each
+    value, and for the configured (facet, counted) pairs it keeps how many
+    personas with a given facet value link to each counted value. Queries
+    on those are dictionary lookups. Other "top counted values among
+    personas with facet value" queries are answered from per-value persona
+    postings, which only touches the personas that have the facet value.
+    """
+
+    def __init__(self, pairs: Optional[Iterable[Tuple[str, str]]] = None):
+        self.pairs = list(DEFAULT_PAIRS if pairs is None else pairs)
+        self._lock = threading.Lock()
+        self._facets: Dict[str, Counter] = defaultdict(Counter)  # rel type -> value -> personas
+        self._cross: Dict[Tuple[str, str], Dict[str, Counter]] = {
+            pair: defaultdict(Counter) for pair in self.pairs
+        }  # (facet, counted) -> facet value -> counted value -> personas
+        self._postings: Dict[Tuple[str, str], List[int]] = defaultdict(list)  # (rel type, value) -> persona ids
+        self._personas: List[Dict[str, List[str]]] = []
+
+    def __len__(self) -> int:
+        return len(self._personas)
+
+    def add(self, attributes: Dict[str, Iterable[str]]) -> int:
+        """
+        Count a newly saved persona.
+
+        Every saved persona is a separate node, so adding equal attributes
+        twice counts them twice, as the graph does.
+
+        Args:
+        attributes (Dict[str, Iterable[str]]): Attribute values per relationship type.
+
+        Returns:
+        int: The persona's id in the index.
+        """
+        # A persona counts once per value, as the Cypher queries' COUNT(DISTINCT p)
+        links = {rel_type: list(dict.fromkeys(str(value) for value in values))
+                 for rel_type, values in attributes.items()}
+        with self._lock:
+            persona_id = len(self._personas)
+            self._personas.append(links)
+            for rel_type, values in links.items():
+                self._facets[rel_type].update(values)
+                for value in values:
+                    self._postings[(rel_type, value)].append(persona_id)
+            for (facet, counted), cross in self._cross.items():
+                for facet_value in links.get(facet, []):
+                    cross[facet_value].update(links.get(counted, []))
+            return persona_id
+
+    def counts(self, rel_type: str) -> Counter:
+        """
+        Return the number of personas linked to each value of a relationship type.
+
+        Args:
+        rel_type (str): The relationship type, e.g. "INTERESTED_IN".
+
+        Returns:
+        Counter: Personas per value.
+        """
+        with self._lock:
+            return Counter(self._facets.get(rel_type, {}))
+
+    def top_n(
+        self,
+        rel_type: str,
+        by: Optional[str] = None,
+        value: Optional[str] = None,
+        n: Optional[int] = 10,
+        min_count: int = 1,
+    ) -> List[Tuple[str, int]]:
+        """
+        Return the most common values of `rel_type`, optionally among personas with `by` = `value`.
+
+        Args:
+        rel_type (str): The relationship type whose values are counted.
+        by (str, optional): The facet relationship type, e.g. "IN_AGE_GROUP".
+        value (str, optional): The facet value, e.g. "25-34". Required with `by`.
+        n (int, optional): Maximum number of results, None for all.
+        min_count (int): Leave out values with fewer personas.
+
+        Returns:
+        List[Tuple[str, int]]: (value, persona count) pairs, most common first.
+        """
+        with self._lock:
+            if by is None:
+                counts = self._facets.get(rel_type, Counter())
+            elif (by, rel_type) in self._cross:
+                counts = self._cross[(by, rel_type)].get(str(value), Counter())
+            else:
+                counts = Counter()
+                for persona_id in self._postings.get((by, str(value)), []):
+                    counts.update(self._personas[persona_id].get(rel_type, []))
+            ranked = sorted(
+                ((item, count) for item, count in counts.items() if count >= min_count),
+                key=lambda pair: (-pair[1], pair[0]),
+            )
+        return ranked if n is None else ranked[:n]
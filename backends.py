@@ -0,0 +1,499 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+from openai import AsyncOpenAI, OpenAI
+from pydantic import BaseModel
+from metrics import metrics
+from rate_limiter import RequestScheduler
+
+# Weight of the newest sample in the latency and cost averages
+EWMA_ALPHA = 0.2
+# Consecutive failures after which a backend is skipped for `cooldown` seconds
+FAILURE_THRESHOLD = 3
+
+class ChatBackend:
+    """
+    A chat model on some server, with its own rate limits and prices.
+
+    Subclasses implement `complete` and `acomplete`, which take the keyword
+    arguments of `chat.completions.create` without the model and return a
+    response shaped like the OpenAI SDK's (`choices[0].message.content`
+    and `usage`).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        scheduler: Optional[RequestScheduler] = None,
+        prompt_price: float = 0.0,
+        completion_price: float = 0.0,
+        structured_outputs: bool = True,
+    ):
+        self.name = name
+        self.model = model
+        # Requests and tokens per minute of this backend, unlimited by default
+        self.scheduler = scheduler or RequestScheduler()
+        # USD per million prompt and completion tokens
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        # Servers without JSON schema support get the prompt's JSON
+        # instructions only, and invalid replies go through the repair loop
+        self.structured_outputs = structured_outputs
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.name!r}, {self.model!r})"
+
+    def prepare(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        prepared = {"model": self.model, **request}
+        if not self.structured_outputs:
+            prepared.pop("response_format", None)
+        return prepared
+
+    def cost(self, usage: Any) -> float:
+        """
+        Price a call from the usage of its response.
+
+        Args:
+        usage: The response's usage object, may be None.
+
+        Returns:
+        float: The cost in USD.
+        """
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+        return (prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1_000_000
+
+    def complete(self, request: Dict[str, Any]) -> Any:
+        raise NotImplementedError
+
+    async def acomplete(self, request: Dict[str, Any]) -> Any:
+        raise NotImplementedError
+
+class OpenAIBackend(ChatBackend):
+    """
+    A model served by the OpenAI API, or another server given by `client`.
+
+    Clients that are not given are built from `client_options` on first use,
+    so configuring backends needs no API key until a call is made.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        client: Optional[OpenAI] = None,
+        aclient: Optional[AsyncOpenAI] = None,
+        client_options: Optional[Dict[str, Any]] = None,
+        **options,
+    ):
+        super().__init__(name, model, **options)
+        self.client = client
+        self.aclient = aclient
+        self.client_options = dict(client_options or {})
+        self._client_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> Optional[str]:
+        # Read from the options rather than a built client, so it does not change on first use
+        client = self.client or self.aclient
+        base_url = self.client_options.get("base_url") if client is None else client.base_url
+        return None if base_url is None else str(base_url)
+
+    def get_client(self) -> OpenAI:
+        if self.client is None:
+            with self._client_lock:
+                if self.client is None:
+                    self.client = OpenAI(**self.client_options)
+        return self.client
+
+    def get_aclient(self) -> AsyncOpenAI:
+        if self.aclient is None:
+            with self._client_lock:
+                if self.aclient is None:
+                    self.aclient = AsyncOpenAI(**self.client_options)
+        return self.aclient
+
+    def complete(self, request: Dict[str, Any]) -> Any:
+        return self.get_client().chat.completions.create(**self.prepare(request))
+
+    async def acomplete(self, request: Dict[str, Any]) -> Any:
+        return await self.get_aclient().chat.completions.create(**self.prepare(request))
+
+class OpenAICompatibleBackend(OpenAIBackend):
+    """A model on a server with an OpenAI-compatible API, e.g. a local vLLM, llama.cpp or Ollama server."""
+
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        base_url: str,
+        api_key: Optional[str] = None,
+        timeout: Optional[float] = None,
+        **options,
+    ):
+        # Local servers usually ignore the key, but the client requires one
+        client_options = {"base_url": base_url, "api_key": api_key or "unused", "max_retries": 0}
+        if timeout is not None:
+            client_options["timeout"] = timeout
+        super().__init__(name, model, client_options=client_options, **options)
+
+class StubBackend(ChatBackend):
+    """
+    A deterministic local backend for tests and offline runs.
+
+    Structured requests get a reply that fills the requested JSON schema
+    with values derived from a hash of the messages, and other requests
+    get `reply(messages)`, by default a short text built the same way.
+    The same request always gets the same reply.
+    """
+
+    def __init__(
+        self,
+        name: str = "stub",
+        model: str = "stub",
+        reply: Optional[Callable[[List[dict]], str]] = None,
+        latency: float = 0.0,
+        **options,
+    ):
+        super().__init__(name, model, **options)
+        self.reply = reply or _stub_text
+        self.latency = latency
+
+    def complete(self, request: Dict[str, Any]) -> Any:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._response(self.prepare(request))
+
+    async def acomplete(self, request: Dict[str, Any]) -> Any:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._response(self.prepare(request))
+
+    def _response(self, request: Dict[str, Any]) -> Any:
+        messages = request["messages"]
+        response_format = request.get("response_format")
+        if response_format and response_format.get("type") == "json_schema":
+            schema = response_format["json_schema"]["schema"]
+            content = json.dumps(_stub_value(schema, schema, _digest(messages)))
+        else:
+            content = self.reply(messages)
+        prompt_chars = sum(len(message["content"]) for message in messages)
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_chars // 4, completion_tokens=len(content) // 4, prompt_tokens_details=None,
+        )
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+# Latency and cost of one backend on one chain stage, whose prompts and replies differ in length
+class StageStats(BaseModel):
+    requests: int = 0  # Successful calls
+    latency_ewma: Optional[float] = None  # Seconds per call, excluding rate limit waits
+    cost_ewma: Optional[float] = None  # USD per call
+
+# Live statistics of one backend
+class BackendStats(BaseModel):
+    requests: int = 0  # Successful calls
+    failures: int = 0  # Calls that failed after the backend's retries
+    consecutive_failures: int = 0  # Failures since the last success
+    cooldown_until: float = 0.0  # Monotonic time until which the backend is skipped
+    stages: Dict[str, StageStats] = {}  # By stage name, "" for calls without a stage
+
+class BackendRouter:
+    """
+    Chooses a backend for every call by chain stage, speed, cost and health.
+
+    Each stage has an ordered list of allowed backends (`routes`, falling
+    back to `default`). Among them, healthy backends are tried in order of
+    their average latency plus `cost_weight` times their average cost on
+    that stage, and backends without measurements on the stage are tried
+    first so every one gets measured. A backend that fails `failure_threshold` times in a row is
+    skipped for `cooldown` seconds, unless no other backend is left.
+    """
+
+    def __init__(
+        self,
+        backends: List[ChatBackend],
+        routes: Optional[Dict[str, List[str]]] = None,
+        default: Optional[List[str]] = None,
+        cost_weight: float = 0.0,
+        alpha: float = EWMA_ALPHA,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        cooldown: float = 30.0,
+    ):
+        self.backends = {backend.name: backend for backend in backends}
+        self.routes = dict(routes or {})
+        self.default = list(default or self.backends)
+        for names in [self.default, *self.routes.values()]:
+            unknown = [name for name in names if name not in self.backends]
+            if unknown:
+                raise ValueError(f"Unknown backends in routes: {', '.join(unknown)}")
+        self.cost_weight = cost_weight
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._stats = {name: BackendStats() for name in self.backends}
+
+    @classmethod
+    def from_config(
+        cls,
+        config: Dict[str, Any],
+        default_backend: Optional[ChatBackend] = None,
+        retry_on: Tuple[Type[BaseException], ...] = (),
+    ) -> "BackendRouter":
+        """
+        Build a router from a config dict, as read from the LLM_BACKENDS file.
+
+        The config has a "backends" list, each with a name, a type
+        ("openai", "openai_compatible" or "stub"), a model and optional
+        base_url, api_key_env, timeout, rpm, tpm, max_retries, prompt_price,
+        completion_price and structured_outputs. "routes" maps stage names
+        to backend names in order of preference, "default" lists the
+        backends of other stages, and "cost_weight" trades USD per call
+        against seconds of latency.
+
+        Args:
+        config (Dict[str, Any]): The parsed config.
+        default_backend (ChatBackend, optional): Available by its name
+            unless the config defines a backend with the same name.
+        retry_on (Tuple[Type[BaseException], ...]): The errors each backend's scheduler retries.
+
+        Returns:
+        BackendRouter: The router.
+        """
+        backends = {}
+        if default_backend is not None:
+            backends[default_backend.name] = default_backend
+        for spec in config.get("backends", []):
+            spec = dict(spec)
+            name, kind, model = spec.pop("name"), spec.pop("type", "openai_compatible"), spec.pop("model", "stub")
+            options = {
+                "scheduler": RequestScheduler(
+                    spec.pop("rpm", None), spec.pop("tpm", None), max_retries=spec.pop("max_retries", 5),
+                    retry_on=retry_on,
+                ),
+                "prompt_price": spec.pop("prompt_price", 0.0),
+                "completion_price": spec.pop("completion_price", 0.0),
+                "structured_outputs": spec.pop("structured_outputs", True),
+            }
+            api_key_env = spec.pop("api_key_env", None)
+            if kind == "stub":
+                backends[name] = StubBackend(name, model, latency=spec.pop("latency", 0.0), **options)
+            elif kind == "openai":
+                client_options = {"api_key": os.getenv(api_key_env or "OPENAI_API_KEY"), "max_retries": 0}
+                if "timeout" in spec:
+                    client_options["timeout"] = spec.pop("timeout")
+                backends[name] = OpenAIBackend(name, model, client_options=client_options, **options)
+            elif kind == "openai_compatible":
+                backends[name] = OpenAICompatibleBackend(
+                    name, model, spec.pop("base_url"), api_key=os.getenv(api_key_env) if api_key_env else None,
+                    timeout=spec.pop("timeout", None), **options,
+                )
+            else:
+                raise ValueError(f"Unknown backend type {kind!r} for {name}")
+            if spec:
+                raise ValueError(f"Unknown options for backend {name}: {', '.join(sorted(spec))}")
+
+        return cls(
+            list(backends.values()),
+            routes=config.get("routes"),
+            default=config.get("default") or ([default_backend.name] if default_backend is not None else None),
+            cost_weight=config.get("cost_weight", 0.0),
+        )
+
+    @classmethod
+    def from_env(
+        cls, default_backend: ChatBackend, retry_on: Tuple[Type[BaseException], ...] = ()
+    ) -> "BackendRouter":
+        """
+        Build a router from the JSON file named by LLM_BACKENDS, see `from_config`.
+
+        Args:
+        default_backend (ChatBackend): The only backend when LLM_BACKENDS is not set.
+        retry_on (Tuple[Type[BaseException], ...]): The errors each backend's scheduler retries.
+
+        Returns:
+        BackendRouter: The router.
+        """
+        path = os.getenv("LLM_BACKENDS")
+        if not path:
+            return cls([default_backend])
+        with open(path) as f:
+            return cls.from_config(json.load(f), default_backend, retry_on)
+
+    def candidates(self, stage: Optional[str] = None) -> List[ChatBackend]:
+        """
+        Return the backends allowed for a stage, best first.
+
+        Args:
+        stage (str, optional): The chain stage, e.g. "narrative" or "evaluation".
+
+        Returns:
+        List[ChatBackend]: Healthy backends by score, then cooling down ones by when they recover.
+        """
+        names = self.routes.get(stage, self.default)
+        now = time.monotonic()
+        with self._lock:
+            healthy = [name for name in names if self._stats[name].cooldown_until <= now]
+            cooling = [name for name in names if self._stats[name].cooldown_until > now]
+            # sorted() is stable, so ties keep the order of the route
+            healthy.sort(key=lambda name: self._score(name, stage))
+            cooling.sort(key=lambda name: self._stats[name].cooldown_until)
+        return [self.backends[name] for name in healthy + cooling]
+
+    def _score(self, name: str, stage: Optional[str] = None) -> float:
+        stats = self._stats[name].stages.get(stage or "")
+        if stats is None or stats.latency_ewma is None:
+            return float("-inf")
+        return stats.latency_ewma + self.cost_weight * (stats.cost_ewma or 0.0)
+
+    def call(self, backend: ChatBackend, request: Dict[str, Any], stage: Optional[str] = None, **schedule) -> Any:
+        """
+        Send a request to a backend through its scheduler, recording latency, cost and failures.
+
+        Args:
+        backend (ChatBackend): The backend, usually from `candidates`.
+        request (Dict[str, Any]): Keyword arguments of `chat.completions.create` without the model.
+        stage (str, optional): The chain stage the latency and cost are recorded for.
+        **schedule: Passed to `RequestScheduler.call`.
+
+        Returns:
+        The backend's response.
+        """
+        latencies = []
+
+        def attempt():
+            started = time.monotonic()
+            try:
+                return backend.complete(request)
+            finally:
+                latencies.append(time.monotonic() - started)
+
+        try:
+            response = backend.scheduler.call(attempt, **schedule)
+        except Exception:
+            self.record_failure(backend.name)
+            raise
+        self.record_success(backend.name, latencies[-1], backend.cost(getattr(response, "usage", None)), stage)
+        return response
+
+    async def acall(
+        self, backend: ChatBackend, request: Dict[str, Any], stage: Optional[str] = None, **schedule
+    ) -> Any:
+        """Asynchronous version of `call`."""
+        latencies = []
+
+        async def attempt():
+            started = time.monotonic()
+            try:
+                return await backend.acomplete(request)
+            finally:
+                latencies.append(time.monotonic() - started)
+
+        try:
+            response = await backend.scheduler.acall(attempt, **schedule)
+        except Exception:
+            self.record_failure(backend.name)
+            raise
+        self.record_success(backend.name, latencies[-1], backend.cost(getattr(response, "usage", None)), stage)
+        return response
+
+    def record_success(self, name: str, seconds: float, cost: float = 0.0, stage: Optional[str] = None):
+        with self._lock:
+            stats = self._stats[name]
+            stats.requests += 1
+            stats.consecutive_failures = 0
+            stats.cooldown_until = 0.0
+            # Health is shared by all stages, speed and cost are not
+            stage_stats = stats.stages.setdefault(stage or "", StageStats())
+            stage_stats.requests += 1
+            stage_stats.latency_ewma = _ewma(stage_stats.latency_ewma, seconds, self.alpha)
+            stage_stats.cost_ewma = _ewma(stage_stats.cost_ewma, cost, self.alpha)
+        metrics.observe("llm_backend_seconds", seconds, backend=name)
+        metrics.inc("llm_backend_cost_usd_total", cost, backend=name)
+
+    def record_failure(self, name: str):
+        with self._lock:
+            stats = self._stats[name]
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= self.failure_threshold:
+                stats.cooldown_until = time.monotonic() + self.cooldown
+        metrics.inc("llm_backend_failures_total", backend=name)
+
+    def signature(self) -> Dict[str, Any]:
+        """
+        Describe the configuration that decides which model answers each stage.
+
+        Used in run keys, so journaled outputs are not replayed after the
+        backends or routes change. Live statistics are left out.
+
+        Returns:
+        Dict[str, Any]: The type, model and base URL of every backend, and the routes.
+        """
+        backends = {}
+        for name, backend in self.backends.items():
+            backends[name] = [type(backend).__name__, backend.model, getattr(backend, "base_url", None)]
+        return {"backends": backends, "routes": self.routes, "default": self.default}
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Return the live statistics of every backend.
+
+        Returns:
+        Dict[str, dict]: BackendStats fields plus the model, per backend name,
+            with the latency and cost per stage under "stages".
+        """
+        with self._lock:
+            return {
+                name: {"model": self.backends[name].model, **stats.model_dump()}
+                for name, stats in self._stats.items()
+            }
+
+def _ewma(average: Optional[float], sample: float, alpha: float) -> float:
+    return sample if average is None else alpha * sample + (1 - alpha) * average
+
+def _digest(messages: List[dict]) -> bytes:
+    return hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).digest()
+
+def _stub_number(seed: bytes, path: str) -> int:
+    return int.from_bytes(hashlib.sha256(seed + path.encode("utf-8")).digest()[:4], "big")
+
+def _stub_value(schema: Dict[str, Any], root: Dict[str, Any], seed: bytes, path: str = "") -> Any:
+    # A value of the schema's type derived from the seed, the same for the same seed and path
+    if "$ref" in schema:
+        ref = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            ref = ref[part]
+        return _stub_value(ref, root, seed, path)
+    if "anyOf" in schema:
+        return _stub_value(schema["anyOf"][0], root, seed, path)
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), "null")
+    number = _stub_number(seed, path)
+    if kind == "object":
+        return {
+            key: _stub_value(value, root, seed, f"{path}/{key}")
+            for key, value in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        return [_stub_value(schema.get("items", {}), root, seed, f"{path}/{i}") for i in range(number % 3 + 1)]
+    if kind == "integer":
+        return 18 + number % 60
+    if kind == "number":
+        return round(number % 1000 / 1000, 3)
+    if kind == "boolean":
+        return bool(number % 2)
+    if kind == "null":
+        return None
+    return f"{path.rsplit('/', 1)[-1].replace('_', ' ') or 'value'} {number % 10000:04d}"
+
+def _stub_text(messages: List[dict]) -> str:
+    number = _stub_number(_digest(messages), "")
+    return f"Stub reply {number:08x}."
@@ -0,0 +1,248 @@
+import asyncio
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, TextIO
+from pydantic import BaseModel
+from persona_generator import agenerate_personas, finish_run, run_checkpoint
+from scraper import scrape_website
+
+# Snapshot of one pipeline stage's progress
+class StageStats(BaseModel):
+    name: str  # Stage name: scrape, generate or save
+    concurrency: int  # Number of workers running the stage
+    processed: int = 0  # Items that completed the stage
+    failed: int = 0  # Items that raised in the stage
+    skipped: int = 0  # Items that needed no further work, e.g. unchanged pages
+    busy_seconds: float = 0.0  # Total time workers spent on items
+    queue_depth: int = 0  # Items waiting for the stage right now
+    max_queue_depth: int = 0  # Highest queue depth seen
+    throughput: float = 0.0  # Processed items per second of wall time
+
+# Summary of a whole batch run
+class BatchReport(BaseModel):
+    elapsed_seconds: float  # Wall time of the run
+    urls_completed: int  # URLs that made it through every stage
+    stages: List[StageStats]  # Per-stage statistics
+    failures: Dict[str, str]  # Error message per failed URL
+    skipped: Dict[str, str] = {}  # Dedup action per URL that needed no new personas
+
+class BatchPipeline:
+    """
+    Pipeline that scrapes, generates personas for and saves many URLs at once.
+
+    Each stage has its own worker pool fed by a bounded queue, so the stages
+    overlap across URLs while a slow stage blocks the ones feeding it instead
+    of letting work pile up in memory.
+    """
+
+    def __init__(
+        self,
+        neo4j_ops,
+        scrape_concurrency: int = 8,
+        generate_concurrency: int = 4,
+        save_concurrency: int = 2,
+        queue_size: int = 16,
+        report_interval: Optional[float] = None,
+        reporter: Callable[[List[StageStats]], None] = None,
+        scrape_options: Optional[Dict[str, Any]] = None,
+        generate_options: Optional[Dict[str, Any]] = None,
+        dedup=None,
+    ):
+        self.neo4j_ops = neo4j_ops
+        # Optional ContentDeduplicator, skips unchanged and mirrored pages
+        self.dedup = dedup
+        self.scrape_options = scrape_options or {}
+        self.generate_options = generate_options or {}
+        self.concurrency = {
+            "scrape": scrape_concurrency,
+            "generate": generate_concurrency,
+            "save": save_concurrency,
+        }
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.reporter = reporter or print_stage_stats
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._stats: Dict[str, StageStats] = {}
+        self._failures: Dict[str, str] = {}
+        self._skipped: Dict[str, str] = {}
+        self._started = 0.0
+
+    async def run(self, urls: Iterable[str]) -> BatchReport:
+        """
+        Process every URL through the scrape, generate and save stages.
+
+        Args:
+        urls (Iterable[str]): The URLs to process. It is consumed lazily, so
+            it can be a file or a stream.
+
+        Returns:
+        BatchReport: Timing, throughput and failures for the run.
+        """
+        self._started = time.monotonic()
+        self._failures = {}
+        self._skipped = {}
+        if self.dedup is not None:
+            await asyncio.to_thread(self.dedup.load)
+        concurrency = dict(self.concurrency)
+        if concurrency["save"] > 1:
+            # Parallel writers duplicate shared attribute nodes unless their keys are unique
+            missing = await asyncio.to_thread(self.neo4j_ops.missing_constraints)
+            if missing:
+                print(f"Warning: no uniqueness constraint on {', '.join(missing)}, saving with one writer. "
+                      "Run --ensure-schema to save in parallel.")
+                concurrency["save"] = 1
+        self._queues = {name: asyncio.Queue(maxsize=self.queue_size) for name in concurrency}
+        self._stats = {name: StageStats(name=name, concurrency=n) for name, n in concurrency.items()}
+
+        handlers = {"scrape": self._scrape, "generate": self._generate, "save": self._save}
+        next_stage = {"scrape": "generate", "generate": "save", "save": None}
+        workers = [
+            asyncio.create_task(self._worker(name, handlers[name], next_stage[name]))
+            for name, n in concurrency.items()
+            for _ in range(n)
+        ]
+        monitor = asyncio.create_task(self._monitor()) if self.report_interval else None
+
+        try:
+            await self._feed(urls)
+            # Stages are drained in order, so by the time a queue is joined
+            # nothing upstream can add to it anymore
+            for name in concurrency:
+                await self._queues[name].join()
+        finally:
+            for task in workers + ([monitor] if monitor else []):
+                task.cancel()
+            await asyncio.gather(*workers, *([monitor] if monitor else []), return_exceptions=True)
+
+        stats = self.stage_stats()
+        return BatchReport(
+            elapsed_seconds=time.monotonic() - self._started,
+            urls_completed=stats[-1].processed,
+            stages=stats,
+            failures=dict(self._failures),
+            skipped=dict(self._skipped),
+        )
+
+    def stage_stats(self) -> List[StageStats]:
+        """
+        Return the current statistics of every stage.
+
+        Returns:
+        List[StageStats]: One entry per stage, in pipeline order.
+        """
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        snapshot = []
+        for name, stats in self._stats.items():
+            snapshot.append(stats.model_copy(update={
+                "queue_depth": self._queues[name].qsize(),
+                "throughput": stats.processed / elapsed,
+            }))
+        return snapshot
+
+    async def _feed(self, urls: Iterable[str]):
+        # Pull URLs lazily off a worker thread so a blocking stream like
+        # stdin never stalls the event loop
+        iterator = iter(urls)
+        while True:
+            url = await asyncio.to_thread(next, iterator, None)
+            if url is None:
+                break
+            await self._put("scrape", url)
+
+    async def _put(self, stage: str, item: Any):
+        queue = self._queues[stage]
+        await queue.put(item)  # Blocks while the stage is saturated
+        stats = self._stats[stage]
+        stats.max_queue_depth = max(stats.max_queue_depth, queue.qsize())
+
+    async def _worker(self, stage: str, handler: Callable, next_stage: Optional[str]):
+        queue = self._queues[stage]
+        stats = self._stats[stage]
+        while True:
+            item = await queue.get()
+            url = item if isinstance(item, str) else item[0]
+            started = time.monotonic()
+            try:
+                result = await handler(item)
+            except Exception as e:
+                stats.failed += 1
+                self._failures[url] = f"{stage}: {e}"
+                result = None
+            else:
+                stats.processed += 1
+            finally:
+                stats.busy_seconds += time.monotonic() - started
+
+            try:
+                if result is not None and next_stage is not None:
+                    await self._put(next_stage, result)
+            finally:
+                queue.task_done()
+
+    async def _scrape(self, url: str):
+        if self.dedup is None:
+            scraped_text = await asyncio.to_thread(scrape_website, url, **self.scrape_options)
+            return url, scraped_text, None
+
+        page, decision = await asyncio.to_thread(self.dedup.scrape, url, **self.scrape_options)
+        if decision.action != "generate":
+            self._stats["scrape"].skipped += 1
+            self._skipped[url] = decision.action
+            return None
+        return url, page.text, page
+
+    async def _generate(self, item):
+        url, scraped_text, page = item
+        # The save stage clears the run's journal once the personas are stored
+        checkpoint = await asyncio.to_thread(run_checkpoint, scraped_text, **self.generate_options)
+        personas = await agenerate_personas(
+            scraped_text, progress=False, checkpoint=checkpoint, **self.generate_options,
+        )
+        return url, personas, page, checkpoint
+
+    async def _save(self, item):
+        url, personas, page, checkpoint = item
+        await asyncio.to_thread(self.neo4j_ops.save_personas, url, personas)
+        if page is not None and personas:
+            # Fingerprint last, so a failed save or a page without personas is regenerated next time
+            await asyncio.to_thread(self.dedup.record, url, page)
+        if checkpoint is not None:
+            # A failed save keeps the journal, so the rerun replays the calls instead of paying again
+            await asyncio.to_thread(finish_run, checkpoint)
+        return url
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.reporter(self.stage_stats())
+
+def read_urls(stream: TextIO) -> Iterable[str]:
+    """
+    Yield URLs from a text stream, one per line.
+
+    Blank lines and lines starting with '#' are skipped.
+
+    Args:
+    stream (TextIO): The file or stream to read.
+
+    Returns:
+    Iterable[str]: The URLs, in stream order.
+    """
+    for line in stream:
+        url = line.strip()
+        if url and not url.startswith("#"):
+            yield url
+
+def print_stage_stats(stats: List[StageStats]):
+    """
+    Print a one-line summary per pipeline stage.
+
+    Args:
+    stats (List[StageStats]): The stage statistics to print.
+    """
+    for stage in stats:
+        print(
+            f"[{stage.name}] done={stage.processed} failed={stage.failed} skipped={stage.skipped} "
+            f"queued={stage.queue_depth} (max {stage.max_queue_depth}) "
+            f"throughput={stage.throughput:.2f}/s busy={stage.busy_seconds:.1f}s "
+            f"workers={stage.concurrency}"
+        )
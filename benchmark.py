@@ -0,0 +1,353 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional
+from pydantic import BaseModel
+from chain import FusionChain, MinimalChainable
+from fakes import FakeLLM, InMemoryGraphStore, narrative, synthetic_personas
+from persona_generator import (
+    GENERATION_MODES, PERSONA_PROMPTS, SEED_PERSONALITIES, _finalize_personas, evaluate_personas, generate_personas,
+    usage_log,
+)
+
+# Persona counts accepted by --scales, besides plain numbers
+SCALE_SUFFIXES = {"k": 1_000, "m": 1_000_000}
+
+# Timing of one benchmark
+class BenchmarkResult(BaseModel):
+    name: str  # What was measured, e.g. "graph_write"
+    scale: int  # Personas or iterations the benchmark ran over
+    operations: int  # Timed operations
+    seconds: float  # Time spent in the operations, excluding setup between them
+    ops_per_second: float  # Operations per second
+    p50_ms: float  # Median operation latency
+    p95_ms: float  # 95th percentile operation latency
+    max_ms: float  # Slowest operation
+    details: Dict[str, float] = {}  # Benchmark-specific numbers, e.g. errors
+
+def measure(name: str, scale: int, operations: Iterable[Callable[[], object]], **details) -> BenchmarkResult:
+    """
+    Run and time each operation in turn.
+
+    Args:
+    name (str): The benchmark name.
+    scale (int): The benchmark's scale.
+    operations (Iterable[Callable]): The operations to time, may be a generator.
+    **details: Extra numbers to report.
+
+    Returns:
+    BenchmarkResult: The timings.
+    """
+    latencies = []
+    for operation in operations:
+        started = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - started)
+    seconds = sum(latencies)
+    return BenchmarkResult(
+        name=name,
+        scale=scale,
+        operations=len(latencies),
+        seconds=seconds,
+        ops_per_second=len(latencies) / seconds if seconds else 0.0,
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p95_ms=percentile(latencies, 0.95) * 1000,
+        max_ms=max(latencies, default=0.0) * 1000,
+        details=details,
+    )
+
+def percentile(values: List[float], fraction: float) -> float:
+    # Nearest-rank percentile, 0 for no values
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def bench_template_fill(iterations: int, page_tokens: int) -> BenchmarkResult:
+    """Fill every chain prompt from the context and the previous JSON output."""
+    llm = FakeLLM()
+    context = {"model": "analytical", "website_content": website_text(page_tokens)}
+    outputs = [llm.reply("analytical", step) for step in range(len(PERSONA_PROMPTS) - 1)]
+
+    def fill_chain():
+        for index, prompt in enumerate(PERSONA_PROMPTS):
+            MinimalChainable.fill_prompt(prompt, context, outputs[:index])
+
+    return measure("template_fill", iterations, [fill_chain] * iterations, prompts=len(PERSONA_PROMPTS))
+
+def bench_fusion_chain(iterations: int, llm: FakeLLM, page_tokens: int, max_workers: int) -> BenchmarkResult:
+    """Run the full persona chain for every seed personality against the fake model."""
+    context = {"website_content": website_text(page_tokens)}
+    failures = []
+
+    def run_chain():
+        try:
+            FusionChain.run(
+                context=context,
+                models=SEED_PERSONALITIES,
+                callable=llm,
+                prompts=PERSONA_PROMPTS,
+                evaluator=llm.evaluate,
+                get_model_name=lambda model: model,
+                max_workers=max_workers,
+            )
+        except Exception:
+            # Every model failed, which a high error rate makes likely
+            failures.append(1)
+
+    result = measure("fusion_chain", iterations, [run_chain] * iterations, max_workers=max_workers)
+    result.details.update(
+        calls=llm.calls, call_errors=llm.errors, failed_runs=len(failures),
+        mean_call_latency_ms=sum(llm.latencies) / len(llm.latencies) * 1000 if llm.latencies else 0.0,
+    )
+    return result
+
+def bench_finalize(iterations: int) -> BenchmarkResult:
+    """Combine the JSON and narrative of each chain into final personas."""
+    llm = FakeLLM()
+    result = FusionChain.run(
+        context={}, models=SEED_PERSONALITIES, callable=llm, prompts=["{{model}}"] * len(PERSONA_PROMPTS),
+        evaluator=llm.evaluate, get_model_name=lambda model: model,
+    )
+    return measure(
+        "finalize_personas", iterations, [lambda: _finalize_personas(result, verbose=False)] * iterations,
+        personas=len(result.all_prompt_responses),
+    )
+
+def bench_graph(scale: int, batch_size: int, queries: int) -> List[BenchmarkResult]:
+    """Write `scale` synthetic personas to the in-memory graph, then time the insight queries."""
+    store = InMemoryGraphStore()
+    personas = synthetic_personas(scale)
+
+    def batches():
+        # Generated lazily so a million personas are never all in memory at once
+        for index in itertools.count():
+            batch = list(itertools.islice(personas, batch_size))
+            if not batch:
+                return
+            yield lambda: store.save_personas(f"https://site-{index % 100}.example", batch)
+
+    write = measure("graph_write", scale, batches(), batch_size=batch_size)
+    write.details["personas_per_second"] = scale / write.seconds if write.seconds else 0.0
+
+    reads = [
+        lambda: store.find_common_interests(),
+        lambda: store.find_challenges_by_age_group("25-34"),
+        lambda: store.find_brands_by_value("values and belief 7"),
+        lambda: store.find_similar_personas(store.personas[0]["name"]),
+    ]
+    read = measure("graph_read", scale, [reads[i % len(reads)] for i in range(queries)])
+    return [write, read]
+
+def bench_generation_modes(text: str, modes: List[str], runs: int = 1, narrative: bool = True) -> List[BenchmarkResult]:
+    """
+    Time `generate_personas` in each generation mode, with its token use and persona scores.
+
+    Unlike the other benchmarks this calls the configured model backends,
+    the OpenAI API unless LLM_BACKENDS points elsewhere, e.g. at stub
+    backends. The personas of every run are scored with one more
+    `evaluate_personas` call after timing, so modes are compared on quality
+    as well as latency and tokens. Runs whose scoring fails are counted in
+    "failed_evaluations" and left out of "mean_score".
+
+    Args:
+    text (str): The website content to generate personas for.
+    modes (List[str]): The generation modes to compare, see GENERATION_MODES.
+    runs (int): Generation runs per mode.
+    narrative (bool): Whether the runs write narratives.
+
+    Returns:
+    List[BenchmarkResult]: One result per mode, named "generate_<mode>".
+    """
+    results = []
+    for mode in modes:
+        generated = []
+
+        def run():
+            # A fresh run id, so a configured checkpoint store never replays an earlier run
+            generated.append(generate_personas(text, mode=mode, narrative=narrative, run_id=uuid.uuid4().hex))
+
+        before = usage_log.totals()
+        result = measure(f"generate_{mode}", len(SEED_PERSONALITIES), [run] * runs)
+        after = usage_log.totals()
+        scores = []
+        failed_evaluations = 0
+        for personas in generated:
+            if not personas:
+                continue
+            try:
+                scores.extend(evaluate_personas([str(persona) for persona in personas], fallback=False)[1])
+            except Exception:
+                failed_evaluations += 1
+        result.details.update({
+            key: (after[key] - before[key]) / runs
+            for key in ("calls", "prompt_tokens", "cached_tokens", "completion_tokens")
+        })
+        result.details.update(
+            personas=sum(len(personas) for personas in generated) / runs,
+            mean_score=sum(scores) / len(scores) if scores else 0.0,
+            failed_evaluations=failed_evaluations,
+        )
+        results.append(result)
+    return results
+
+def website_text(tokens: int) -> str:
+    # About `tokens` tokens of page-like text
+    persona = next(synthetic_personas(1))
+    return narrative(persona, int(tokens * 0.75))
+
+def parse_scale(value: str) -> int:
+    """
+    Parse a persona count such as "1000", "100k" or "1m".
+
+    Args:
+    value (str): The count.
+
+    Returns:
+    int: The number of personas.
+    """
+    value = value.strip().lower()
+    if value and value[-1] in SCALE_SUFFIXES:
+        return int(float(value[:-1]) * SCALE_SUFFIXES[value[-1]])
+    return int(value)
+
+def parse_modes(value: str) -> List[str]:
+    # Comma-separated generation modes, e.g. "chained,batched"
+    modes = [mode.strip() for mode in value.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in GENERATION_MODES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown generation mode {unknown[0]!r}, use {', '.join(GENERATION_MODES)}")
+    return modes
+
+def compare(results: List[BenchmarkResult], baseline: List[BenchmarkResult], tolerance: float) -> List[str]:
+    """
+    Find benchmarks that got slower than a baseline run.
+
+    Args:
+    results (List[BenchmarkResult]): The current run.
+    baseline (List[BenchmarkResult]): The run to compare against.
+    tolerance (float): Allowed relative slowdown, e.g. 0.1 for 10%.
+
+    Returns:
+    List[str]: One message per regression.
+    """
+    previous = {(result.name, result.scale): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result.name, result.scale))
+        if before is None:
+            continue
+        if result.ops_per_second < before.ops_per_second * (1 - tolerance):
+            regressions.append(
+                f"{result.name}@{result.scale}: throughput {result.ops_per_second:.1f}/s "
+                f"vs {before.ops_per_second:.1f}/s"
+            )
+        if before.p95_ms and result.p95_ms > before.p95_ms * (1 + tolerance):
+            regressions.append(f"{result.name}@{result.scale}: p95 {result.p95_ms:.2f}ms vs {before.p95_ms:.2f}ms")
+    return regressions
+
+def run_benchmarks(args: argparse.Namespace) -> List[BenchmarkResult]:
+    results = [
+        bench_template_fill(args.iterations * 100, args.page_tokens),
+        bench_fusion_chain(
+            args.iterations,
+            FakeLLM(
+                median_latency=args.latency, latency_sigma=args.latency_sigma, list_size=args.list_size,
+                narrative_words=args.narrative_words, error_rate=args.error_rate, seed=args.seed,
+            ),
+            args.page_tokens,
+            args.max_workers,
+        ),
+        bench_finalize(args.iterations * 100),
+    ]
+    for scale in args.scales:
+        results.extend(bench_graph(scale, args.batch_size, args.queries))
+    if args.modes:
+        if args.mode_text:
+            with open(args.mode_text) as f:
+                text = f.read()
+        else:
+            text = website_text(args.page_tokens)
+        results.extend(bench_generation_modes(text, args.modes, args.mode_runs, narrative=not args.no_narrative))
+    return results
+
+def environment() -> Dict[str, Optional[str]]:
+    # Identifies the code and machine a run was made on
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform()}
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the persona pipeline offline.")
+    parser.add_argument("--scales", type=lambda value: [parse_scale(v) for v in value.split(",")],
+                        default=[1_000, 100_000], help="Synthetic persona counts for the graph benchmarks, "
+                                                       "e.g. 1k,100k,1m")
+    parser.add_argument("--iterations", type=int, default=20, help="Chain runs to time")
+    parser.add_argument("--latency", type=float, default=0.0, help="Median fake model latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.0,
+                        help="Log-normal spread of the fake model latency, 0 for fixed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of fake model calls that fail")
+    parser.add_argument("--list-size", type=int, default=3, help="Items per list attribute in fake replies")
+    parser.add_argument("--narrative-words", type=int, default=300, help="Words in the fake narrative")
+    parser.add_argument("--page-tokens", type=int, default=2000, help="Approximate tokens of fake website text")
+    parser.add_argument("--max-workers", type=int, default=len(SEED_PERSONALITIES),
+                        help="Concurrent model chains in FusionChain.run")
+    parser.add_argument("--batch-size", type=int, default=100, help="Personas per graph write")
+    parser.add_argument("--queries", type=int, default=20, help="Graph reads to time per scale")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the fake model")
+    parser.add_argument("--modes", type=parse_modes, metavar="MODE[,MODE]",
+                        help="Also time generate_personas in these generation modes, e.g. chained,combined,batched. "
+                             "This calls the configured model backends")
+    parser.add_argument("--mode-text", metavar="FILE",
+                        help="Website text for --modes, instead of synthetic text of --page-tokens")
+    parser.add_argument("--mode-runs", type=int, default=1, help="Generation runs per mode for --modes")
+    parser.add_argument("--no-narrative", action="store_true", help="Skip the narrative in --modes runs")
+    parser.add_argument("--output", metavar="FILE", help="Write the results as JSON to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="Compare against the results in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative slowdown against the baseline reported as a regression")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    results = run_benchmarks(args)
+
+    for result in results:
+        print(f"{result.name:<18} scale={result.scale:<8} {result.ops_per_second:>12.1f} ops/s  "
+              f"p50={result.p50_ms:.3f}ms  p95={result.p95_ms:.3f}ms")
+        if "mean_score" in result.details:
+            details = result.details
+            print(f"{'':<18} {details['calls']:.0f} calls, {details['prompt_tokens']:.0f} prompt and "
+                  f"{details['completion_tokens']:.0f} completion tokens per run, mean score {details['mean_score']:.2f}"
+                  f" ({details['failed_evaluations']:.0f} evaluations failed)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "environment": environment(),
+                "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+                "results": [result.model_dump() for result in results],
+            }, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = [BenchmarkResult(**result) for result in json.load(f)["results"]]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
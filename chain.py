@@ -1,13 +1,29 @@
-from typing import List, Dict, Callable, Any, Union
+import asyncio
+import hashlib
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable, Any, Optional, Union
 from pydantic import BaseModel
+from effects import Effect, Steps, run_async, run_sync
+from metrics import metrics
+from prompt_template import compile_template
+
+# How context-filled prompts are kept in the result: the "full" text, a
+# SHA-256 "hash" of it, or "none". Filled prompts usually embed the whole
+# context, so full copies can dominate a long-running process's memory.
+PROMPT_RETENTION = ("full", "hash", "none")
+# Model name under which evaluations are journaled in a checkpoint
+EVALUATION_CHECKPOINT = "__evaluation__"
 
 # Define the structure of the FusionChain result
 class FusionChainResult(BaseModel):
     top_response: Union[str, Dict[str, Any]]  # The best response from all models
     all_prompt_responses: List[List[Any]]  # All responses from all models
-    all_context_filled_prompts: List[List[str]]  # All prompts with context filled in
+    all_context_filled_prompts: List[List[str]]  # All prompts with context filled in, as kept by `keep_prompts`
     performance_scores: List[float]  # Performance scores for each model
     used_model_names: List[str]  # Names of all models used
+    model_errors: Dict[str, str] = {}  # Error messages for models whose chain failed
+    pruned_models: Dict[str, int] = {}  # Prompt index after which each pruned model was dropped
 
 class FusionChain:
     @staticmethod
@@ -18,62 +34,286 @@ class FusionChain:
         prompts: List[str],  # List of prompts to use
         evaluator: Callable[[List[str]], tuple[str, List[float]]],  # Function to evaluate outputs
         get_model_name: Callable[[Any], str],  # Function to get model names
+        max_workers: Optional[int] = None,  # Run up to this many model chains concurrently
+        prune_schedule: Optional[Dict[int, int]] = None,  # Prompt index -> models kept after it
+        keep_prompts: str = "full",  # "full", "hash" or "none", see PROMPT_RETENTION
+        checkpoint: Optional[Any] = None,  # RunCheckpoint journaling every step, to resume failed runs
     ) -> FusionChainResult:
-        all_outputs = []
-        all_context_filled_prompts = []
+        executor = None
+        if max_workers and max_workers > 1 and len(models) > 1:
+            executor = ThreadPoolExecutor(max_workers=min(max_workers, len(models)))
+        try:
+            return run_sync(FusionChain._steps(
+                context, models, callable, prompts, evaluator, get_model_name, prune_schedule, keep_prompts,
+                checkpoint, executor=executor,
+            ))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    @staticmethod
+    async def arun(
+        context: Dict[str, Any],  # Initial context for prompts
+        models: List[Any],  # List of models to use
+        callable: Callable,  # Function or coroutine function to call models
+        prompts: List[str],  # List of prompts to use
+        evaluator: Callable,  # Function or coroutine function to evaluate outputs
+        get_model_name: Callable[[Any], str],  # Function to get model names
+        max_concurrency: Optional[int] = None,  # Run up to this many model chains at once
+        prune_schedule: Optional[Dict[int, int]] = None,  # Prompt index -> models kept after it
+        keep_prompts: str = "full",  # "full", "hash" or "none", see PROMPT_RETENTION
+        checkpoint: Optional[Any] = None,  # RunCheckpoint journaling every step, to resume failed runs
+    ) -> FusionChainResult:
+        semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        return await run_async(FusionChain._steps(
+            context, models, callable, prompts, evaluator, get_model_name, prune_schedule, keep_prompts,
+            checkpoint, semaphore=semaphore,
+        ))
+
+    @staticmethod
+    def _steps(
+        context, models, callable, prompts, evaluator, get_model_name, prune_schedule, keep_prompts, checkpoint,
+        executor=None, semaphore=None,
+    ) -> Steps:
+        # The tournament behind `run` and `arun`. Each stage runs the surviving
+        # models on the thread pool when driven by `run`, or concurrently on
+        # the event loop when driven by `arun`.
+        _prompt_retainer(keep_prompts)  # Fail on an unknown option before any model is called
+        tournament = _Tournament(models, prompts, get_model_name, prune_schedule)
+
+        for start, end in tournament.stages():
+            alive = tournament.alive
+            chains = [
+                MinimalChainable._steps(
+                    context, models[index], callable, prompts[start:end], tournament.outputs[index], keep_prompts,
+                    checkpoint, tournament.model_name(index),
+                )
+                for index in alive
+            ]
+            stage_results = yield Effect(lambda: _run_chains(chains, executor), lambda: _arun_chains(chains, semaphore))
+            tournament.record(alive, stage_results)
 
-        # Run each model through the MinimalChainable
-        for model in models:
-            outputs, context_filled_prompts = MinimalChainable.run(
-                context, model, callable, prompts
-            )
-            all_outputs.append(outputs)
-            all_context_filled_prompts.append(context_filled_prompts)
+            if tournament.should_prune(end):
+                with metrics.timer("chain_evaluator_seconds", stage="prune"):
+                    _, scores = yield from tournament.evaluate(evaluator, end - 1, checkpoint)
+                tournament.prune(end, scores)
 
         # Evaluate the last output of each model
-        last_outputs = [outputs[-1] for outputs in all_outputs]
-        top_response, performance_scores = evaluator(last_outputs)
+        with metrics.timer("chain_evaluator_seconds", stage="final"):
+            top_response, performance_scores = yield from tournament.evaluate(evaluator, len(prompts) - 1, checkpoint)
+        return tournament.result(top_response, performance_scores)
+
+def _run_chains(chains: List[Steps], executor: Optional[ThreadPoolExecutor]) -> List[tuple]:
+    # Drive each model's chain to a (result, error) pair, on the thread pool
+    # if there is one. Results are collected in model order either way.
+    def run_chain(steps):
+        try:
+            return run_sync(steps), None
+        except Exception as e:
+            return None, e
+
+    if executor is None:
+        return [run_chain(steps) for steps in chains]
+    return list(executor.map(run_chain, chains))
+
+async def _arun_chains(chains: List[Steps], semaphore: Optional[asyncio.Semaphore]) -> List[tuple]:
+    async def run_chain(steps):
+        try:
+            if semaphore is None:
+                return await run_async(steps), None
+            async with semaphore:
+                return await run_async(steps), None
+        except Exception as e:
+            return None, e
+
+    # gather() returns results in model order regardless of completion order
+    return await asyncio.gather(*(run_chain(steps) for steps in chains))
+
+class _Tournament:
+    # Book-keeping shared by FusionChain.run and arun: which models are still
+    # running, what they produced so far, and which were dropped and when.
+
+    def __init__(self, models, prompts, get_model_name, prune_schedule):
+        self.models = models
+        self.prompts = prompts
+        self.get_model_name = get_model_name
+        for index, keep in (prune_schedule or {}).items():
+            if not 0 <= index < len(prompts):
+                raise ValueError(f"prune_schedule index {index} is outside the {len(prompts)} prompts")
+            if keep < 1:
+                raise ValueError(f"prune_schedule must keep at least one model after prompt {index}, not {keep}")
+        # Pruning after the last prompt is just the final evaluation
+        self.prune_schedule = {
+            index: keep for index, keep in (prune_schedule or {}).items() if index < len(prompts) - 1
+        }
+        self.alive = list(range(len(models)))
+        self.outputs = [[] for _ in models]
+        self.context_filled_prompts = [[] for _ in models]
+        self.model_errors = {}
+        self.pruned_models = {}
+        self._first_error = None
+
+    def stages(self):
+        # Split the prompts into (start, end) slices ending at each pruning point
+        start = 0
+        for index in sorted(self.prune_schedule):
+            yield start, index + 1
+            start = index + 1
+        yield start, len(self.prompts)
 
+    def record(self, indexes, stage_results):
+        alive = []
+        for index, (chain_result, error) in zip(indexes, stage_results):
+            if error is not None:
+                # One model failing must not throw away the other models' work
+                self.model_errors[self.get_model_name(self.models[index])] = str(error)
+                self._first_error = self._first_error or error
+                continue
+            outputs, context_filled_prompts = chain_result
+            self.outputs[index] = outputs
+            self.context_filled_prompts[index].extend(context_filled_prompts)
+            alive.append(index)
+        self.alive = alive
+
+        if not self.alive:
+            # Nothing left to evaluate, surface the first failure
+            raise self._first_error
+
+    def should_prune(self, end):
+        keep = self.prune_schedule.get(end - 1)
+        return keep is not None and len(self.alive) > keep
+
+    def prune(self, end, scores):
+        # Keep the top-k scoring models, preserving their original order
+        keep = self.prune_schedule[end - 1]
+        ranked = sorted(range(len(self.alive)), key=lambda i: scores[i] if i < len(scores) else 0.0, reverse=True)
+        kept = {self.alive[i] for i in ranked[:keep]}
+        for index in self.alive:
+            if index not in kept:
+                self.pruned_models[self.get_model_name(self.models[index])] = end - 1
+        self.alive = [index for index in self.alive if index in kept]
+
+    def last_outputs(self):
+        return [self.outputs[index][-1] for index in self.alive]
+
+    def model_name(self, index):
+        return self.get_model_name(self.models[index])
+
+    def evaluate(self, evaluator, step, checkpoint) -> Steps:
+        # Evaluations are journaled too, so a resumed run prunes the same
+        # models. One made over a different set of models doesn't apply.
+        outputs = self.last_outputs()
+        models = [self.model_name(index) for index in self.alive]
+        if checkpoint is not None:
+            evaluation = (yield Effect(lambda: checkpoint.steps(EVALUATION_CHECKPOINT))).get(step)
+            if evaluation is not None and evaluation["models"] == models:
+                return evaluation["top_response"], evaluation["scores"]
+
+        top_response, scores = yield Effect(lambda: evaluator(outputs), lambda: evaluator(outputs))
+        if checkpoint is not None:
+            yield Effect(lambda: checkpoint.record(EVALUATION_CHECKPOINT, step, {
+                "models": models,
+                "top_response": top_response,
+                "scores": list(scores),
+            }))
+        return top_response, scores
+
+    def result(self, top_response, performance_scores) -> FusionChainResult:
         # Get the names of all models used
-        model_names = [get_model_name(model) for model in models]
+        model_names = [self.get_model_name(self.models[index]) for index in self.alive]
 
         # Return the result in the defined structure
         return FusionChainResult(
             top_response=top_response,
-            all_prompt_responses=all_outputs,
-            all_context_filled_prompts=all_context_filled_prompts,
+            all_prompt_responses=[self.outputs[index] for index in self.alive],
+            all_context_filled_prompts=[self.context_filled_prompts[index] for index in self.alive],
             performance_scores=performance_scores,
             used_model_names=model_names,
+            model_errors=self.model_errors,
+            pruned_models=self.pruned_models,
         )
 
 class MinimalChainable:
     @staticmethod
     def run(
-        context: Dict[str, Any], model: Any, callable: Callable, prompts: List[str]
+        context: Dict[str, Any], model: Any, callable: Callable, prompts: List[str],
+        prior_outputs: Optional[List[Any]] = None, keep_prompts: str = "full",
+        checkpoint: Optional[Any] = None, model_name: Optional[str] = None,
+    ) -> tuple[List[Any], List[str]]:
+        return run_sync(MinimalChainable._steps(
+            context, model, callable, prompts, prior_outputs, keep_prompts, checkpoint, model_name,
+        ))
+
+    @staticmethod
+    async def arun(
+        context: Dict[str, Any], model: Any, callable: Callable, prompts: List[str],
+        prior_outputs: Optional[List[Any]] = None, keep_prompts: str = "full",
+        checkpoint: Optional[Any] = None, model_name: Optional[str] = None,
     ) -> tuple[List[Any], List[str]]:
-        output = []
+        # `callable` may be a plain or a coroutine function
+        return await run_async(MinimalChainable._steps(
+            context, model, callable, prompts, prior_outputs, keep_prompts, checkpoint, model_name,
+        ))
+
+    @staticmethod
+    def _steps(context, model, callable, prompts, prior_outputs, keep_prompts, checkpoint, model_name) -> Steps:
+        # Continue a chain from earlier outputs, e.g. between tournament stages
+        output = list(prior_outputs or [])
         context_filled_prompts = []
+        retain = _prompt_retainer(keep_prompts)
+        # Steps journaled by an earlier attempt of this run are replayed instead of called
+        model_name = str(model) if model_name is None else model_name
+        journaled = {}
+        if checkpoint is not None:
+            journaled = yield Effect(lambda: checkpoint.steps(model_name))
+        # {{model}} resolves to the model itself unless the context overrides it
+        context = {"model": model, **context}
+
+        # Callables that take a `step` argument are told which prompt they are answering
+        step_kwargs = _step_kwargs(callable)
 
         for prompt in prompts:
-            # Replace context placeholders in the prompt
-            for key, value in context.items():
-                prompt = prompt.replace("{{" + key + "}}", str(value))
-
-            # Replace output placeholders in the prompt
-            for i, prev_output in enumerate(output):
-                if isinstance(prev_output, dict):
-                    # Replace the entire output dict
-                    prompt = prompt.replace(f"{{{{output[-{len(output)-i}]}}}}", str(prev_output))
-                    # Replace individual keys from the output dict
-                    for key, value in prev_output.items():
-                        prompt = prompt.replace(f"{{{{output[-{len(output)-i}].{key}}}}}", str(value))
-                else:
-                    # Replace the entire output if it's not a dict
-                    prompt = prompt.replace(f"{{{{output[-{len(output)-i}]}}}}", str(prev_output))
-
-            context_filled_prompts.append(prompt)
-            # Call the model with the filled prompt
-            result = callable(model, prompt)
+            prompt = MinimalChainable.fill_prompt(prompt, context, output)
+            if retain is not None:
+                context_filled_prompts.append(retain(prompt))
+            step = len(output)
+            if step in journaled:
+                metrics.inc("chain_steps_resumed_total")
+                output.append(journaled[step])
+                continue
+            # Call the model with the filled prompt, awaiting it in `arun` if it is async
+            call = lambda: callable(model, prompt, **step_kwargs(step))
+            with metrics.timer("chain_prompt_seconds", model=model, step=step):
+                result = yield Effect(call, call)
+            if checkpoint is not None:
+                yield Effect(lambda: checkpoint.record(model_name, step, result))
             output.append(result)
 
         return output, context_filled_prompts
+
+    @staticmethod
+    def fill_prompt(prompt: str, context: Dict[str, Any], output: List[Any]) -> str:
+        # Prompts are compiled once and cached, then filled in a single pass. A
+        # placeholder without a value raises, instead of sending it to the model.
+        return compile_template(prompt).render_strict(context, output)
+
+def _prompt_retainer(keep_prompts):
+    # Maps a filled prompt to what the result keeps of it, None to keep nothing
+    if keep_prompts == "full":
+        return lambda prompt: prompt
+    if keep_prompts == "hash":
+        return lambda prompt: hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    if keep_prompts == "none":
+        return None
+    raise ValueError(f"keep_prompts must be one of {', '.join(PROMPT_RETENTION)}, not {keep_prompts!r}")
+
+def _step_kwargs(callable):
+    # The step is the index of the prompt in the full chain, so it stays
+    # correct when a chain continues from prior outputs
+    try:
+        accepts_step = "step" in inspect.signature(callable).parameters
+    except (TypeError, ValueError):
+        accepts_step = False
+    if accepts_step:
+        return lambda step: {"step": step}
+    return lambda step: {}
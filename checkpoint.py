@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+class CheckpointStore:
+    """
+    Journal of completed chain steps backed by SQLite.
+
+    Every output is written as soon as its call returns, keyed by
+    (run id, model, step). A chain run again with the same run id replays
+    the journaled steps instead of calling the model, so a run that failed
+    or was killed part-way resumes from the last completed step of each
+    model. Runs older than `ttl_seconds` are deleted when the store opens.
+    """
+
+    def __init__(self, path: str, ttl_seconds: Optional[float] = None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS steps (
+                run_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                step INTEGER NOT NULL,
+                output TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (run_id, model, step)
+            )
+            """)
+            if ttl_seconds is not None:
+                self._conn.execute("DELETE FROM steps WHERE created_at < ?", (time.time() - ttl_seconds,))
+
+    @classmethod
+    def from_env(cls) -> Optional["CheckpointStore"]:
+        """
+        Build a store from the CHECKPOINT_* environment variables.
+
+        CHECKPOINT_PATH enables checkpointing. CHECKPOINT_TTL (seconds) is optional.
+
+        Returns:
+        Optional[CheckpointStore]: The store, or None if CHECKPOINT_PATH is not set.
+        """
+        path = os.getenv("CHECKPOINT_PATH")
+        if not path:
+            return None
+        ttl = os.getenv("CHECKPOINT_TTL")
+        return cls(path, ttl_seconds=float(ttl) if ttl else None)
+
+    @staticmethod
+    def run_key(*parts: Any) -> str:
+        """
+        Hash everything that determines a run's outputs into a run id.
+
+        Args:
+        *parts: JSON-serializable inputs, e.g. the model name, prompts and website content.
+
+        Returns:
+        str: A hex SHA-256 digest.
+        """
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def run(self, run_id: str) -> "RunCheckpoint":
+        return RunCheckpoint(self, run_id)
+
+    def steps(self, run_id: str, model: str) -> Dict[int, Any]:
+        """
+        Read the journaled outputs of one model in a run.
+
+        Args:
+        run_id (str): The run id.
+        model (str): The model name.
+
+        Returns:
+        Dict[int, Any]: Output per completed step.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT step, output FROM steps WHERE run_id = ? AND model = ?", (run_id, model)
+            ).fetchall()
+        return {step: json.loads(output) for step, output in rows}
+
+    def record(self, run_id: str, model: str, step: int, output: Any):
+        """
+        Journal a completed step, committing it before returning.
+
+        Args:
+        run_id (str): The run id.
+        model (str): The model name.
+        step (int): The index of the prompt in the chain.
+        output: The step's output, a string or JSON-serializable value.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO steps (run_id, model, step, output, created_at) VALUES (?, ?, ?, ?, ?)",
+                (run_id, model, step, json.dumps(output, ensure_ascii=False), time.time()),
+            )
+
+    def clear(self, run_id: Optional[str] = None):
+        # Forget one run, or every run
+        with self._lock, self._conn:
+            if run_id is None:
+                self._conn.execute("DELETE FROM steps")
+            else:
+                self._conn.execute("DELETE FROM steps WHERE run_id = ?", (run_id,))
+
+    def close(self):
+        self._conn.close()
+
+class RunCheckpoint:
+    """A CheckpointStore bound to one run id, as taken by the chain classes."""
+
+    def __init__(self, store: CheckpointStore, run_id: str):
+        self.store = store
+        self.run_id = run_id
+        # Set when a chain of the run failed, so the journal is kept for a rerun to resume it
+        self.failed = False
+
+    def steps(self, model: str) -> Dict[int, Any]:
+        return self.store.steps(self.run_id, model)
+
+    def record(self, model: str, step: int, output: Any):
+        self.store.record(self.run_id, model, step, output)
+
+    def clear(self):
+        self.store.clear(self.run_id)
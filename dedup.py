@@ -0,0 +1,110 @@
+from typing import Optional, Tuple
+from pydantic import BaseModel
+from fingerprint import SimHashIndex
+from metrics import metrics
+from scraper import ScrapedPage, scrape_page
+
+# What to do with a scraped page
+class DedupDecision(BaseModel):
+    action: str  # "generate", "unchanged" or "duplicate"
+    duplicate_of: Optional[str] = None  # The website whose personas a duplicate reuses
+    distance: Optional[int] = None  # SimHash distance to that website
+
+class ContentDeduplicator:
+    """
+    Skips persona generation for pages that haven't changed or that mirror another website.
+
+    Each website's fingerprint (content hash, SimHash, ETag and
+    Last-Modified) is stored on its Website node. A re-scrape first sends a
+    conditional request; if the page is unchanged, its personas are kept. A
+    page without personas whose SimHash is within `max_distance` bits of an
+    already processed website is linked to that website's personas instead.
+    Pages that already have personas and changed are always regenerated.
+    """
+
+    def __init__(self, neo4j_ops, max_distance: int = 3):
+        self.neo4j_ops = neo4j_ops
+        self.index = SimHashIndex(max_distance)
+        self._loaded = False
+
+    def load(self):
+        """Index the fingerprints of every website in the database."""
+        for url, fingerprint in self.neo4j_ops.fetch_website_fingerprints():
+            self.index.add(url, int(fingerprint, 16))
+        self._loaded = True
+
+    def scrape(self, url: str, **scrape_options) -> Tuple[ScrapedPage, DedupDecision]:
+        """
+        Scrape a page and decide whether it needs new personas.
+
+        Unchanged pages and near-duplicates are recorded in the database
+        here, so only pages with the "generate" action need further work,
+        followed by `record` once their personas are saved.
+
+        Args:
+        url (str): The website URL.
+        **scrape_options: Passed to `scrape_page`.
+
+        Returns:
+        Tuple[ScrapedPage, DedupDecision]: The page and what to do with it.
+        """
+        if not self._loaded:
+            self.load()
+        previous = self.neo4j_ops.get_website_fingerprint(url)
+        has_personas = bool(previous and previous["has_personas"])
+        page = scrape_page(
+            url,
+            etag=previous["etag"] if has_personas else None,
+            last_modified=previous["last_modified"] if has_personas else None,
+            **scrape_options,
+        )
+        decision = self.decide(url, page, previous)
+        metrics.inc("dedup_decisions_total", action=decision.action)
+
+        if decision.action == "unchanged" and not page.not_modified:
+            # Keep the validators current for the next conditional request
+            self.neo4j_ops.record_fingerprint(url, page.fingerprint())
+        elif decision.action == "duplicate":
+            self.neo4j_ops.link_duplicate_website(url, decision.duplicate_of, decision.distance, page.fingerprint())
+        return page, decision
+
+    def decide(self, url: str, page: ScrapedPage, previous: Optional[dict]) -> DedupDecision:
+        """
+        Decide what to do with a scraped page, without side effects.
+
+        Args:
+        url (str): The website URL.
+        page (ScrapedPage): The scrape result.
+        previous (dict, optional): The fingerprint stored by the last scrape.
+
+        Returns:
+        DedupDecision: The decision.
+        """
+        if previous and previous["has_personas"]:
+            if page.not_modified or previous["content_hash"] == page.content_hash:
+                return DedupDecision(action="unchanged")
+            # A changed page with personas of its own, or linked from a
+            # website it no longer duplicates, gets new ones
+            return DedupDecision(action="generate")
+        if page.simhash is not None:
+            near = self.index.near(int(page.simhash, 16), exclude=url)
+            if near:
+                canonical, distance = near[0]
+                return DedupDecision(action="duplicate", duplicate_of=canonical, distance=distance)
+        return DedupDecision(action="generate")
+
+    def record(self, url: str, page: ScrapedPage):
+        """
+        Store the fingerprint of a page whose personas were just saved.
+
+        A website that was a duplicate before loses its link and the
+        personas it reused, keeping only the ones just generated for it.
+
+        Args:
+        url (str): The website URL.
+        page (ScrapedPage): The page the personas were generated from.
+        """
+        self.neo4j_ops.unlink_duplicate_website(url)
+        self.neo4j_ops.record_fingerprint(url, page.fingerprint())
+        if page.simhash is not None:
+            self.index.add(url, int(page.simhash, 16))
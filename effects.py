@@ -0,0 +1,81 @@
+import asyncio
+import inspect
+from typing import Any, Callable, Generator, Optional
+
+# A step generator yields Effects and finally returns its result
+Steps = Generator["Effect", Any, Any]
+
+class Effect:
+    """
+    One I/O operation requested by a step generator.
+
+    Step generators hold the logic of a function whose blocking and asyncio
+    versions would otherwise be copies of each other. `run_sync` performs
+    each effect by calling `sync`. `run_async` awaits `async_` when given,
+    and otherwise runs `sync` on a worker thread, so blocking I/O such as
+    SQLite never stalls the event loop.
+    """
+
+    __slots__ = ("sync", "async_")
+
+    def __init__(self, sync: Callable[[], Any], async_: Optional[Callable[[], Any]] = None):
+        self.sync = sync
+        self.async_ = async_
+
+def run_sync(steps: Steps) -> Any:
+    """
+    Drive a step generator with blocking calls.
+
+    The result of every effect is sent back into the generator, and an
+    error is raised inside it at the `yield`, so it can handle the error.
+
+    Args:
+    steps (Steps): The step generator.
+
+    Returns:
+    Any: The generator's return value.
+    """
+    value, error = None, None
+    try:
+        while True:
+            try:
+                effect = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            value, error = None, None
+            try:
+                value = effect.sync()
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
+
+async def run_async(steps: Steps) -> Any:
+    """
+    Asynchronous version of `run_sync`.
+
+    Args:
+    steps (Steps): The step generator.
+
+    Returns:
+    Any: The generator's return value.
+    """
+    value, error = None, None
+    try:
+        while True:
+            try:
+                effect = steps.send(value) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            value, error = None, None
+            try:
+                if effect.async_ is None:
+                    value = await asyncio.to_thread(effect.sync)
+                else:
+                    value = effect.async_()
+                    if inspect.isawaitable(value):
+                        value = await value
+            except Exception as e:
+                error = e
+    finally:
+        steps.close()
@@ -0,0 +1,249 @@
+import csv
+import itertools
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List
+from urllib.parse import quote, unquote
+from pydantic import BaseModel
+from metrics import metrics
+from neo4j_operations import ATTRIBUTES, LIST_ATTRIBUTES, PERSONA_PROPERTIES
+
+# File formats the exporter writes and the importer reads
+EXPORT_FORMATS = ("parquet", "csv")
+# Personas read per query and written per part file
+DEFAULT_PAGE_SIZE = 1000
+
+# Columns of each exported table. Personas and attributes are partitioned by
+# website in Hive style (personas/website=<quoted url>/part-00000.parquet),
+# so the website is a partition key rather than a column.
+TABLE_COLUMNS = {
+    "personas": ["persona_id", *PERSONA_PROPERTIES, "insights", "day_in_life"],
+    "attributes": ["persona_id", "rel_type", "value"],
+    "websites": ["url", "content_hash", "simhash", "etag", "last_modified", "duplicate_of", "distance"],
+}
+# Columns holding integers, everything else is a string
+INTEGER_COLUMNS = {"age", "distance"}
+
+# Persona key per relationship type, and the relationship types whose key holds a list
+_PERSONA_KEYS = {rel_type: key for key, _, _, rel_type in ATTRIBUTES}
+_LIST_RELATIONSHIPS = {rel_type for _, _, _, rel_type in LIST_ATTRIBUTES}
+
+# Summary of an export or import
+class TransferReport(BaseModel):
+    websites: int = 0  # Websites whose personas were transferred
+    duplicates: int = 0  # Websites linked to another website's personas
+    personas: int = 0  # Personas transferred
+    attributes: int = 0  # Persona attribute links transferred
+    files: int = 0  # Files written or read
+
+def export_personas(
+    neo4j_ops,
+    path: str,
+    format: str = "parquet",
+    page_size: int = DEFAULT_PAGE_SIZE,
+    max_workers: int = 4,
+) -> TransferReport:
+    """
+    Export every persona and its attribute links, partitioned by website.
+
+    Websites are exported in parallel, each read page by page and written
+    as it is read, so memory use is bounded by `page_size` per worker.
+    Near-duplicate websites are exported as links to their canonical
+    website rather than as copies of its personas.
+
+    Args:
+    neo4j_ops (Neo4jOperations): The database to export.
+    path (str): The output directory.
+    format (str): "parquet" (needs pyarrow) or "csv".
+    page_size (int): Personas read per query and written per part file.
+    max_workers (int): Websites exported at once.
+
+    Returns:
+    TransferReport: What was exported.
+    """
+    _check_format(format)
+    websites = neo4j_ops.fetch_websites()
+    report = TransferReport(duplicates=sum(website["duplicate_of"] is not None for website in websites))
+    _write_table(format, os.path.join(path, "websites"), "websites", websites)
+    report.files += 1
+
+    def export_website(url):
+        counts = TransferReport(websites=1)
+        after = None
+        for page_number in itertools.count():
+            page = neo4j_ops.fetch_persona_page(url, after=after, limit=page_size)
+            if not page:
+                break
+            personas, attributes = _page_rows(page)
+            part = f"part-{page_number:05d}"
+            _write_table(format, os.path.join(path, "personas", _partition(url), part), "personas", personas)
+            _write_table(format, os.path.join(path, "attributes", _partition(url), part), "attributes", attributes)
+            counts.personas += len(personas)
+            counts.attributes += len(attributes)
+            counts.files += 2
+            if len(page) < page_size:
+                break
+            after = page[-1]["id"]
+        metrics.inc("export_personas_total", counts.personas)
+        return counts
+
+    canonical = [website["url"] for website in websites if website["duplicate_of"] is None]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for counts in executor.map(export_website, canonical):
+            if counts.personas:
+                report.websites += 1
+                report.personas += counts.personas
+                report.attributes += counts.attributes
+                report.files += counts.files
+    return report
+
+def import_personas(neo4j_ops, path: str, batch_size: int = 100, max_workers: int = 2) -> TransferReport:
+    """
+    Load an export into a database through the batched persona ingest.
+
+    Each website's personas are written with `save_personas`, so a whole
+    batch of personas goes in one UNWIND statement. Website fingerprints
+    and duplicate links are restored once every persona is written.
+
+    Args:
+    neo4j_ops (Neo4jOperations): The database to load into.
+    path (str): The directory written by `export_personas`.
+    batch_size (int): Maximum number of personas written per transaction.
+    max_workers (int): Websites loaded at once, one when the database
+        lacks the uniqueness constraints that keep parallel writers from
+        duplicating shared attribute nodes.
+
+    Returns:
+    TransferReport: What was imported.
+    """
+    report = TransferReport()
+    partitions = _partitions(os.path.join(path, "personas"))
+
+    def import_website(url):
+        personas = _read_personas(os.path.join(path, "personas", _partition(url)),
+                                  os.path.join(path, "attributes", _partition(url)))
+        neo4j_ops.save_personas(url, personas, batch_size=batch_size)
+        return len(personas)
+
+    if max_workers > 1:
+        missing = neo4j_ops.missing_constraints()
+        if missing:
+            print(f"Warning: no uniqueness constraint on {', '.join(missing)}, importing with one writer. "
+                  "Run --ensure-schema to import in parallel.")
+            max_workers = 1
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for count in executor.map(import_website, partitions):
+            report.websites += 1
+            report.personas += count
+
+    websites = list(_read_table_files(os.path.join(path, "websites")))
+    for website in websites:
+        fingerprint = {key: website[key] for key in ("content_hash", "simhash", "etag", "last_modified")}
+        if website["duplicate_of"] is not None:
+            neo4j_ops.link_duplicate_website(website["url"], website["duplicate_of"], website["distance"], fingerprint)
+            report.duplicates += 1
+        elif any(value is not None for value in fingerprint.values()):
+            neo4j_ops.record_fingerprint(website["url"], fingerprint)
+    metrics.inc("import_personas_total", report.personas)
+    return report
+
+def _check_format(format: str):
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}, not {format!r}")
+
+def _partition(url: str) -> str:
+    return f"website={quote(url, safe='')}"
+
+def _partitions(directory: str) -> List[str]:
+    # Website URLs of the partition directories under a table
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        unquote(name[len("website="):]) for name in os.listdir(directory) if name.startswith("website=")
+    )
+
+def _page_rows(page: List[dict]):
+    # Split a page of personas into persona rows and attribute link rows
+    personas = []
+    attributes = []
+    for record in page:
+        properties = record["properties"]
+        row = {"persona_id": record["id"]}
+        row.update({key: properties.get(key) for key in PERSONA_PROPERTIES})
+        row["insights"] = record["insights"][0] if record["insights"] else None
+        row["day_in_life"] = record["day_in_life"][0] if record["day_in_life"] else None
+        personas.append(row)
+        attributes.extend(
+            {"persona_id": record["id"], "rel_type": rel_type, "value": value}
+            for rel_type, value in record["attributes"]
+        )
+    return personas, attributes
+
+def _read_personas(persona_dir: str, attribute_dir: str) -> List[dict]:
+    # Rebuild persona dicts in the form save_personas takes
+    links: Dict[str, Dict[str, list]] = defaultdict(lambda: defaultdict(list))
+    for row in _read_table_files(attribute_dir):
+        links[row["persona_id"]][row["rel_type"]].append(row["value"])
+
+    personas = []
+    for row in _read_table_files(persona_dir):
+        persona = {key: row[key] for key in PERSONA_PROPERTIES if row.get(key) is not None}
+        for rel_type, values in links.get(row["persona_id"], {}).items():
+            persona[_PERSONA_KEYS[rel_type]] = values if rel_type in _LIST_RELATIONSHIPS else values[0]
+        if row.get("insights") is not None:
+            persona["flashmark_insights"] = row["insights"]
+        if row.get("day_in_life") is not None:
+            persona["A Day in the Life"] = row["day_in_life"]
+        personas.append(persona)
+    return personas
+
+def _write_table(format: str, path: str, table: str, rows: List[dict]):
+    # Write rows to path plus the format's extension, creating directories as needed
+    columns = TABLE_COLUMNS[table]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if format == "csv":
+        with open(f"{path}.csv", "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+
+    pa, pq = _pyarrow()
+    schema = pa.schema([(column, pa.int64() if column in INTEGER_COLUMNS else pa.string()) for column in columns])
+    data = {column: [_coerce(column, row.get(column)) for row in rows] for column in columns}
+    pq.write_table(pa.table(data, schema=schema), f"{path}.parquet")
+
+def _read_table_files(path: str) -> Iterator[dict]:
+    # Rows of a table file, or of every part file in a partition directory, in order
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    else:
+        files = [f"{path}.{format}" for format in EXPORT_FORMATS if os.path.exists(f"{path}.{format}")]
+    for file in files:
+        if file.endswith(".csv"):
+            with open(file, newline="", encoding="utf-8") as f:
+                for row in csv.DictReader(f):
+                    # CSV has no nulls or types, empty cells are missing values
+                    yield {column: _coerce(column, value or None) for column, value in row.items()}
+        elif file.endswith(".parquet"):
+            _, pq = _pyarrow()
+            yield from pq.read_table(file).to_pylist()
+
+def _coerce(column: str, value):
+    if value is None or column not in INTEGER_COLUMNS:
+        return None if value is None else str(value)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def _pyarrow():
+    # pyarrow is only needed for Parquet, so it is imported on first use
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet export needs pyarrow (pip install pyarrow), or use format='csv'") from e
+    return pyarrow, pyarrow.parquet
@@ -0,0 +1,277 @@
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from collections import Counter, defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+from neo4j_operations import persona_row
+from persona_schema import persona_dict
+
+# Offline stand-ins for the OpenAI API and Neo4j, used by benchmark.py and tests
+
+FIRST_NAMES = ["Ava", "Ben", "Chloe", "Diego", "Emma", "Farah", "Gus", "Hana", "Ivan", "Jade", "Kofi", "Lena"]
+LAST_NAMES = ["Smith", "Garcia", "Chen", "Okafor", "Novak", "Patel", "Silva", "Kim", "Müller", "Haddad"]
+GENDERS = ["Female", "Male", "Non-binary"]
+ETHNICITIES = ["Asian", "Black", "Hispanic", "White", "Middle Eastern", "Mixed"]
+LOCATIONS = ["Seattle", "Austin", "Denver", "Boston", "Chicago", "Toronto", "London", "Berlin"]
+OCCUPATIONS = ["Designer", "Nurse", "Engineer", "Teacher", "Accountant", "Chef", "Founder", "Analyst"]
+INCOME_LEVELS = ["Low", "Lower-middle", "Middle", "Upper-middle", "High"]
+EDUCATION_LEVELS = ["High school", "Associate", "Bachelor's", "Master's", "Doctorate"]
+# Vocabulary sizes per list attribute, so larger synthetic graphs get realistic hub nodes
+LIST_VOCABULARIES = {
+    "values_and_beliefs": 40, "challenges": 120, "needs": 80, "frustrations": 100, "goals": 90,
+    "behaviors": 150, "other_brands": 300, "purchases": 400, "lifestyle": 60, "interests": 200,
+    "media_consumption": 80,
+}
+
+class FakeLLMError(RuntimeError):
+    """Raised by `FakeLLM` for a simulated API failure."""
+
+class FakeLLM:
+    """
+    Deterministic stand-in for the persona chain's model callable.
+
+    Replies follow the persona chain: JSON for the first four steps, each
+    adding the fields of its stage, then a narrative. Latency is drawn from
+    a log-normal distribution with the given median and spread (0 spread
+    means fixed latency), and calls fail with probability `error_rate`.
+
+    Args:
+    median_latency (float): Median seconds per call.
+    latency_sigma (float): Log-normal sigma, 0 for fixed latency.
+    list_size (int): Items per list attribute, which sets the JSON size.
+    narrative_words (int): Words in the final narrative.
+    error_rate (float): Probability that a call raises `FakeLLMError`.
+    seed (int): Seed for the latency and error draws and the persona content.
+    """
+
+    def __init__(
+        self,
+        median_latency: float = 0.0,
+        latency_sigma: float = 0.0,
+        list_size: int = 3,
+        narrative_words: int = 300,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.median_latency = median_latency
+        self.latency_sigma = latency_sigma
+        self.list_size = list_size
+        self.narrative_words = narrative_words
+        self.error_rate = error_rate
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.latencies: List[float] = []
+
+    def _draw(self) -> Tuple[float, bool]:
+        # One locked draw per call keeps results reproducible for a given seed and call order
+        with self._lock:
+            self.calls += 1
+            latency = self.median_latency
+            if self.latency_sigma > 0 and latency > 0:
+                latency = self._random.lognormvariate(math.log(latency), self.latency_sigma)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            self.latencies.append(latency)
+            return latency, failed
+
+    def reply(self, model: str, step: int):
+        # The same model always describes the same persona, so steps build on each other
+        seed = zlib.crc32(f"{self.seed}:{model}".encode())
+        persona = synthetic_persona(seed, list_size=self.list_size, personality=model)
+        if step >= len(STAGE_FIELDS):
+            return narrative(persona, self.narrative_words)
+        fields = [field for stage in STAGE_FIELDS[:step + 1] for field in stage]
+        return json.dumps({field: persona[field] for field in fields})
+
+    def __call__(self, model: str, prompt: str, step: int = 0):
+        latency, failed = self._draw()
+        if latency:
+            time.sleep(latency)
+        if failed:
+            raise FakeLLMError(f"Simulated API error for {model} at step {step}")
+        return self.reply(model, step)
+
+    async def acall(self, model: str, prompt: str, step: int = 0):
+        latency, failed = self._draw()
+        if latency:
+            await asyncio.sleep(latency)
+        if failed:
+            raise FakeLLMError(f"Simulated API error for {model} at step {step}")
+        return self.reply(model, step)
+
+    def evaluate(self, outputs: List) -> Tuple[object, List[float]]:
+        """Evaluator for `FusionChain` that scores outputs by length, longest best."""
+        scores = [float(len(str(output))) for output in outputs]
+        return outputs[scores.index(max(scores))], scores
+
+# Fields added by each JSON step of the persona chain
+STAGE_FIELDS = [
+    ["name", "age", "gender", "ethnicity", "location", "occupation", "income_level", "education_level"],
+    ["values_and_beliefs", "challenges", "needs", "frustrations", "goals", "behaviors"],
+    ["other_brands", "purchases", "lifestyle", "interests", "media_consumption"],
+    ["flashmark_insights"],
+]
+
+def synthetic_persona(seed: int, list_size: int = 3, personality: Optional[str] = None) -> dict:
+    """
+    Build a complete, reproducible persona from a seed.
+
+    Args:
+    seed (int): The seed, equal seeds give equal personas.
+    list_size (int): Items per list attribute.
+    personality (str, optional): Mentioned in the insights text.
+
+    Returns:
+    dict: A persona with every field the chain produces except the narrative.
+    """
+    rng = random.Random(seed)
+    persona = {
+        "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {seed}",
+        "age": rng.randint(18, 75),
+        "gender": rng.choice(GENDERS),
+        "ethnicity": rng.choice(ETHNICITIES),
+        "location": rng.choice(LOCATIONS),
+        "occupation": rng.choice(OCCUPATIONS),
+        "income_level": rng.choice(INCOME_LEVELS),
+        "education_level": rng.choice(EDUCATION_LEVELS),
+    }
+    for key, vocabulary in LIST_VOCABULARIES.items():
+        label = key.rstrip("s").replace("_", " ")
+        persona[key] = [f"{label} {rng.randrange(vocabulary)}" for _ in range(list_size)]
+    persona["flashmark_insights"] = (
+        f"A {personality or 'pragmatic'} buyer who compares {persona['other_brands'][0]} "
+        f"on price and reviews and measures success by {persona['goals'][0]}."
+    )
+    return persona
+
+def synthetic_personas(count: int, seed: int = 0, list_size: int = 3) -> Iterator[dict]:
+    """
+    Yield `count` distinct synthetic personas without holding them all in memory.
+
+    Args:
+    count (int): Number of personas.
+    seed (int): Offset of the first persona seed.
+    list_size (int): Items per list attribute.
+
+    Returns:
+    Iterator[dict]: The personas.
+    """
+    for index in range(count):
+        yield synthetic_persona(seed + index, list_size=list_size)
+
+def narrative(persona: dict, words: int) -> str:
+    # A title line with the persona's name, then `words` words of filler text
+    filler = " ".join(persona["interests"] + persona["lifestyle"] + persona["goals"]).split()
+    body = [filler[i % len(filler)] for i in range(words)]
+    return f"# A day with {persona['name']}\n\n" + " ".join(body)
+
+class InMemoryGraphStore:
+    """
+    In-process fake of the `Neo4jOperations` write and read path.
+
+    Personas are converted with the same `persona_row` and
+    `persona_attributes` functions as the real ingest, and stored with the
+    graph's semantics: every saved persona is a new node and attribute
+    nodes are shared by value. The read methods return what the Cypher
+    queries of `Neo4jOperations` return.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.websites: Dict[str, List[int]] = defaultdict(list)  # Website URL -> persona ids
+        self.personas: List[dict] = []  # Node properties by persona id
+        self.persona_ids: Dict[str, List[int]] = defaultdict(list)  # Name -> persona ids
+        self.links: List[Dict[str, List[str]]] = []  # Attribute values per relationship type, by persona id
+        self.postings: Dict[Tuple[str, str], List[int]] = defaultdict(list)  # (rel type, value) -> persona ids
+        self.statements = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def save_persona(self, website_url, persona_data):
+        self.save_personas(website_url, [persona_data])
+
+    def save_personas(self, website_url, personas, batch_size=100):
+        """
+        Save personas generated for a website, one "statement" per batch like the real ingest.
+
+        Args:
+        website_url (str): The website the personas were generated for.
+        personas (Iterable): PersonaRecords, JSON strings or dicts.
+        batch_size (int): Maximum number of personas per statement.
+        """
+        batch = []
+        for persona in personas:
+            batch.append(persona_dict(persona))
+            if len(batch) == batch_size:
+                self._ingest(website_url, batch)
+                batch = []
+        if batch:
+            self._ingest(website_url, batch)
+
+    def _ingest(self, website_url, personas):
+        rows = [persona_row(persona) for persona in personas]
+        with self._lock:
+            self.statements += 1
+            for row in rows:
+                persona_id = len(self.personas)
+                self.personas.append(row["properties"])
+                self.persona_ids[row["properties"].get("name")].append(persona_id)
+                self.websites[website_url].append(persona_id)
+                links = {rel_type: [str(value) for value in values] for rel_type, values in row["attributes"].items()}
+                self.links.append(links)
+                for rel_type, values in links.items():
+                    for value in values:
+                        self.postings[(rel_type, value)].append(persona_id)
+
+    def find_common_interests(self, min_count=2):
+        counts = self._value_counts("INTERESTED_IN")
+        return [(interest, count) for interest, count in counts.most_common() if count >= min_count]
+
+    def find_challenges_by_age_group(self, age_group):
+        return self._value_counts("FACES", self.postings.get(("IN_AGE_GROUP", age_group), [])).most_common()
+
+    def find_brands_by_value(self, value):
+        return self._value_counts("PREFERS", self.postings.get(("VALUES", value), [])).most_common()
+
+    def find_similar_personas(self, persona_name, min_similarity=3):
+        shared_types = Counter()
+        with self._lock:
+            for persona_id in self.persona_ids.get(persona_name, []):
+                matches = defaultdict(set)
+                for rel_type, values in self.links[persona_id].items():
+                    for value in values:
+                        for other in self.postings[(rel_type, value)]:
+                            if other != persona_id:
+                                matches[other].add(rel_type)
+                for other, rel_types in matches.items():
+                    shared_types[other] += len(rel_types)
+            return [
+                (self.personas[other].get("name"), similarity)
+                for other, similarity in shared_types.most_common() if similarity >= min_similarity
+            ]
+
+    def _value_counts(self, rel_type, persona_ids=None) -> Counter:
+        with self._lock:
+            if persona_ids is None:
+                return Counter({
+                    value: len(ids) for (link_type, value), ids in self.postings.items() if link_type == rel_type
+                })
+            counts = Counter()
+            for persona_id in persona_ids:
+                counts.update(self.links[persona_id].get(rel_type, []))
+            return counts
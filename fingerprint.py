@@ -0,0 +1,147 @@
+import hashlib
+import re
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# Bits in a SimHash fingerprint
+SIMHASH_BITS = 64
+# Words per shingle, so near-duplicates are judged on phrases rather than vocabulary
+SHINGLE_SIZE = 3
+# Fewest shingles a text needs for a SimHash. Empty or near-empty pages
+# (e.g. sites rendered by JavaScript) would otherwise all look alike.
+MIN_SHINGLES = 8
+
+_WORD = re.compile(r"\w+")
+
+def normalize_text(text: str) -> str:
+    """
+    Lowercase text and collapse whitespace, so formatting changes don't change fingerprints.
+
+    Args:
+    text (str): The page text.
+
+    Returns:
+    str: The normalized text.
+    """
+    return " ".join(text.lower().split())
+
+def content_hash(text: str) -> str:
+    """
+    Hash the normalized page text for exact change detection.
+
+    Args:
+    text (str): The page text.
+
+    Returns:
+    str: A hex SHA-256 digest.
+    """
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+def simhash(text: str, bits: int = SIMHASH_BITS) -> Optional[int]:
+    """
+    Compute the SimHash of a text's word shingles.
+
+    Texts that share most of their shingles get fingerprints that differ in
+    only a few bits, so near-duplicate pages are found by Hamming distance.
+
+    Args:
+    text (str): The page text.
+    bits (int): The fingerprint size, at most 64.
+
+    Returns:
+    Optional[int]: The fingerprint as an unsigned integer, or None for texts
+    with fewer than MIN_SHINGLES shingles, which can't be compared.
+    """
+    words = _WORD.findall(text.lower())
+    shingles = [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    weights = [0] * bits
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(bits):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+def hamming_distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+class SimHashIndex:
+    """
+    Index of SimHash fingerprints for finding near-duplicates within `max_distance` bits.
+
+    Fingerprints are split into `max_distance + 1` bands. Two fingerprints
+    within the distance must agree exactly on at least one band, so a query
+    only compares against fingerprints that share a band with it.
+    """
+
+    def __init__(self, max_distance: int = 3, bits: int = SIMHASH_BITS):
+        self.max_distance = max_distance
+        self.bits = bits
+        band_count = max_distance + 1
+        # Band boundaries as (shift, mask), covering every bit once
+        edges = [bits * i // band_count for i in range(band_count + 1)]
+        self._bands = [(start, (1 << (end - start)) - 1) for start, end in zip(edges, edges[1:])]
+        self._lock = threading.Lock()
+        self._buckets: Dict[Tuple[int, int], set] = defaultdict(set)
+        self._fingerprints: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._fingerprints
+
+    def add(self, key: str, fingerprint: int):
+        """
+        Index a fingerprint, replacing any earlier one for the same key.
+
+        Args:
+        key (str): The document key, e.g. the URL.
+        fingerprint (int): Its SimHash.
+        """
+        with self._lock:
+            self._remove(key)
+            self._fingerprints[key] = fingerprint
+            for band, value in self._band_values(fingerprint):
+                self._buckets[(band, value)].add(key)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str):
+        fingerprint = self._fingerprints.pop(key, None)
+        if fingerprint is None:
+            return
+        for band, value in self._band_values(fingerprint):
+            bucket = self._buckets[(band, value)]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[(band, value)]
+
+    def _band_values(self, fingerprint: int):
+        return [(band, fingerprint >> shift & mask) for band, (shift, mask) in enumerate(self._bands)]
+
+    def near(self, fingerprint: int, exclude: Optional[str] = None) -> List[Tuple[str, int]]:
+        """
+        Find the indexed documents within `max_distance` bits of a fingerprint.
+
+        Args:
+        fingerprint (int): The SimHash to look up.
+        exclude (str, optional): A key to leave out, usually the document itself.
+
+        Returns:
+        List[Tuple[str, int]]: (key, distance) pairs, nearest first.
+        """
+        with self._lock:
+            candidates = set()
+            for band_value in self._band_values(fingerprint):
+                candidates |= self._buckets.get(band_value, set())
+            candidates.discard(exclude)
+            matches = [(key, hamming_distance(fingerprint, self._fingerprints[key])) for key in candidates]
+        return sorted(
+            ((key, distance) for key, distance in matches if distance <= self.max_distance),
+            key=lambda match: (match[1], match[0]),
+        )
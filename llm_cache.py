@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+class LLMCache:
+    """
+    Persistent, content-addressed cache of LLM responses backed by SQLite.
+
+    Entries are keyed by a hash of everything that determines a completion
+    (model, system prompt, user prompt and temperature). Entries older than
+    `ttl_seconds` are treated as misses, and once the cache holds more than
+    `max_entries` the least recently used entries are evicted.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: Optional[float] = None,
+        max_entries: Optional[int] = 10000,
+        bypass: bool = False,
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @classmethod
+    def from_env(cls) -> Optional["LLMCache"]:
+        """
+        Build a cache from the LLM_CACHE_* environment variables.
+
+        LLM_CACHE_PATH enables the cache. LLM_CACHE_TTL (seconds),
+        LLM_CACHE_MAX_ENTRIES and LLM_CACHE_BYPASS are optional.
+
+        Returns:
+        Optional[LLMCache]: The cache, or None if LLM_CACHE_PATH is not set.
+        """
+        path = os.getenv("LLM_CACHE_PATH")
+        if not path:
+            return None
+        ttl = os.getenv("LLM_CACHE_TTL")
+        max_entries = os.getenv("LLM_CACHE_MAX_ENTRIES")
+        return cls(
+            path,
+            ttl_seconds=float(ttl) if ttl else None,
+            max_entries=int(max_entries) if max_entries else 10000,
+            bypass=os.getenv("LLM_CACHE_BYPASS", "").lower() in ("1", "true", "yes"),
+        )
+
+    @staticmethod
+    def make_key(
+        model: str, system_prompt: str, user_prompt: str, temperature: float, response_format: Optional[str] = None
+    ) -> str:
+        """
+        Hash the inputs that determine a completion into a cache key.
+
+        Args:
+        model (str): The API model name.
+        system_prompt (str): The system message, or an empty string.
+        user_prompt (str): The context-filled user message.
+        temperature (float): The sampling temperature.
+        response_format (str, optional): The serialized response format, if any.
+
+        Returns:
+        str: A hex SHA-256 digest.
+        """
+        parts = [model, system_prompt, user_prompt, temperature]
+        if response_format is not None:
+            parts.append(response_format)
+        payload = json.dumps(parts, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response.
+
+        Args:
+        key (str): The cache key from `make_key`.
+
+        Returns:
+        Optional[str]: The cached response, or None on a miss or when bypassed.
+        """
+        if self.bypass:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                with self._conn:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, response: str):
+        """
+        Store a response, evicting the least recently used entries if needed.
+
+        Args:
+        key (str): The cache key from `make_key`.
+        response (str): The response to store.
+        """
+        if self.bypass:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            existed = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            if not existed:
+                self._size += 1
+            if self.max_entries is not None and self._size > self.max_entries:
+                overflow = self._size - self.max_entries
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed_at ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self._size -= overflow
+
+    def __len__(self) -> int:
+        return self._size
+
+    def stats(self) -> dict:
+        """
+        Return the hit/miss counters and current size.
+
+        Returns:
+        dict: hits, misses, hit_rate and entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": self._size,
+        }
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+            self._size = 0
+
+    def close(self):
+        self._conn.close()
@@ -1,51 +1,340 @@
+import argparse
+import asyncio
 import os
+import sys
 from dotenv import load_dotenv
-import requests
-from bs4 import BeautifulSoup
-from persona_generator import generate_personas
+from batch import BatchPipeline, print_stage_stats, read_urls
+from dedup import ContentDeduplicator
+from export import EXPORT_FORMATS, export_personas, import_personas
+from metrics import metrics
+from persona_generator import (
+    GENERATION_MODES, PROMPT_LAYOUTS, backend_router, finish_run, generate_personas, prompt_count, response_cache,
+    run_checkpoint, scheduler, usage_log,
+)
 from neo4j_operations import Neo4jOperations
+from scraper import DEFAULT_MAX_BYTES, DEFAULT_MAX_TOKENS, scrape_website
 
-def scrape_website(url: str) -> str:
+def env_number(name: str, cast: type):
     """
-    Scrape the content of a given URL.
-    
+    Read an optional numeric setting from the environment.
+
     Args:
-    url (str): The URL of the website to scrape.
-    
+    name (str): The environment variable.
+    cast (type): int or float.
+
+    Returns:
+    The parsed value, or None if the variable is unset or empty.
+    """
+    value = os.getenv(name)
+    return cast(value) if value else None
+
+def connect_neo4j(ensure_schema: bool = False) -> Neo4jOperations:
+    """
+    Connect to Neo4j using the credentials from the environment.
+
+    Args:
+    ensure_schema (bool): Also create the constraints and indexes, as
+        `--ensure-schema` does. Off for normal runs, since a uniqueness
+        constraint can't be created on a database that already holds
+        duplicate nodes.
+
     Returns:
-    str: The text content of the website.
+    Neo4jOperations: The connected Neo4j helper.
     """
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    return soup.get_text()
+    neo4j_uri = os.getenv("NEO4J_URI")
+    neo4j_user = os.getenv("NEO4J_USER")
+    neo4j_password = os.getenv("NEO4J_PASSWORD")
+    neo4j_ops = Neo4jOperations(
+        neo4j_uri,
+        neo4j_user,
+        neo4j_password,
+        database=os.getenv("NEO4J_DATABASE"),
+        max_connection_pool_size=env_number("NEO4J_MAX_POOL_SIZE", int),
+        connection_acquisition_timeout=env_number("NEO4J_ACQUISITION_TIMEOUT", float),
+        max_connection_lifetime=env_number("NEO4J_MAX_CONNECTION_LIFETIME", float),
+        fetch_size=env_number("NEO4J_FETCH_SIZE", int),
+    )
+    if ensure_schema:
+        created = neo4j_ops.ensure_schema()
+        if created:
+            print(f"Created Neo4j schema: {', '.join(created)}")
+    return neo4j_ops
+
+def run_batch(args: argparse.Namespace):
+    """
+    Generate and save personas for every URL in a file or stdin.
+
+    Args:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+    neo4j_ops = connect_neo4j()
+    pipeline = BatchPipeline(
+        neo4j_ops,
+        scrape_concurrency=args.scrape_concurrency,
+        generate_concurrency=args.generate_concurrency,
+        save_concurrency=args.save_concurrency,
+        queue_size=args.queue_size,
+        report_interval=args.report_interval,
+        scrape_options=scrape_options(args),
+        generate_options=generate_options(args),
+        dedup=None if args.force else ContentDeduplicator(neo4j_ops, args.max_simhash_distance),
+    )
+
+    stream = sys.stdin if args.batch == "-" else open(args.batch)
+    try:
+        report = asyncio.run(pipeline.run(read_urls(stream)))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+        write_metrics(args, neo4j_ops)
+        neo4j_ops.close()
+
+    print(f"\nProcessed {report.urls_completed} URLs in {report.elapsed_seconds:.1f}s")
+    print_stage_stats(report.stages)
+    for url, action in report.skipped.items():
+        print(f"- {url} skipped ({action})")
+    for url, error in report.failures.items():
+        print(f"- {url} failed in {error}")
+
+def run_transfer(args: argparse.Namespace):
+    """
+    Export personas to files or load an export, as given on the command line.
+
+    Args:
+    args (argparse.Namespace): The parsed command line arguments.
+    """
+    neo4j_ops = connect_neo4j()
+    try:
+        if args.import_dir:
+            report = import_personas(neo4j_ops, args.import_dir)
+            print(f"Imported {report.personas} personas for {report.websites} websites "
+                  f"and {report.duplicates} duplicate websites from {args.import_dir}")
+        else:
+            report = export_personas(neo4j_ops, args.export, format=args.export_format)
+            print(f"Exported {report.personas} personas and {report.attributes} attribute links "
+                  f"for {report.websites} websites to {report.files} files in {args.export}")
+    finally:
+        write_metrics(args, neo4j_ops)
+        neo4j_ops.close()
+
+def write_metrics(args: argparse.Namespace, neo4j_ops: Neo4jOperations = None):
+    """
+    Write the run's metrics to the files given on the command line, if any.
+
+    Args:
+    args (argparse.Namespace): The parsed command line arguments.
+    neo4j_ops (Neo4jOperations, optional): Adds connection pool statistics to the JSON summary.
+    """
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+    if args.metrics_json:
+        metrics.write_json(
+            args.metrics_json,
+            usage=usage_log.totals(),
+            rate_limiter=scheduler.stats(),
+            backends=backend_router.stats(),
+            response_cache=response_cache.stats() if response_cache is not None else None,
+            neo4j_pool=neo4j_ops.pool_metrics() if neo4j_ops is not None else None,
+        )
+
+def scrape_options(args: argparse.Namespace) -> dict:
+    """
+    Collect the scraper limits from the command line arguments.
+
+    Args:
+    args (argparse.Namespace): The parsed command line arguments.
+
+    Returns:
+    dict: Keyword arguments for `scrape_website`.
+    """
+    return {"max_bytes": args.max_page_bytes, "max_tokens": args.max_page_tokens}
+
+def generate_options(args: argparse.Namespace) -> dict:
+    """
+    Collect the persona generation settings from the command line arguments.
+
+    Args:
+    args (argparse.Namespace): The parsed command line arguments.
+
+    Returns:
+    dict: Keyword arguments for `generate_personas` and `run_checkpoint`.
+    """
+    return {
+        "prune_schedule": args.prune, "layout": args.prompt_layout, "mode": args.generation_mode,
+        "narrative": not args.no_narrative,
+    }
+
+def parse_prune_schedule(value: str) -> dict:
+    """
+    Parse a pruning schedule like "2:3,4:2".
+
+    Each PART:KEEP pair keeps the KEEP best personas after prompt PART
+    (numbered from 1, as in the prompt chain).
+
+    Args:
+    value (str): The schedule from the command line.
+
+    Returns:
+    dict: Maps 0-based prompt indexes to the number of personas kept.
+    """
+    schedule = {}
+    for pair in value.split(","):
+        try:
+            part, keep = (int(number) for number in pair.split(":"))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"expected PART:KEEP, not {pair!r}")
+        if part < 1:
+            raise argparse.ArgumentTypeError(f"prompt parts are numbered from 1, not {part}")
+        if keep < 1:
+            raise argparse.ArgumentTypeError(f"part {part} must keep at least 1 persona, not {keep}")
+        schedule[part - 1] = keep
+    return schedule
+
+def check_prune_schedule(schedule: dict, prompt_count: int):
+    """
+    Reject pruning points outside a chain of `prompt_count` prompts.
+
+    Pruning after the last prompt would only repeat the final evaluation,
+    so parts run from 1 to `prompt_count - 1`.
+
+    Args:
+    schedule (dict): The parsed schedule.
+    prompt_count (int): Prompts in the chain of the chosen generation mode.
+
+    Raises:
+    argparse.ArgumentTypeError: If a part is out of range.
+    """
+    for index in sorted(schedule):
+        if index >= prompt_count - 1:
+            raise argparse.ArgumentTypeError(
+                f"part {index + 1} is out of range, this generation mode can prune after parts "
+                f"1 to {prompt_count - 1}" if prompt_count > 1 else
+                f"part {index + 1} is out of range, this generation mode has a single prompt"
+            )
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+
+    Args:
+    argv (list, optional): The arguments to parse, defaults to sys.argv.
+
+    Returns:
+    argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Generate user personas from website content.")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Process the URLs listed in FILE, one per line ('-' reads stdin)")
+    parser.add_argument("--scrape-concurrency", type=int, default=8,
+                        help="Number of pages scraped at once in batch mode")
+    parser.add_argument("--generate-concurrency", type=int, default=4,
+                        help="Number of websites generating personas at once in batch mode")
+    parser.add_argument("--save-concurrency", type=int, default=2,
+                        help="Number of concurrent Neo4j writers in batch mode, one without the --ensure-schema constraints")
+    parser.add_argument("--queue-size", type=int, default=16,
+                        help="Capacity of each batch stage's input queue")
+    parser.add_argument("--report-interval", type=float, default=30.0,
+                        help="Seconds between batch progress reports")
+    parser.add_argument("--max-page-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="Stop downloading a page after this many bytes")
+    parser.add_argument("--max-page-tokens", type=int, default=DEFAULT_MAX_TOKENS,
+                        help="Approximate token budget for the scraped text sent to the model")
+    parser.add_argument("--prune", type=parse_prune_schedule, metavar="PART:KEEP[,PART:KEEP]",
+                        help="Evaluate personas after the given prompt parts and keep only the best ones")
+    parser.add_argument("--prompt-layout", choices=sorted(PROMPT_LAYOUTS), default="inline",
+                        help="'prefix' puts the website content first in every prompt so the "
+                             "provider's prompt cache can reuse it")
+    parser.add_argument("--generation-mode", choices=GENERATION_MODES, default="chained",
+                        help="'combined' writes each persona's profile in one call and 'batched' writes "
+                             "every persona's profile in one call, instead of a chain of four")
+    parser.add_argument("--no-narrative", action="store_true",
+                        help="Skip the 'A Day in the Life' narrative")
+    parser.add_argument("--force", action="store_true",
+                        help="Regenerate personas even for unchanged or duplicate pages")
+    parser.add_argument("--max-simhash-distance", type=int, default=3,
+                        help="Treat pages whose SimHash differs in at most this many bits as duplicates")
+    parser.add_argument("--metrics-json", metavar="FILE",
+                        help="Write a JSON summary of the run's timings and token usage to FILE")
+    parser.add_argument("--metrics-prom", metavar="FILE",
+                        help="Write the run's metrics to FILE in the Prometheus text format")
+    parser.add_argument("--ensure-schema", action="store_true",
+                        help="Create the Neo4j constraints and indexes, then exit")
+    parser.add_argument("--export", metavar="DIR",
+                        help="Export every persona to DIR, partitioned by website, then exit")
+    parser.add_argument("--import", dest="import_dir", metavar="DIR",
+                        help="Load personas exported with --export from DIR, then exit")
+    parser.add_argument("--export-format", choices=EXPORT_FORMATS, default="parquet",
+                        help="File format written by --export ('parquet' needs pyarrow)")
+    args = parser.parse_args(argv)
+    if args.prune:
+        try:
+            check_prune_schedule(args.prune, prompt_count(args.generation_mode, narrative=not args.no_narrative))
+        except argparse.ArgumentTypeError as e:
+            parser.error(f"argument --prune: {e}")
+    return args
 
 def main():
     # Load environment variables (including API keys)
     load_dotenv()
-    
+    args = parse_args()
+
+    if args.ensure_schema:
+        connect_neo4j(ensure_schema=True).close()
+        print("Neo4j schema check finished.")
+        return
+
+    if args.export or args.import_dir:
+        run_transfer(args)
+        return
+
+    if args.batch:
+        run_batch(args)
+        return
+
     # Get user input for the website URL
     url = input("Enter the website URL to generate personas from: ")
     
-    # Scrape the website content
-    scraped_text = scrape_website(url)
+    # Initialize Neo4j connection
+    neo4j_ops = connect_neo4j()
+    
+    # Scrape the website content, skipping generation for unchanged or duplicate pages
+    page = None
+    if args.force:
+        scraped_text = scrape_website(url, **scrape_options(args))
+    else:
+        dedup = ContentDeduplicator(neo4j_ops, args.max_simhash_distance)
+        page, decision = dedup.scrape(url, **scrape_options(args))
+        if decision.action != "generate":
+            if decision.action == "unchanged":
+                print("\nThe page hasn't changed since its personas were generated; use --force to regenerate.")
+            else:
+                print(f"\nThe page duplicates {decision.duplicate_of} (SimHash distance {decision.distance}); "
+                      "linked its personas instead of generating new ones.")
+            write_metrics(args, neo4j_ops)
+            neo4j_ops.close()
+            return
+        scraped_text = page.text
     
     # Generate personas based on the scraped content
     print("\nGenerating personas...")
-    personas = generate_personas(scraped_text)
-    
-    # Initialize Neo4j connection
-    neo4j_uri = os.getenv("NEO4J_URI")
-    neo4j_user = os.getenv("NEO4J_USER")
-    neo4j_password = os.getenv("NEO4J_PASSWORD")
-    neo4j_ops = Neo4jOperations(neo4j_uri, neo4j_user, neo4j_password)
+    checkpoint = run_checkpoint(scraped_text, **generate_options(args))
+    personas = generate_personas(scraped_text, checkpoint=checkpoint, **generate_options(args))
+    usage = usage_log.totals()
+    print(f"Used {usage['prompt_tokens']} prompt tokens ({usage['cached_tokens']} cached) "
+          f"and {usage['completion_tokens']} completion tokens in {usage['calls']} calls.")
     
-    # Output results and save to Neo4j
+    # Output results
     for i, persona in enumerate(personas, 1):
         print(f"\n\n--- Persona {i} ---")
         print(persona)
-        
-        # Save persona to Neo4j
-        neo4j_ops.save_persona(url, persona)
+
+    # Save all personas to Neo4j in one batch
+    neo4j_ops.save_personas(url, personas)
+    if page is not None and personas:
+        # Pages without personas are not fingerprinted, so the next run tries them again
+        dedup.record(url, page)
+    # Only now are the journaled calls no longer needed for a rerun
+    finish_run(checkpoint)
     
     print("\nPersonas have been saved to the Neo4j database.")
     
@@ -66,11 +355,14 @@ def main():
     for brand, count in brands:
         print(f"- {brand}: preferred by {count} personas")
     
-    print("\nPersonas similar to the first persona:")
-    similar_personas = neo4j_ops.find_similar_personas(personas[0]['name'])
-    for persona, similarity in similar_personas:
-        print(f"- {persona}: {similarity} shared attributes")
+    if personas:
+        print("\nPersonas similar to the first persona:")
+        similar_personas = neo4j_ops.find_similar_personas(personas[0].name)
+        for persona, similarity in similar_personas:
+            print(f"- {persona}: {similarity} shared attributes")
     
+    write_metrics(args, neo4j_ops)
+
     # Close Neo4j connection
     neo4j_ops.close()
 
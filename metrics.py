@@ -0,0 +1,184 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+# Prefix of every exported metric name
+NAMESPACE = "persona"
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and timers for the persona pipeline.
+
+    Metrics are identified by a name and a set of string labels. Timers keep
+    a count, sum and maximum per label set, which is enough for rates and
+    averages without storing every observation. The registry exports the
+    Prometheus text format and a JSON summary.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._timers: Dict[Tuple[str, Tuple], list] = {}  # [count, sum, max]
+        self.started = time.time()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Add to a counter.
+
+        Args:
+        name (str): The counter name, e.g. "llm_prompt_tokens_total".
+        value (float): The amount to add.
+        **labels: Label values, converted to strings.
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """
+        Record one duration.
+
+        Args:
+        name (str): The timer name, e.g. "scrape_seconds".
+        seconds (float): The duration.
+        **labels: Label values, converted to strings.
+        """
+        key = (name, _label_key(labels))
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Time the body of a `with` block, including when it raises.
+
+        Args:
+        name (str): The timer name.
+        **labels: Label values, converted to strings.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self) -> dict:
+        """
+        Return every metric as plain data.
+
+        Returns:
+        dict: "counters" and "timers", lists of dicts with name, labels and values.
+        """
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            timers = [
+                {"name": name, "labels": dict(labels), "count": count, "sum": total, "max": longest}
+                for (name, labels), (count, total, longest) in sorted(self._timers.items())
+            ]
+        return {"counters": counters, "timers": timers}
+
+    def to_prometheus(self) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Counters become counters and timers become summaries with _count and
+        _sum series, plus a _max gauge.
+
+        Returns:
+        str: The exposition text.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+        for counter in snapshot["counters"]:
+            name = _metric_name(counter["name"])
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{_format_labels(counter['labels'])} {counter['value']}")
+        # Every series of a metric family has to follow its TYPE line
+        families: Dict[str, list] = {}
+        for timer in snapshot["timers"]:
+            families.setdefault(_metric_name(timer["name"]), []).append(timer)
+        for name, timers in families.items():
+            lines.append(f"# TYPE {name} summary")
+            for timer in timers:
+                labels = _format_labels(timer["labels"])
+                lines.append(f"{name}_count{labels} {timer['count']}")
+                lines.append(f"{name}_sum{labels} {timer['sum']}")
+            lines.append(f"# TYPE {name}_max gauge")
+            for timer in timers:
+                lines.append(f"{name}_max{_format_labels(timer['labels'])} {timer['max']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, **extra) -> dict:
+        """
+        Build a JSON-serializable summary of the run.
+
+        Args:
+        **extra: Additional top-level entries, e.g. token usage totals.
+
+        Returns:
+        dict: Start and end time, wall time, the metrics and the extra entries.
+        """
+        finished = time.time()
+        return {
+            "started": self.started,
+            "finished": finished,
+            "elapsed_seconds": finished - self.started,
+            **self.snapshot(),
+            **extra,
+        }
+
+    def write_json(self, path: str, **extra):
+        """
+        Write the run summary to a JSON file.
+
+        Args:
+        path (str): The output file.
+        **extra: See `summary`.
+        """
+        with open(path, "w") as f:
+            json.dump(self.summary(**extra), f, indent=2, default=str)
+
+    def write_prometheus(self, path: str):
+        """
+        Write the Prometheus text format to a file, e.g. for node_exporter's textfile collector.
+
+        Args:
+        path (str): The output file.
+        """
+        with open(path, "w") as f:
+            f.write(self.to_prometheus())
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+            self.started = time.time()
+
+# The registry every module records into
+metrics = MetricsRegistry()
+
+def _label_key(labels: Dict[str, object]) -> Tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _metric_name(name: str) -> str:
+    return f"{NAMESPACE}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -1,207 +1,706 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, READ_ACCESS, WRITE_ACCESS
+from neo4j.exceptions import Neo4jError
 import json
+import threading
+import time
+from aggregates import AggregateIndex
+from metrics import metrics
+from persona_schema import persona_dict
+from similarity import PersonaSimilarityIndex
+
+# Persona properties stored directly on the Persona node
+PERSONA_PROPERTIES = [
+    "name", "age", "gender", "ethnicity", "location", "occupation", "income_level", "education_level",
+]
+
+# Single-valued attributes linked as shared nodes: (persona key, node label, node property, relationship type)
+DEMOGRAPHIC_ATTRIBUTES = [
+    ("age_group", "AgeGroup", "group", "IN_AGE_GROUP"),
+    ("gender", "Gender", "type", "HAS_GENDER"),
+    ("ethnicity", "Ethnicity", "type", "HAS_ETHNICITY"),
+    ("location", "Location", "name", "LIVES_IN"),
+    ("occupation", "Occupation", "title", "WORKS_AS"),
+    ("income_level", "IncomeLevel", "level", "HAS_INCOME"),
+    ("education_level", "EducationLevel", "level", "HAS_EDUCATION"),
+]
+
+# List attributes linked as shared nodes: (persona key, node label, node property, relationship type)
+LIST_ATTRIBUTES = [
+    ("values_and_beliefs", "Value", "name", "VALUES"),
+    ("challenges", "Challenge", "name", "FACES"),
+    ("needs", "Need", "name", "NEEDS"),
+    ("frustrations", "Frustration", "name", "FRUSTRATED_BY"),
+    ("goals", "Goal", "name", "AIMS_FOR"),
+    ("behaviors", "Behavior", "name", "EXHIBITS"),
+    ("other_brands", "Brand", "name", "PREFERS"),
+    ("purchases", "Purchase", "item", "BUYS"),
+    ("lifestyle", "Lifestyle", "aspect", "HAS_LIFESTYLE"),
+    ("interests", "Interest", "name", "INTERESTED_IN"),
+    ("media_consumption", "Media", "type", "CONSUMES"),
+]
+
+ATTRIBUTES = DEMOGRAPHIC_ATTRIBUTES + LIST_ATTRIBUTES
+# (node label, node property) per relationship type
+ATTRIBUTE_NODES = {rel_type: (label, prop) for _, label, prop, rel_type in ATTRIBUTES}
+
+def _build_ingest_query():
+    # Every attribute is sent as a (possibly empty) list and linked with a
+    # FOREACH, so one statement writes a whole batch of personas and each
+    # relationship hangs off the Persona node just created instead of a
+    # re-MATCH by name.
+    links = "\n    ".join(
+        f"FOREACH (value IN row.attributes.`{rel_type}` | "
+        f"MERGE (n:{label} {{{prop}: value}}) CREATE (p)-[:{rel_type}]->(n))"
+        for _, label, prop, rel_type in ATTRIBUTES
+    )
+    return f"""
+    MERGE (w:Website {{url: $url}})
+    WITH w
+    UNWIND $personas AS row
+    CREATE (p:Persona)
+    SET p = row.properties
+    CREATE (p)-[:GENERATED_FOR]->(w)
+    {links}
+    FOREACH (content IN row.insights | CREATE (p)-[:HAS_INSIGHTS]->(:Insights {{content: content}}))
+    FOREACH (content IN row.day_in_life | CREATE (p)-[:HAS_DAY_IN_LIFE]->(:DayInLife {{content: content}}))
+    RETURN elementId(p) AS id
+    """
+
+INGEST_QUERY = _build_ingest_query()
+
+def _build_schema_statements():
+    # MERGE keys get uniqueness constraints (which are backed by an index).
+    # Persona names are only indexed since regenerated personas may repeat a name.
+    statements = [
+        ("website_url_unique", "CREATE CONSTRAINT website_url_unique IF NOT EXISTS "
+                               "FOR (n:Website) REQUIRE n.url IS UNIQUE"),
+        ("persona_name_index", "CREATE INDEX persona_name_index IF NOT EXISTS FOR (n:Persona) ON (n.name)"),
+    ]
+    for _, label, prop, _ in ATTRIBUTES:
+        name = f"{label.lower()}_{prop}_unique"
+        statements.append((name, f"CREATE CONSTRAINT {name} IF NOT EXISTS "
+                                  f"FOR (n:{label}) REQUIRE n.{prop} IS UNIQUE"))
+    return statements
+
+SCHEMA_STATEMENTS = _build_schema_statements()
+# (label, property) of every node the ingest MERGEs, each unique once ensure_schema has run
+MERGE_KEYS = [("Website", "url")] + [(label, prop) for _, label, prop, _ in ATTRIBUTES]
 
 class Neo4jOperations:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+    def __init__(
+        self,
+        uri,
+        user,
+        password,
+        database=None,
+        max_connection_pool_size=None,
+        connection_acquisition_timeout=None,
+        max_connection_lifetime=None,
+        fetch_size=None,
+    ):
+        """
+        Connect to Neo4j.
+
+        Pool settings left as None use the driver defaults.
+
+        Args:
+        uri (str): The Neo4j URI, e.g. neo4j://host:7687 for routing to a cluster.
+        user (str): The Neo4j user.
+        password (str): The Neo4j password.
+        database (str, optional): The database to use, defaults to the user's home database.
+        max_connection_pool_size (int, optional): Maximum connections per server.
+        connection_acquisition_timeout (float, optional): Seconds to wait for a free connection.
+        max_connection_lifetime (float, optional): Seconds before a pooled connection is retired.
+        fetch_size (int, optional): Records fetched per batch when streaming results.
+        """
+        pool_config = {
+            "max_connection_pool_size": max_connection_pool_size,
+            "connection_acquisition_timeout": connection_acquisition_timeout,
+            "max_connection_lifetime": max_connection_lifetime,
+        }
+        self.driver = GraphDatabase.driver(
+            uri, auth=(user, password), **{k: v for k, v in pool_config.items() if v is not None}
+        )
+        self.database = database
+        self.fetch_size = fetch_size
+        self._metrics_lock = threading.Lock()
+        self._active_sessions = 0
+        self._acquisitions = 0
+        self._acquisition_wait_total = 0.0
+        self._acquisition_wait_max = 0.0
+        self.similarity_index = None
+        self.aggregates = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def close(self):
         self.driver.close()
 
+    def _session(self, access_mode):
+        config = {"default_access_mode": access_mode}
+        if self.database is not None:
+            config["database"] = self.database
+        if self.fetch_size is not None:
+            config["fetch_size"] = self.fetch_size
+        return self.driver.session(**config)
+
+    def _execute(self, session, access_mode, work, *args, **kwargs):
+        # Run work in a managed transaction, timing how long it takes to get
+        # a connection and begin the transaction before work first runs
+        requested = time.monotonic()
+        waited = []
+
+        def timed_work(tx, *work_args, **work_kwargs):
+            if not waited:
+                waited.append(time.monotonic() - requested)
+                self._record_acquisition(waited[0])
+            return work(tx, *work_args, **work_kwargs)
+
+        if access_mode == READ_ACCESS:
+            return session.execute_read(timed_work, *args, **kwargs)
+        return session.execute_write(timed_work, *args, **kwargs)
+
+    def _record_acquisition(self, seconds):
+        with self._metrics_lock:
+            self._acquisitions += 1
+            self._acquisition_wait_total += seconds
+            self._acquisition_wait_max = max(self._acquisition_wait_max, seconds)
+
+    def _track_session(self, delta):
+        with self._metrics_lock:
+            self._active_sessions += delta
+
+    def _read(self, statement, query, **params):
+        # Reads go through execute_read so a cluster can route them to followers.
+        # `statement` names the query in the timing metrics.
+        def work(tx):
+            with metrics.timer("neo4j_statement_seconds", statement=statement):
+                return list(tx.run(query, **params))
+
+        self._track_session(1)
+        try:
+            with self._session(READ_ACCESS) as session:
+                return self._execute(session, READ_ACCESS, work)
+        finally:
+            self._track_session(-1)
+
+    def _write(self, statement, query, **params):
+        # Single-statement write in its own managed transaction, returning its records
+        def work(tx):
+            with metrics.timer("neo4j_statement_seconds", statement=statement):
+                return list(tx.run(query, **params))
+
+        self._track_session(1)
+        try:
+            with self._session(WRITE_ACCESS) as session:
+                return self._execute(session, WRITE_ACCESS, work)
+        finally:
+            self._track_session(-1)
+
+    def pool_metrics(self):
+        """
+        Return connection pool and acquisition statistics.
+
+        Connection counts come from the driver's private pool internals and
+        are None when this driver version does not expose them. Acquisition wait is measured from requesting a transaction
+        until it has begun, so it includes the BEGIN round trip.
+
+        Returns:
+        dict: in_use and idle connections, active sessions and acquisition wait times.
+        """
+        pool = getattr(self.driver, "_pool", None)
+        connections = getattr(pool, "connections", None)
+        in_use = idle = None
+        if connections is not None:
+            in_use = idle = 0
+            for address_connections in list(connections.values()):
+                for connection in list(address_connections):
+                    if getattr(connection, "in_use", False):
+                        in_use += 1
+                    else:
+                        idle += 1
+        pool_config = getattr(pool, "pool_config", None)
+        with self._metrics_lock:
+            return {
+                "in_use_connections": in_use,
+                "idle_connections": idle,
+                "max_connection_pool_size": getattr(pool_config, "max_connection_pool_size", None),
+                "active_sessions": self._active_sessions,
+                "acquisitions": self._acquisitions,
+                "acquisition_wait_total": self._acquisition_wait_total,
+                "acquisition_wait_max": self._acquisition_wait_max,
+                "acquisition_wait_avg": (
+                    self._acquisition_wait_total / self._acquisitions if self._acquisitions else 0.0
+                ),
+            }
+
+    def ensure_schema(self):
+        """
+        Create the constraints and indexes used by persona writes and queries.
+
+        Safe to run repeatedly, existing constraints and indexes are left alone.
+        A uniqueness constraint that conflicts with duplicate nodes already in
+        the database is skipped with a warning naming it, and the rest are
+        still created.
+
+        Returns:
+        list: Names of the constraints and indexes that were created.
+        """
+        created = []
+        with self._session(WRITE_ACCESS) as session:
+            for name, statement in SCHEMA_STATEMENTS:
+                try:
+                    with metrics.timer("neo4j_statement_seconds", statement=name):
+                        counters = session.run(statement).consume().counters
+                except Neo4jError as e:
+                    print(f"Warning: could not create {name}, remove the conflicting duplicate nodes "
+                          f"and run --ensure-schema again: {e}")
+                    continue
+                if counters.constraints_added or counters.indexes_added:
+                    created.append(name)
+        return created
+
+    def missing_constraints(self):
+        """
+        Return the MERGE keys that have no uniqueness constraint.
+
+        Two writers that MERGE the same new attribute node only see each
+        other's node when its key is unique, otherwise each may create its
+        own copy. Run parallel writers only when this is empty.
+
+        Returns:
+        list: "Label.property" of every key without a constraint, all of
+            them if the constraints can't be listed.
+        """
+        try:
+            records = self._read("show_constraints", "SHOW CONSTRAINTS YIELD type, labelsOrTypes, properties")
+        except Neo4jError:
+            records = []
+        unique = {
+            (record["labelsOrTypes"][0], record["properties"][0])
+            for record in records
+            # UNIQUENESS before Neo4j 5.7, NODE_PROPERTY_UNIQUENESS since, or a NODE_KEY on the one property
+            if ("UNIQUENESS" in record["type"] or record["type"] == "NODE_KEY")
+            and len(record["labelsOrTypes"] or []) == 1 and len(record["properties"] or []) == 1
+        }
+        return [f"{label}.{prop}" for label, prop in MERGE_KEYS if (label, prop) not in unique]
+
     def save_persona(self, website_url, persona_data):
-        with self.driver.session() as session:
-            session.write_transaction(self._create_and_link_persona, website_url, persona_data)
+        self.save_personas(website_url, [persona_data])
+
+    def save_personas(self, website_url, personas, batch_size=100):
+        """
+        Save personas generated for a website, writing each batch in one transaction.
+
+        All batches share one session and are retried by the driver on
+        transient errors.
+
+        Args:
+        website_url (str): The website the personas were generated for.
+        personas (list): PersonaRecords, JSON strings or dicts.
+        batch_size (int): Maximum number of personas written per transaction.
+        """
+        personas = [persona_dict(p) for p in personas]
+        persona_ids = []
+        self._track_session(1)
+        try:
+            with self._session(WRITE_ACCESS) as session:
+                for start in range(0, len(personas), batch_size):
+                    persona_ids.extend(self._execute(
+                        session, WRITE_ACCESS, self._create_and_link_personas,
+                        website_url, personas[start:start + batch_size],
+                    ) or [])
+        finally:
+            self._track_session(-1)
+
+        # Keep the in-process indexes current with what was written
+        if self.similarity_index is not None or self.aggregates is not None:
+            for index, persona in enumerate(personas):
+                attributes = persona_attributes(persona)
+                attributes["GENERATED_FOR"] = [website_url]
+                if self.similarity_index is not None and index < len(persona_ids):
+                    self.similarity_index.add(persona_ids[index], attributes, name=persona.get("name"))
+                if self.aggregates is not None:
+                    self.aggregates.add(attributes)
 
     @staticmethod
     def _create_and_link_persona(tx, website_url, persona_data):
-        persona = json.loads(persona_data)
-
-        # Create Website node
-        tx.run("MERGE (w:Website {url: $url})", url=website_url)
-
-        # Create Persona node
-        create_persona_query = """
-        CREATE (p:Persona {
-            name: $name,
-            age: $age,
-            gender: $gender,
-            ethnicity: $ethnicity,
-            location: $location,
-            occupation: $occupation,
-            income_level: $income_level,
-            education_level: $education_level
-        })
-        WITH p
-        MATCH (w:Website {url: $website_url})
-        CREATE (p)-[:GENERATED_FOR]->(w)
-        RETURN p
-        """
-        result = tx.run(create_persona_query, website_url=website_url, **persona)
-        persona_node = result.single()['p']
-
-        # Create and link demographic nodes
-        tx.run("""
-        MATCH (p:Persona {name: $name})
-        MERGE (a:AgeGroup {group: $age_group})
-        MERGE (g:Gender {type: $gender})
-        MERGE (e:Ethnicity {type: $ethnicity})
-        MERGE (l:Location {name: $location})
-        MERGE (o:Occupation {title: $occupation})
-        MERGE (i:IncomeLevel {level: $income_level})
-        MERGE (ed:EducationLevel {level: $education_level})
-        CREATE (p)-[:IN_AGE_GROUP]->(a)
-        CREATE (p)-[:HAS_GENDER]->(g)
-        CREATE (p)-[:HAS_ETHNICITY]->(e)
-        CREATE (p)-[:LIVES_IN]->(l)
-        CREATE (p)-[:WORKS_AS]->(o)
-        CREATE (p)-[:HAS_INCOME]->(i)
-        CREATE (p)-[:HAS_EDUCATION]->(ed)
-        """, name=persona['name'], 
-        age_group=get_age_group(persona['age']),
-        **persona)
-
-        # Create and link psychographic nodes
-        for value in persona['values_and_beliefs']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (v:Value {name: $value})
-            CREATE (p)-[:VALUES]->(v)
-            """, name=persona['name'], value=value)
-
-        for challenge in persona['challenges']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (c:Challenge {name: $challenge})
-            CREATE (p)-[:FACES]->(c)
-            """, name=persona['name'], challenge=challenge)
-
-        for need in persona['needs']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (n:Need {name: $need})
-            CREATE (p)-[:NEEDS]->(n)
-            """, name=persona['name'], need=need)
-
-        for frustration in persona['frustrations']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (f:Frustration {name: $frustration})
-            CREATE (p)-[:FRUSTRATED_BY]->(f)
-            """, name=persona['name'], frustration=frustration)
-
-        for goal in persona['goals']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (g:Goal {name: $goal})
-            CREATE (p)-[:AIMS_FOR]->(g)
-            """, name=persona['name'], goal=goal)
-
-        for behavior in persona['behaviors']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (b:Behavior {name: $behavior})
-            CREATE (p)-[:EXHIBITS]->(b)
-            """, name=persona['name'], behavior=behavior)
-
-        # Create and link habit nodes
-        for brand in persona['other_brands']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (b:Brand {name: $brand})
-            CREATE (p)-[:PREFERS]->(b)
-            """, name=persona['name'], brand=brand)
-
-        for purchase in persona['purchases']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (pur:Purchase {item: $purchase})
-            CREATE (p)-[:BUYS]->(pur)
-            """, name=persona['name'], purchase=purchase)
-
-        for lifestyle in persona['lifestyle']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (l:Lifestyle {aspect: $lifestyle})
-            CREATE (p)-[:HAS_LIFESTYLE]->(l)
-            """, name=persona['name'], lifestyle=lifestyle)
-
-        for interest in persona['interests']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (i:Interest {name: $interest})
-            CREATE (p)-[:INTERESTED_IN]->(i)
-            """, name=persona['name'], interest=interest)
-
-        for media in persona['media_consumption']:
-            tx.run("""
-            MATCH (p:Persona {name: $name})
-            MERGE (m:Media {type: $media})
-            CREATE (p)-[:CONSUMES]->(m)
-            """, name=persona['name'], media=media)
-
-        # Create Flashmark.insights node and link to Persona
-        tx.run("""
-        MATCH (p:Persona {name: $name})
-        CREATE (i:Insights {content: $flashmark_insights})
-        CREATE (p)-[:HAS_INSIGHTS]->(i)
-        """, name=persona['name'], flashmark_insights=persona['flashmark_insights'])
-
-        # Create DayInLife node and link to Persona
-        tx.run("""
-        MATCH (p:Persona {name: $name})
-        CREATE (d:DayInLife {content: $day_in_life})
-        CREATE (p)-[:HAS_DAY_IN_LIFE]->(d)
-        """, name=persona['name'], day_in_life=persona['A Day in the Life'])
-        # Link Persona to Website
-        tx.run("""
-        MATCH (p:Persona {name: $name})
-        MATCH (w:Website {url: $url})
-        CREATE (p)-[:GENERATED_FOR]->(w)
-        """, name=persona['name'], url=website_url)
+        Neo4jOperations._create_and_link_personas(tx, website_url, [persona_data])
 
+    @staticmethod
+    def _create_and_link_personas(tx, website_url, personas):
+        # Returns the element ids of the new Persona nodes, in input order
+        rows = [persona_row(persona_dict(p)) for p in personas]
+        with metrics.timer("neo4j_statement_seconds", statement="ingest_personas"):
+            persona_ids = [record["id"] for record in tx.run(INGEST_QUERY, url=website_url, personas=rows)]
+        metrics.inc("neo4j_personas_written_total", len(rows))
+        return persona_ids
 
     def find_common_interests(self, min_count=2):
-        with self.driver.session() as session:
-            result = session.run("""
-            MATCH (p:Persona)-[:INTERESTED_IN]->(i:Interest)
-            WITH i, COUNT(p) as persona_count
-            WHERE persona_count >= $min_count
-            RETURN i.name AS interest, persona_count
-            ORDER BY persona_count DESC
-            """, min_count=min_count)
-            return [(record["interest"], record["persona_count"]) for record in result]
+        # Insight queries are index lookups once aggregates are enabled
+        if self.aggregates is not None:
+            return self.aggregates.top_n("INTERESTED_IN", n=None, min_count=min_count)
+
+        records = self._read("find_common_interests", """
+        MATCH (p:Persona)-[:INTERESTED_IN]->(i:Interest)
+        WITH i, COUNT(DISTINCT p) as persona_count
+        WHERE persona_count >= $min_count
+        RETURN i.name AS interest, persona_count
+        ORDER BY persona_count DESC
+        """, min_count=min_count)
+        return [(record["interest"], record["persona_count"]) for record in records]
 
     def find_challenges_by_age_group(self, age_group):
-        with self.driver.session() as session:
-            result = session.run("""
-            MATCH (p:Persona)-[:IN_AGE_GROUP]->(:AgeGroup {group: $age_group})
-            MATCH (p)-[:FACES]->(c:Challenge)
-            RETURN c.name AS challenge, COUNT(p) as count
-            ORDER BY count DESC
-            """, age_group=age_group)
-            return [(record["challenge"], record["count"]) for record in result]
+        if self.aggregates is not None:
+            return self.aggregates.top_n("FACES", by="IN_AGE_GROUP", value=age_group, n=None)
+
+        records = self._read("find_challenges_by_age_group", """
+        MATCH (p:Persona)-[:IN_AGE_GROUP]->(:AgeGroup {group: $age_group})
+        MATCH (p)-[:FACES]->(c:Challenge)
+        RETURN c.name AS challenge, COUNT(DISTINCT p) as count
+        ORDER BY count DESC
+        """, age_group=age_group)
+        return [(record["challenge"], record["count"]) for record in records]
 
     def find_brands_by_value(self, value):
-        with self.driver.session() as session:
-            result = session.run("""
-            MATCH (p:Persona)-[:VALUES]->(:Value {name: $value})
-            MATCH (p)-[:PREFERS]->(b:Brand)
-            RETURN b.name AS brand, COUNT(p) as count
-            ORDER BY count DESC
-            """, value=value)
-            return [(record["brand"], record["count"]) for record in result]
+        if self.aggregates is not None:
+            return self.aggregates.top_n("PREFERS", by="VALUES", value=value, n=None)
+
+        records = self._read("find_brands_by_value", """
+        MATCH (p:Persona)-[:VALUES]->(:Value {name: $value})
+        MATCH (p)-[:PREFERS]->(b:Brand)
+        RETURN b.name AS brand, COUNT(DISTINCT p) as count
+        ORDER BY count DESC
+        """, value=value)
+        return [(record["brand"], record["count"]) for record in records]
+
+    def get_website_fingerprint(self, url):
+        """
+        Read the content fingerprint stored on a Website node by its last scrape.
+
+        Args:
+        url (str): The website URL.
+
+        Returns:
+        dict: content_hash, simhash, etag, last_modified and has_personas,
+        or None if the website hasn't been saved.
+        """
+        records = self._read("get_website_fingerprint", """
+        MATCH (w:Website {url: $url})
+        RETURN w.content_hash AS content_hash, w.simhash AS simhash, w.etag AS etag,
+               w.last_modified AS last_modified,
+               EXISTS { MATCH (w)<-[:GENERATED_FOR]-(:Persona) } AS has_personas
+        """, url=url)
+        if not records:
+            return None
+        record = records[0]
+        return {key: record[key] for key in ("content_hash", "simhash", "etag", "last_modified", "has_personas")}
+
+    def fetch_website_fingerprints(self):
+        """
+        Read the SimHash of every website that has its own personas.
+
+        Websites linked as duplicates are left out, so near-duplicate lookups
+        always resolve to the website the personas were generated for.
+
+        Returns:
+        list: (url, simhash hex) pairs.
+        """
+        records = self._read("fetch_website_fingerprints", """
+        MATCH (w:Website)
+        WHERE w.simhash IS NOT NULL AND NOT (w)-[:DUPLICATE_OF]->()
+        RETURN w.url AS url, w.simhash AS simhash
+        """)
+        return [(record["url"], record["simhash"]) for record in records]
+
+    def record_fingerprint(self, url, fingerprint):
+        """
+        Store a scrape's content fingerprint on the Website node.
+
+        Args:
+        url (str): The website URL.
+        fingerprint (dict): content_hash, simhash, etag and last_modified.
+        """
+        self._write("record_fingerprint", """
+        MERGE (w:Website {url: $url})
+        SET w += $fingerprint, w.fetched_at = datetime()
+        """, url=url, fingerprint=fingerprint)
+
+    def link_duplicate_website(self, url, canonical_url, distance, fingerprint):
+        """
+        Record a website as a near-duplicate of another and reuse its personas.
+
+        The personas generated for `canonical_url` are linked to `url` with
+        GENERATED_FOR, so per-website queries find them for both.
+
+        Args:
+        url (str): The duplicate website's URL.
+        canonical_url (str): The website the personas were generated for.
+        distance (int): SimHash distance between the two pages.
+        fingerprint (dict): The duplicate's content fingerprint.
+
+        Returns:
+        int: The number of personas linked.
+        """
+        records = self._write("link_duplicate_website", """
+        MATCH (c:Website {url: $canonical_url})
+        MERGE (w:Website {url: $url})
+        SET w += $fingerprint, w.fetched_at = datetime()
+        MERGE (w)-[d:DUPLICATE_OF]->(c)
+        SET d.distance = $distance
+        WITH w, c
+        MATCH (p:Persona)-[:GENERATED_FOR]->(c)
+        MERGE (p)-[:GENERATED_FOR]->(w)
+        RETURN count(p) AS personas
+        """, url=url, canonical_url=canonical_url, distance=distance, fingerprint=fingerprint)
+        return records[0]["personas"] if records else 0
+
+    def unlink_duplicate_website(self, url):
+        """
+        Undo `link_duplicate_website` for a website that got its own personas.
+
+        Deletes its DUPLICATE_OF relationship and the GENERATED_FOR links to
+        the canonical website's personas, so the website has only the
+        personas generated for it and is indexed for near-duplicate lookups again.
+
+        Args:
+        url (str): The website URL.
+
+        Returns:
+        int: The number of persona links removed.
+        """
+        records = self._write("unlink_duplicate_website", """
+        MATCH (w:Website {url: $url})-[d:DUPLICATE_OF]->(c:Website)
+        DELETE d
+        WITH w, c
+        MATCH (p:Persona)-[g:GENERATED_FOR]->(w)
+        WHERE (p)-[:GENERATED_FOR]->(c)
+        DELETE g
+        RETURN count(g) AS unlinked
+        """, url=url)
+        return records[0]["unlinked"] if records else 0
+
+    def top_n(self, rel_type, by=None, value=None, n=10, min_count=1):
+        """
+        Return the most common values of an attribute, optionally among personas with a given facet value.
+
+        For example `top_n("PREFERS", by="LIVES_IN", value="Seattle")` returns
+        the brands most preferred by personas living in Seattle. Answered from
+        the aggregates when enabled, otherwise by one Cypher aggregation.
+
+        Args:
+        rel_type (str): The relationship type whose values are counted, e.g. "PREFERS".
+        by (str, optional): The facet relationship type, e.g. "LIVES_IN".
+        value (str, optional): The facet value. Required with `by`.
+        n (int, optional): Maximum number of results, None for all.
+        min_count (int): Leave out values with fewer personas.
+
+        Returns:
+        list: (value, persona count) pairs, most common first.
+        """
+        for name in (rel_type, by):
+            if name is not None and name not in ATTRIBUTE_NODES:
+                raise ValueError(f"Unknown attribute relationship type: {name}")
+        if by is not None and value is None:
+            raise ValueError("A facet value is required with `by`")
+        if self.aggregates is not None:
+            return self.aggregates.top_n(rel_type, by=by, value=value, n=n, min_count=min_count)
+
+        # Labels and relationship types come from the validated table, never from input
+        label, prop = ATTRIBUTE_NODES[rel_type]
+        facet = ""
+        if by is not None:
+            by_label, by_prop = ATTRIBUTE_NODES[by]
+            facet = f"MATCH (p)-[:{by}]->(:{by_label} {{{by_prop}: $value}})"
+        records = self._read(f"top_{rel_type.lower()}", f"""
+        MATCH (p:Persona)
+        {facet}
+        MATCH (p)-[:{rel_type}]->(x:{label})
+        WITH x.{prop} AS value, COUNT(DISTINCT p) AS count
+        WHERE count >= $min_count
+        RETURN value, count
+        ORDER BY count DESC, value
+        """ + ("LIMIT $n" if n is not None else ""), value=value, min_count=min_count, n=n)
+        return [(record["value"], record["count"]) for record in records]
 
     def find_similar_personas(self, persona_name, min_similarity=3):
-        with self.driver.session() as session:
-            result = session.run("""
-            MATCH (p1:Persona {name: $persona_name})-[r]->(node)<-[r2]-(p2:Persona)
-            WHERE TYPE(r) = TYPE(r2)
-            WITH p2, COUNT(DISTINCT TYPE(r)) AS similarity
-            WHERE similarity >= $min_similarity
-            RETURN p2.name AS similar_persona, similarity
-            ORDER BY similarity DESC
-            """, persona_name=persona_name, min_similarity=min_similarity)
-            return [(record["similar_persona"], record["similarity"]) for record in result]
+        # Served in-process when a similarity index is enabled. Every persona
+        # with the name is compared, as the query below does.
+        if self.similarity_index is not None:
+            scores = {}
+            for persona_id in self.similarity_index.ids(persona_name):
+                for other, score in self.similarity_index.similar(
+                    persona_id, k=None, metric="shared_types", min_score=min_similarity
+                ):
+                    scores[other] = max(scores.get(other, 0), score)
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            return [(self.similarity_index.name(other), int(score)) for other, score in ranked]
+
+        records = self._read("find_similar_personas", """
+        MATCH (p1:Persona {name: $persona_name})-[r]->(node)<-[r2]-(p2:Persona)
+        WHERE TYPE(r) = TYPE(r2) AND TYPE(r) <> 'SIMILAR_TO'
+        WITH p2, COUNT(DISTINCT TYPE(r)) AS similarity
+        WHERE similarity >= $min_similarity
+        RETURN p2.name AS similar_persona, similarity
+        ORDER BY similarity DESC
+        """, persona_name=persona_name, min_similarity=min_similarity)
+        return [(record["similar_persona"], record["similarity"]) for record in records]
+
+    def fetch_persona_attributes(self, by_node=False):
+        """
+        Read every persona's linked attribute values.
+
+        Args:
+        by_node (bool): Keep personas that share a name apart instead of merging them.
+
+        Returns:
+        list: (persona name, {relationship type: [values]}) pairs, or
+        (element id, persona name, {relationship type: [values]}) triples with `by_node`.
+        """
+        records = self._read("fetch_persona_attributes", """
+        MATCH (p:Persona)-[r]->(n)
+        WHERE TYPE(r) IN $rel_types
+        RETURN elementId(p) AS id, p.name AS name, TYPE(r) AS rel_type,
+               coalesce(n.url, n.name, n.type, n.group, n.title, n.level, n.item, n.aspect) AS value
+        """, rel_types=[rel_type for _, _, _, rel_type in ATTRIBUTES] + ["GENERATED_FOR"])
+        personas = {}
+        for record in records:
+            key = record["id"] if by_node else record["name"]
+            _, attributes = personas.setdefault(key, (record["name"], {}))
+            attributes.setdefault(record["rel_type"], []).append(record["value"])
+        if by_node:
+            return [(key, name, attributes) for key, (name, attributes) in personas.items()]
+        return list(personas.values())
+
+    def fetch_websites(self):
+        """
+        Read every website with its stored fingerprint and duplicate link.
+
+        Returns:
+        list: Dicts with url, content_hash, simhash, etag, last_modified,
+        duplicate_of and distance, ordered by URL.
+        """
+        records = self._read("fetch_websites", """
+        MATCH (w:Website)
+        OPTIONAL MATCH (w)-[d:DUPLICATE_OF]->(c:Website)
+        RETURN w.url AS url, w.content_hash AS content_hash, w.simhash AS simhash, w.etag AS etag,
+               w.last_modified AS last_modified, c.url AS duplicate_of, d.distance AS distance
+        ORDER BY url
+        """)
+        return [dict(record) for record in records]
+
+    def fetch_persona_page(self, website_url, after=None, limit=1000):
+        """
+        Read one page of the personas generated for a website, with everything linked to them.
+
+        Pages are keyed on the persona's element id, so each page starts
+        where the previous one ended instead of skipping over it.
+
+        Args:
+        website_url (str): The website URL.
+        after (str, optional): The id of the last persona of the previous page.
+        limit (int): Maximum number of personas returned.
+
+        Returns:
+        list: Dicts with id, properties, attributes ([relationship type, value]
+        pairs), insights and day_in_life, ordered by id.
+        """
+        records = self._read("fetch_persona_page", """
+        MATCH (p:Persona)-[:GENERATED_FOR]->(:Website {url: $url})
+        WHERE $after IS NULL OR elementId(p) > $after
+        WITH p ORDER BY elementId(p) LIMIT $limit
+        RETURN elementId(p) AS id, properties(p) AS properties,
+               [(p)-[r]->(n) WHERE TYPE(r) IN $rel_types |
+                [TYPE(r), coalesce(n.name, n.type, n.group, n.title, n.level, n.item, n.aspect)]] AS attributes,
+               [(p)-[:HAS_INSIGHTS]->(i) | i.content] AS insights,
+               [(p)-[:HAS_DAY_IN_LIFE]->(d) | d.content] AS day_in_life
+        """, url=website_url, after=after, limit=limit, rel_types=[rel_type for _, _, _, rel_type in ATTRIBUTES])
+        return [dict(record) for record in records]
+
+    def enable_aggregates(self, pairs=None):
+        """
+        Build the in-process aggregate counts from the database.
+
+        Once enabled, the insight queries and `top_n` are answered from the
+        counts and `save_personas` keeps them current. Writes made by other
+        processes are not seen until the aggregates are enabled again.
+
+        Args:
+        pairs (list, optional): (facet, counted) relationship type pairs to
+            keep cross counts for, see `AggregateIndex`.
+
+        Returns:
+        AggregateIndex: The populated index.
+        """
+        index = AggregateIndex(pairs)
+        for _, _, attributes in self.fetch_persona_attributes(by_node=True):
+            index.add(attributes)
+        self.aggregates = index
+        return index
+
+    def enable_similarity_index(self, weights=None):
+        """
+        Build an in-process similarity index from the database.
+
+        Once enabled, `find_similar_personas` is answered from the index and
+        `save_personas` adds new personas to it. Personas are indexed by
+        element id, so personas sharing a name are kept apart.
+
+        Args:
+        weights (dict, optional): Weight per relationship type for the "weighted" metric.
+
+        Returns:
+        PersonaSimilarityIndex: The populated index.
+        """
+        index = PersonaSimilarityIndex(weights)
+        for persona_id, name, attributes in self.fetch_persona_attributes(by_node=True):
+            index.add(persona_id, attributes, name=name)
+        self.similarity_index = index
+        return index
+
+    def write_similar_to_edges(self, k=10, metric="jaccard", min_score=0.1, batch_size=1000):
+        """
+        Store each persona's top-k similar personas as SIMILAR_TO relationships.
+
+        Requires `enable_similarity_index` to have been called. Existing
+        SIMILAR_TO scores are updated in place.
+
+        Args:
+        k (int): Number of similar personas linked per persona.
+        metric (str): The similarity metric, see `PersonaSimilarityIndex`.
+        min_score (float): Only link pairs scoring at least this.
+        batch_size (int): Relationships written per transaction.
+
+        Returns:
+        int: The number of relationships written.
+        """
+        if self.similarity_index is None:
+            raise RuntimeError("Call enable_similarity_index() before writing SIMILAR_TO edges")
+
+        rows = [
+            {"source": source, "target": target, "score": score}
+            for source, similar in self.similarity_index.all_similar(k, metric, min_score).items()
+            for target, score in similar
+        ]
+
+        def write_edges(tx, batch):
+            with metrics.timer("neo4j_statement_seconds", statement="write_similar_to"):
+                tx.run("""
+                UNWIND $rows AS row
+                MATCH (a:Persona) WHERE elementId(a) = row.source
+                MATCH (b:Persona) WHERE elementId(b) = row.target
+                MERGE (a)-[s:SIMILAR_TO]->(b)
+                SET s.score = row.score, s.metric = $metric
+                """, rows=batch, metric=metric).consume()
+
+        with self._session(WRITE_ACCESS) as session:
+            for start in range(0, len(rows), batch_size):
+                self._execute(session, WRITE_ACCESS, write_edges, rows[start:start + batch_size])
+        return len(rows)
 
 def get_age_group(age):
     if age < 18:
@@ -218,3 +717,61 @@ def get_age_group(age):
         return "55-64"
     else:
         return "65+"
+
+def persona_attributes(persona):
+    """
+    Collect the values of every linked attribute of a persona.
+
+    Args:
+    persona (dict): The parsed persona.
+
+    Returns:
+    dict: A list of distinct values per relationship type, in order.
+    """
+    values = dict(persona)
+    age = values.get("age")
+    if values.get("age_group") is None and age is not None:
+        try:
+            values["age_group"] = get_age_group(int(age))
+        except (TypeError, ValueError):
+            pass
+
+    attributes = {}
+    for key, _, _, rel_type in ATTRIBUTES:
+        value = values.get(key)
+        if value is None:
+            items = []
+        elif isinstance(value, (list, tuple, set)):
+            # A persona links to each value once, whatever the generated list repeats
+            items = list(dict.fromkeys(_to_property(item) for item in value if item is not None))
+        else:
+            items = [_to_property(value)]
+        attributes[rel_type] = items
+    return attributes
+
+def persona_row(persona):
+    """
+    Convert a parsed persona into the parameter row used by the ingest query.
+
+    Args:
+    persona (dict): The parsed persona.
+
+    Returns:
+    dict: Node properties, attribute values and text content of the persona.
+    """
+    insights = persona.get("flashmark_insights")
+    day_in_life = persona.get("A Day in the Life")
+    return {
+        "properties": {
+            key: _to_property(persona[key]) for key in PERSONA_PROPERTIES if persona.get(key) is not None
+        },
+        "attributes": persona_attributes(persona),
+        "insights": [] if insights is None else [_to_property(insights)],
+        "day_in_life": [] if day_in_life is None else [_to_property(day_in_life)],
+    }
+
+def _to_property(value):
+    # Neo4j properties can't hold maps, so nested values are stored as JSON text
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value if isinstance(value, (str, int, float, bool)) else str(value)
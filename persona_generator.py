@@ -1,160 +1,761 @@
+import asyncio
 import os
-import os
-from openai import OpenAI
+import re
+import threading
+import openai
 import json
-from typing import List
-from chain import FusionChain
+from typing import Dict, List, Optional, Type, Union
+from pydantic import BaseModel
+from backends import BackendRouter, OpenAIBackend
+from chain import FusionChain, FusionChainResult
+from checkpoint import CheckpointStore, RunCheckpoint
+from effects import Effect, Steps, run_async, run_sync
+from llm_cache import LLMCache
+from metrics import metrics
+from persona_schema import (
+    STAGE_MODELS, InvalidModelOutputError, PersonaProfile, PersonaRecord, parse_json_reply, persona_batch_model,
+    response_format,
+)
+from rate_limiter import RequestScheduler
+from usage import CHARS_PER_TOKEN, UsageLog
 from tqdm import tqdm
 
-# Initialize the OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Per-request timeout in seconds. Retries are left to the scheduler below.
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Errors that are worth retrying after a backoff
+RETRYABLE_ERRORS = (
+    openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError,
+)
+# Shared rate limiter for every API call, limits set with LLM_RPM and LLM_TPM
+scheduler = RequestScheduler.from_env(retry_on=RETRYABLE_ERRORS)
+# OPENAI_MODEL on the OpenAI API. Its clients read OPENAI_API_KEY when the first call is made.
+openai_backend = OpenAIBackend(
+    "openai", OPENAI_MODEL, client_options={"timeout": LLM_TIMEOUT, "max_retries": 0}, scheduler=scheduler,
+)
+# Model backends and the chain stages they serve, configured with LLM_BACKENDS.
+# Without it every call goes to the OpenAI backend above.
+backend_router = BackendRouter.from_env(openai_backend, retry_on=RETRYABLE_ERRORS)
+# Completion tokens reserved per call until the actual usage is known
+EXPECTED_COMPLETION_TOKENS = 800
+# Times an invalid structured reply is sent back to the model for correction
+MAX_REPAIRS = 2
+
+# Optional on-disk cache of API responses, enabled with LLM_CACHE_PATH
+response_cache: Optional[LLMCache] = LLMCache.from_env()
+
+# Optional journal of completed chain steps for resuming failed runs, enabled with CHECKPOINT_PATH
+checkpoint_store: Optional[CheckpointStore] = CheckpointStore.from_env()
+
+# Token usage of every API call, including prompt-cache hits reported by the API
+usage_log = UsageLog()
+
+# Define 4 initial personas with different "seed" personalities
+SEED_PERSONALITIES = ["analytical", "creative", "practical", "enthusiastic"]
+
+# The 5-part prompt chain run for every seed personality
+PERSONA_PROMPTS = [
+    # Part 1: Generate basic persona info
+    """Based on the following website content, generate a basic persona including name, age, gender, ethnicity, location, occupation, income level, and education level. The persona should have a {{model}} personality type. Respond in strictly JSON format:
+    {{website_content}}
+    """,
+    # Part 2: Generate psychographics
+    """Using the basic persona information and the website content, generate psychographics including values & beliefs, challenges, needs, frustrations, goals, and behaviors. Use the following JSON as context:
+    {{output[-1]}}
+    Respond in strictly JSON format, adding to the existing JSON.
+    """,
+    # Part 3: Generate habits
+    """Based on the persona developed so far and the website content, generate habits including other brands, purchases, lifestyle, interests, and media consumption. Use the following JSON as context:
+    {{output[-1]}}
+    Respond in strictly JSON format, adding to the existing JSON.
+    """,
+    # Part 4: Generate Flashmark.insights
+    """Create a brief Flashmark.insights section for the persona, focusing on their decision-making process and metrics for success. Use the following JSON as context:
+    {{output[-1]}}
+    Respond in strictly JSON format, adding to the existing JSON.
+    """,
+    # Part 5: Generate "A Day in the Life"
+    """Using all the information generated so far, create a detailed "A Day in the Life" narrative for this persona. The narrative should be at least 300 words long and showcase the persona's habits, challenges, and interactions with the product or service related to the website. Use the following JSON as context:
+    {{output[-1]}}
+    Respond with a markdown-formatted narrative.
+    """
+]
+
+# The same chain with the large, stable content first. Every call starts with
+# the identical system message and website text, so the provider's prompt
+# cache can reuse that prefix across personalities and steps, and only the
+# persona so far and the instructions after it vary.
+SHARED_PREFIX_SYSTEM_PROMPT = "You are creating user personas based on website content."
+_SHARED_PREFIX = """Website content:
+{{website_content}}
+
+"""
+PREFIX_PERSONA_PROMPTS = [
+    _SHARED_PREFIX + """Task: Based on the website content above, generate a basic persona including name, age, gender, ethnicity, location, occupation, income level, and education level. The persona should have a {{model}} personality type. Respond in strictly JSON format.""",
+    _SHARED_PREFIX + """Persona so far:
+{{output[-1]}}
+
+Task: Using the persona so far and the website content, generate psychographics including values & beliefs, challenges, needs, frustrations, goals, and behaviors for this {{model}} persona. Respond in strictly JSON format, adding to the existing JSON.""",
+    _SHARED_PREFIX + """Persona so far:
+{{output[-1]}}
+
+Task: Based on the persona so far and the website content, generate habits including other brands, purchases, lifestyle, interests, and media consumption for this {{model}} persona. Respond in strictly JSON format, adding to the existing JSON.""",
+    _SHARED_PREFIX + """Persona so far:
+{{output[-1]}}
+
+Task: Create a brief Flashmark.insights section for this {{model}} persona, focusing on their decision-making process and metrics for success. Respond in strictly JSON format, adding to the existing JSON.""",
+    _SHARED_PREFIX + """Persona so far:
+{{output[-1]}}
+
+Task: Using all the information generated so far, create a detailed "A Day in the Life" narrative for this {{model}} persona. The narrative should be at least 300 words long and showcase the persona's habits, challenges, and interactions with the product or service related to the website. Respond with a markdown-formatted narrative.""",
+]
+
+# Names of the chain's stages, used to route each prompt to a backend
+STAGE_NAMES = ["basics", "psychographics", "habits", "insights", "narrative"]
+
+# Prompt layouts selectable per run: (prompts, whether they use the shared prefix)
+PROMPT_LAYOUTS = {
+    "inline": (PERSONA_PROMPTS, False),
+    "prefix": (PREFIX_PERSONA_PROMPTS, True),
+}
 
-def generate_personas(scraped_text: str) -> List[str]:
+# The whole profile of one persona in a single call, for the "combined" mode
+_PROFILE_TASK = """generate a complete persona with a {{model}} personality type, including:
+- basic info: name, age, gender, ethnicity, location, occupation, income level, and education level
+- psychographics: values & beliefs, challenges, needs, frustrations, goals, and behaviors
+- habits: other brands, purchases, lifestyle, interests, and media consumption
+- a brief Flashmark.insights section focusing on their decision-making process and metrics for success"""
+COMBINED_PROFILE_PROMPTS = {
+    "inline": """Based on the following website content, """ + _PROFILE_TASK + """
+Respond in strictly JSON format:
+    {{website_content}}
+    """,
+    "prefix": _SHARED_PREFIX + """Task: Based on the website content above, """ + _PROFILE_TASK + """
+Respond in strictly JSON format.""",
+}
+
+# The profiles of every personality in a single call, for the "batched" mode.
+# The filled prompt is the same for each personality, see _BatchedProfiles.
+_BATCH_TASK = """generate one complete persona for each of these personality types: {{personalities}}. Each persona includes:
+- basic info: name, age, gender, ethnicity, location, occupation, income level, and education level
+- psychographics: values & beliefs, challenges, needs, frustrations, goals, and behaviors
+- habits: other brands, purchases, lifestyle, interests, and media consumption
+- a brief Flashmark.insights section focusing on their decision-making process and metrics for success
+Make the personas distinct from each other."""
+BATCHED_PROFILE_PROMPTS = {
+    "inline": """Based on the following website content, """ + _BATCH_TASK + """
+Respond in strictly JSON format, an object with one key per personality type holding its persona:
+    {{website_content}}
+    """,
+    "prefix": _SHARED_PREFIX + """Task: Based on the website content above, """ + _BATCH_TASK + """
+Respond in strictly JSON format, an object with one key per personality type holding its persona.""",
+}
+
+# How the structured stages are generated, selectable per run:
+# "chained" builds each persona over the five prompts above, "combined" asks
+# for its whole profile in one call, and "batched" asks for every
+# personality's profile in one call. The narrative is a separate step in
+# every mode and can be left out.
+GENERATION_MODES = ("chained", "combined", "batched")
+# Stage names of the profile and narrative prompts of the single-call modes
+PROFILE_STAGE_NAMES = ["profile", "narrative"]
+
+# Scheduler priority of evaluations, above every chain step since they decide which chains continue
+EVALUATION_PRIORITY = len(PERSONA_PROMPTS)
+
+def generate_personas(
+    scraped_text: str,
+    prune_schedule: Optional[Dict[int, int]] = None,
+    layout: str = "inline",
+    structured: bool = True,
+    run_id: Optional[str] = None,
+    mode: str = "chained",
+    narrative: bool = True,
+    checkpoint: Optional[RunCheckpoint] = None,
+) -> List[PersonaRecord]:
     """
     Generate personas based on scraped website content.
-    
+
     Args:
     scraped_text (str): The scraped content of the website.
-    
+    prune_schedule (Dict[int, int], optional): Maps a prompt index to the number
+        of top-scoring personas that continue past it, so weak personas are
+        dropped before the expensive later prompts. Indexes count the
+        prompts of the chosen mode, e.g. 0 is the profile step outside
+        "chained" mode.
+    layout (str): "inline" embeds the website content inside each prompt,
+        "prefix" puts it first as a prefix shared by every call so the
+        provider's prompt cache can serve it.
+    structured (bool): Constrain the JSON prompts to the persona schema of
+        their stage and pass validated dicts between prompts, instead of
+        free-text JSON.
+    run_id (str, optional): Names the run in the checkpoint store. Defaults
+        to a hash of the content and settings, so running the same page
+        again resumes where a failed run stopped.
+    mode (str): "chained" builds each profile over four calls, "combined"
+        in one call per persona and "batched" in one call for all of them.
+        See GENERATION_MODES.
+    narrative (bool): Whether to write the "A Day in the Life" narrative.
+    checkpoint (RunCheckpoint, optional): The run's journal from
+        `run_checkpoint`. Defaults to the journal of these settings. It is
+        left in place, so pass it to `finish_run` once the personas are saved.
+
     Returns:
-    List[str]: A list of JSON strings, each representing a persona.
+    List[PersonaRecord]: The finished personas.
+    """
+    return run_sync(_generate_steps(
+        scraped_text, True, prune_schedule, layout, structured, run_id, mode, narrative, checkpoint,
+    ))
+
+async def agenerate_personas(
+    scraped_text: str,
+    progress: bool = True,
+    prune_schedule: Optional[Dict[int, int]] = None,
+    layout: str = "inline",
+    structured: bool = True,
+    run_id: Optional[str] = None,
+    mode: str = "chained",
+    narrative: bool = True,
+    checkpoint: Optional[RunCheckpoint] = None,
+) -> List[PersonaRecord]:
     """
+    Asynchronously generate personas based on scraped website content.
+
+    All seed personalities run their chains concurrently on the event loop.
+
+    Args:
+    scraped_text (str): The scraped content of the website.
+    progress (bool): Whether to show a progress bar.
+    prune_schedule (Dict[int, int], optional): See `generate_personas`.
+    layout (str): See `generate_personas`.
+    structured (bool): See `generate_personas`.
+    run_id (str, optional): See `generate_personas`.
+    mode (str): See `generate_personas`.
+    narrative (bool): See `generate_personas`.
+    checkpoint (RunCheckpoint, optional): See `generate_personas`.
+
+    Returns:
+    List[PersonaRecord]: The finished personas.
+    """
+    return await run_async(_generate_steps(
+        scraped_text, progress, prune_schedule, layout, structured, run_id, mode, narrative, checkpoint,
+    ))
+
+def _generate_steps(
+    scraped_text: str, progress: bool, prune_schedule: Optional[Dict[int, int]], layout: str, structured: bool,
+    run_id: Optional[str], mode: str, narrative: bool, checkpoint: Optional[RunCheckpoint],
+) -> Steps:
+    # One generation run, driven by `generate_personas` with the chains on a
+    # thread pool or by `agenerate_personas` with the chains on the event loop
     context = {"website_content": scraped_text}
-    
-    # Define 4 initial personas with different "seed" personalities
-    models = ["analytical", "creative", "practical", "enthusiastic"]
-    
-    print("Generating initial personas...")
+    models = SEED_PERSONALITIES
+    prompts, response_models, stage_names = _generation_plan(mode, layout, narrative)
+    shared_prefix = PROMPT_LAYOUTS[layout][1]
+    batch = None
+    if mode == "batched":
+        batch = _BatchedProfiles(models, structured)
+        context["personalities"] = ", ".join(models)
+
+    if progress:
+        print("Generating initial personas...")
     # Create a progress bar
-    pbar = tqdm(total=len(models) * 5, desc="Generating personas", unit="step")
-    
-    # Custom callable to update progress bar
-    def prompt_with_progress(model: str, prompt_text: str) -> str:
-        result = call_openai(model, prompt_text)
+    pbar = tqdm(
+        total=_planned_steps(len(models), prune_schedule, len(prompts)), desc="Generating personas", unit="step",
+        disable=not progress,
+    )
+
+    # One chain step, updating the progress bar
+    def prompt_with_progress(model: str, prompt_text: str, step: int) -> Steps:
+        if batch is not None and step == 0:
+            result = yield from batch.profile(model, prompt_text)
+        else:
+            response_model = response_models[step] if structured else None
+            # Later steps go first so in-flight chains finish before new ones start
+            result = yield from _call_openai_steps(
+                model, prompt_text, shared_prefix=shared_prefix, response_model=response_model, priority=step,
+                stage=stage_names[step],
+            )
         pbar.update(1)
         return result
-    
+
+    if checkpoint is None:
+        checkpoint = yield Effect(
+            lambda: run_checkpoint(scraped_text, prune_schedule, layout, structured, run_id, mode, narrative)
+        )
+    options = {
+        "context": context,
+        "models": models,
+        "prompts": prompts,
+        "get_model_name": lambda model: model,
+        "prune_schedule": prune_schedule,
+        # Every filled prompt embeds the website text and none are used after the run
+        "keep_prompts": "none",
+        "checkpoint": checkpoint,
+    }
+
     # Run the FusionChain to generate personas
-    result = FusionChain.run(
-        context=context,
-        models=models,
-        callable=prompt_with_progress,
-        prompts=[
-            # Part 1: Generate basic persona info
-            """Based on the following website content, generate a basic persona including name, age, gender, ethnicity, location, occupation, income level, and education level. The persona should have a {{model}} personality type. Respond in strictly JSON format:
-            {{website_content}}
-            """,
-            # Part 2: Generate psychographics
-            """Using the basic persona information and the website content, generate psychographics including values & beliefs, challenges, needs, frustrations, goals, and behaviors. Use the following JSON as context:
-            {{output[-1]}}
-            Respond in strictly JSON format, adding to the existing JSON.
-            """,
-            # Part 3: Generate habits
-            """Based on the persona developed so far and the website content, generate habits including other brands, purchases, lifestyle, interests, and media consumption. Use the following JSON as context:
-            {{output[-1]}}
-            Respond in strictly JSON format, adding to the existing JSON.
-            """,
-            # Part 4: Generate Flashmark.insights
-            """Create a brief Flashmark.insights section for the persona, focusing on their decision-making process and metrics for success. Use the following JSON as context:
-            {{output[-1]}}
-            Respond in strictly JSON format, adding to the existing JSON.
-            """,
-            # Part 5: Generate "A Day in the Life"
-            """Using all the information generated so far, create a detailed "A Day in the Life" narrative for this persona. The narrative should be at least 300 words long and showcase the persona's habits, challenges, and interactions with the product or service related to the website. Use the following JSON as context:
-            {{output[-1]}}
-            Respond with a markdown-formatted narrative.
-            """
-        ],
-        evaluator=evaluate_personas,
-        get_model_name=lambda model: model,
+    result = yield Effect(
+        lambda: FusionChain.run(
+            callable=lambda model, prompt_text, step: run_sync(prompt_with_progress(model, prompt_text, step)),
+            evaluator=evaluate_personas, max_workers=len(models), **options,
+        ),
+        lambda: FusionChain.arun(
+            callable=lambda model, prompt_text, step: run_async(prompt_with_progress(model, prompt_text, step)),
+            evaluator=aevaluate_personas, **options,
+        ),
     )
-    
+
     # Close the progress bar
     pbar.close()
 
-    print("Finalizing personas...")
-    # Combine JSON and narrative for each persona
+    personas = _finalize_personas(result, verbose=progress, narrative=narrative)
+    if checkpoint is not None and result.model_errors:
+        checkpoint.failed = True
+    return personas
+
+def _generation_plan(mode: str, layout: str, narrative: bool) -> tuple[List[str], list, List[str]]:
+    # Prompts of a mode, with the response model and stage name of each
+    if mode not in GENERATION_MODES:
+        raise ValueError(f"mode must be one of {', '.join(GENERATION_MODES)}, not {mode!r}")
+    chain_prompts, _ = PROMPT_LAYOUTS[layout]
+    if mode == "chained":
+        prompts, response_models, stage_names = chain_prompts, STAGE_MODELS, STAGE_NAMES
+    else:
+        # The batched profile step is answered by _BatchedProfiles, which has its own response model
+        profile_prompts = COMBINED_PROFILE_PROMPTS if mode == "combined" else BATCHED_PROFILE_PROMPTS
+        prompts = [profile_prompts[layout], chain_prompts[-1]]
+        response_models, stage_names = [PersonaProfile, None], PROFILE_STAGE_NAMES
+    if not narrative:
+        prompts = prompts[:-1]
+    return prompts, response_models, stage_names
+
+def prompt_count(mode: str = "chained", narrative: bool = True) -> int:
+    """
+    Count the prompts of a generation mode's chain, the range of its prune schedule.
+
+    Args:
+    mode (str): See GENERATION_MODES.
+    narrative (bool): Whether the chain ends with the narrative prompt.
+
+    Returns:
+    int: The number of prompts.
+    """
+    prompts, _, _ = _generation_plan(mode, "inline", narrative)
+    return len(prompts)
+
+class _BatchedProfiles:
+    # Answers the profile step of every personality from a single request.
+    # The first chain to reach the step makes the call and the others wait
+    # for its reply, so pruning, checkpoints and evaluation work as in the
+    # other modes.
+
+    def __init__(self, personalities: List[str], structured: bool):
+        self.response_model = persona_batch_model(tuple(personalities)) if structured else None
+        self._lock = threading.Lock()
+        self._alock = asyncio.Lock()
+        self._reply = None
+        self._error = None
+
+    def profile(self, model: str, prompt: str) -> Steps:
+        release = yield Effect(self._acquire, self._aacquire)
+        try:
+            if self._reply is None and self._error is None:
+                try:
+                    # The prompt names every personality, so it takes the shared system message
+                    self._reply = self._parse((yield from _call_openai_steps(
+                        "batch", prompt, shared_prefix=True, response_model=self.response_model, stage="profile",
+                    )))
+                except Exception as e:
+                    self._error = e
+        finally:
+            release()
+        return self._pick(model)
+
+    # Chains on threads and chains on the event loop wait for the call under different locks
+    def _acquire(self):
+        self._lock.acquire()
+        return self._lock.release
+
+    async def _aacquire(self):
+        await self._alock.acquire()
+        return self._alock.release
+
+    @staticmethod
+    def _parse(reply: Union[str, dict]) -> dict:
+        return reply if isinstance(reply, dict) else parse_json_reply(reply)
+
+    def _pick(self, model: str) -> dict:
+        # Every chain fails with the batch call, and a chain fails alone when the reply lacks its persona
+        if self._error is not None:
+            raise self._error
+        profile = self._reply.get(model) if isinstance(self._reply, dict) else None
+        if not isinstance(profile, dict):
+            raise InvalidModelOutputError(f"Batched reply has no persona for {model}")
+        return profile
+
+def run_checkpoint(
+    scraped_text: str,
+    prune_schedule: Optional[Dict[int, int]] = None,
+    layout: str = "inline",
+    structured: bool = True,
+    run_id: Optional[str] = None,
+    mode: str = "chained",
+    narrative: bool = True,
+) -> Optional[RunCheckpoint]:
+    """
+    Open the checkpoint journal of a generation run.
+
+    Takes the same arguments as `generate_personas`, which replays the
+    journaled steps when given the journal.
+
+    Returns:
+    Optional[RunCheckpoint]: The journal, or None when checkpointing is off.
+    """
+    if checkpoint_store is None:
+        return None
+    if run_id is None:
+        prompts, _, _ = _generation_plan(mode, layout, narrative)
+        run_id = CheckpointStore.run_key(
+            backend_router.signature(), SEED_PERSONALITIES, prompts, structured,
+            sorted((prune_schedule or {}).items()), scraped_text,
+        )
+    return checkpoint_store.run(run_id)
+
+def finish_run(checkpoint: Optional[RunCheckpoint]):
+    """
+    Clear a generation run's journal once its personas are saved.
+
+    Generating for the same page again then calls the models instead of
+    replaying the old outputs. Call it only after the save succeeded, so a
+    failed save is retried without paying for the calls again. The journal
+    is kept when a persona's chain failed, so a rerun resumes that chain.
+
+    Args:
+    checkpoint (RunCheckpoint, optional): The run's journal from `run_checkpoint`.
+    """
+    if checkpoint is not None and not checkpoint.failed:
+        checkpoint.clear()
+
+def _planned_steps(
+    model_count: int, prune_schedule: Optional[Dict[int, int]], prompt_count: int = len(PERSONA_PROMPTS),
+) -> int:
+    # Number of chain steps when models are pruned on schedule
+    steps = 0
+    alive = model_count
+    for index in range(prompt_count):
+        steps += alive
+        alive = min(alive, (prune_schedule or {}).get(index, alive))
+    return steps
+
+def _finalize_personas(result: FusionChainResult, verbose: bool = True, narrative: bool = True) -> List[PersonaRecord]:
+    """
+    Combine the JSON and narrative produced by each model's chain.
+
+    Args:
+    result (FusionChainResult): The result of running the persona chain.
+    verbose (bool): Whether to print progress messages.
+    narrative (bool): Whether the chain ended with a narrative prompt.
+
+    Returns:
+    List[PersonaRecord]: The finished personas.
+    """
+    if verbose:
+        print("Finalizing personas...")
+    for model_name, error in result.model_errors.items():
+        print(f"Skipping {model_name} persona, its chain failed: {error}")
+    if verbose:
+        for model_name, index in result.pruned_models.items():
+            print(f"Pruned {model_name} persona after prompt {index + 1}")
+    profile_index = -2 if narrative else -1
     final_personas = []
-    for i, persona in enumerate(result.all_prompt_responses, 1):
-        print(f"Finalizing persona {i} of 4...")
-        json_data = json.loads(persona[-2])  # Get the JSON data from the second-to-last prompt
-        narrative = persona[-1]  # Get the narrative from the last prompt
-        json_data["A Day in the Life"] = narrative
-        final_personas.append(json.dumps(json_data, indent=2))
-    
+    for i, (model_name, persona) in enumerate(zip(result.used_model_names, result.all_prompt_responses), 1):
+        if verbose:
+            print(f"Finalizing persona {i} of {len(result.all_prompt_responses)}...")
+        # Get the JSON data from the last JSON prompt, already a dict for structured runs
+        profile = persona[profile_index]
+        try:
+            json_data = profile if isinstance(profile, dict) else parse_json_reply(profile)
+        except ValueError as e:
+            print(f"Skipping persona {i}, its JSON could not be parsed: {e}")
+            continue
+        # The narrative from the last prompt is kept apart, so the profile is never copied
+        final_personas.append(PersonaRecord(
+            model=model_name, profile=json_data, narrative=persona[-1] if narrative else None,
+        ))
+
     return final_personas
 
-def call_openai(model: str, prompt: str) -> str:
+def call_openai(
+    model: str,
+    prompt: str,
+    shared_prefix: bool = False,
+    response_model: Optional[Type[BaseModel]] = None,
+    max_repairs: int = MAX_REPAIRS,
+    priority: int = 0,
+    stage: Optional[str] = None,
+) -> Union[str, dict]:
     """
     Send a prompt to the OpenAI API and get the response.
-    
+
     Args:
     model (str): The personality type of the persona.
     prompt (str): The prompt to send to the API.
-    
+    shared_prefix (bool): Use a system message that is the same for every
+        personality, for prompts that state the personality themselves.
+    response_model (Type[BaseModel], optional): Request structured output
+        matching this model's JSON schema and return the validated reply.
+    max_repairs (int): How many times an invalid structured reply is sent
+        back to the model for correction before giving up.
+    priority (int): Scheduler priority, higher runs first when rate limited.
+    stage (str, optional): The chain stage, e.g. "narrative", which picks
+        the backends that may answer. See `backend_router`.
+
     Returns:
-    str: The API's response.
-    """
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": f"You are creating a {model} persona based on website content."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.7,
-    )
-    return response.choices[0].message.content
+    Union[str, dict]: The API's response, as a dict when `response_model` is set.
+    """
+    return run_sync(_call_openai_steps(model, prompt, shared_prefix, response_model, max_repairs, priority, stage))
+
+async def acall_openai(
+    model: str,
+    prompt: str,
+    shared_prefix: bool = False,
+    response_model: Optional[Type[BaseModel]] = None,
+    max_repairs: int = MAX_REPAIRS,
+    priority: int = 0,
+    stage: Optional[str] = None,
+) -> Union[str, dict]:
+    """
+    Asynchronous version of `call_openai` built on the `AsyncOpenAI` client.
+
+    Args:
+    model (str): The personality type of the persona.
+    prompt (str): The prompt to send to the API.
+    shared_prefix (bool): See `call_openai`.
+    response_model (Type[BaseModel], optional): See `call_openai`.
+    max_repairs (int): See `call_openai`.
+    priority (int): See `call_openai`.
+    stage (str, optional): See `call_openai`.
+
+    Returns:
+    Union[str, dict]: The API's response, as a dict when `response_model` is set.
+    """
+    return await run_async(_call_openai_steps(
+        model, prompt, shared_prefix, response_model, max_repairs, priority, stage,
+    ))
+
+def _call_openai_steps(
+    model: str,
+    prompt: str,
+    shared_prefix: bool = False,
+    response_model: Optional[Type[BaseModel]] = None,
+    max_repairs: int = MAX_REPAIRS,
+    priority: int = 0,
+    stage: Optional[str] = None,
+) -> Steps:
+    messages = _persona_messages(model, prompt, shared_prefix)
+    if response_model is None:
+        return (yield from _complete_steps(messages, temperature=0.7, label=model, priority=priority, stage=stage))
+
+    for _ in range(max_repairs + 1):
+        try:
+            return (yield from _complete_steps(
+                messages, temperature=0.7, label=model, response_model=response_model, priority=priority,
+                stage=stage,
+            ))
+        except _InvalidReply as invalid:
+            error = invalid
+            messages = _repair_messages(messages, invalid)
+    raise InvalidModelOutputError(f"{response_model.__name__} reply still invalid after {max_repairs} repairs: {error}")
+
+class _InvalidReply(ValueError):
+    # A structured reply that failed validation, kept so it can be repaired
+    def __init__(self, content: str, error: Exception):
+        super().__init__(str(error))
+        self.content = content
+
+def _complete_steps(
+    messages: List[dict],
+    temperature: float,
+    label: str,
+    response_model: Optional[Type[BaseModel]] = None,
+    priority: int = 0,
+    stage: Optional[str] = None,
+) -> Steps:
+    request = _request_kwargs(messages, temperature, response_model)
+    schedule = {"estimated_tokens": _estimate_tokens(messages), "priority": priority, "count_tokens": _billed_tokens}
+    candidates = backend_router.candidates(stage)
+    for attempt, backend in enumerate(candidates, 1):
+        # Serve the reply from the response cache when possible. Only valid
+        # replies are cached, so cached structured replies always parse.
+        key = _cache_key(backend.model, messages, temperature, response_model)
+        if key is not None:
+            cached = yield Effect(lambda: response_cache.get(key))
+            if cached is not None:
+                metrics.inc("llm_response_cache_hits_total", label=label)
+                return _parse_reply(cached, response_model)
+
+        try:
+            with metrics.timer("llm_request_seconds", label=label):
+                response = yield Effect(
+                    lambda: backend_router.call(backend, request, stage, **schedule),
+                    lambda: backend_router.acall(backend, request, stage, **schedule),
+                )
+        except Exception:
+            if attempt == len(candidates):
+                raise
+            # Fail over to the next backend allowed for this stage
+            metrics.inc("llm_backend_failovers_total", backend=backend.name)
+            continue
+        _record_usage(label, backend.model, response, stage)
+        content = response.choices[0].message.content
+        reply = _parse_reply(content, response_model)
+
+        # Empty replies, e.g. refusals, are not cached so the next run asks again
+        if key is not None and content is not None:
+            yield Effect(lambda: response_cache.set(key, content))
+        return reply
+
+def _request_kwargs(messages: List[dict], temperature: float, response_model: Optional[Type[BaseModel]]) -> dict:
+    # The backend adds its model
+    kwargs = {"messages": messages, "temperature": temperature}
+    if response_model is not None:
+        kwargs["response_format"] = response_format(response_model)
+    return kwargs
+
+def _record_usage(label: str, model: str, response, stage: Optional[str] = None):
+    record = usage_log.record(label, model, getattr(response, "usage", None))
+    # Token counters are split by model and chain stage, so cost can be attributed to either
+    labels = {"label": label, "model": model, "stage": stage or ""}
+    metrics.inc("llm_requests_total", **labels)
+    metrics.inc("llm_prompt_tokens_total", record.prompt_tokens, **labels)
+    metrics.inc("llm_cached_tokens_total", record.cached_tokens, **labels)
+    metrics.inc("llm_completion_tokens_total", record.completion_tokens, **labels)
 
-def evaluate_personas(outputs: List[str]) -> tuple[str, List[float]]:
+def _estimate_tokens(messages: List[dict]) -> int:
+    # Reserve the prompt's approximate size plus a typical completion
+    return sum(len(m["content"]) for m in messages) // CHARS_PER_TOKEN + EXPECTED_COMPLETION_TOKENS
+
+def _billed_tokens(response) -> Optional[int]:
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if isinstance(prompt_tokens, int) and isinstance(completion_tokens, int):
+        return prompt_tokens + completion_tokens
+    return None
+
+def _parse_reply(content: str, response_model: Optional[Type[BaseModel]]) -> Union[str, dict]:
+    if response_model is None:
+        return content
+    try:
+        return response_model.model_validate(parse_json_reply(content or "")).model_dump()
+    except ValueError as e:  # Covers both JSON decoding and pydantic validation errors
+        raise _InvalidReply(content, e)
+
+def _repair_messages(messages: List[dict], invalid: _InvalidReply) -> List[dict]:
+    # Show the model its invalid reply and the validation error
+    return messages + [
+        {"role": "assistant", "content": invalid.content or ""},
+        {"role": "user", "content": f"That reply was not valid: {invalid}. "
+                                    "Respond again with only JSON that matches the required schema."},
+    ]
+
+def _cache_key(
+    model: str, messages: List[dict], temperature: float, response_model: Optional[Type[BaseModel]] = None
+) -> Optional[str]:
+    if response_cache is None or response_cache.bypass:
+        return None
+    system_prompt = "".join(m["content"] for m in messages if m["role"] == "system")
+    turns = [m["content"] for m in messages if m["role"] != "system"]
+    # Repair turns are part of the key, so a repaired reply never replaces the original one
+    user_prompt = turns[0] if len(turns) == 1 else json.dumps(turns, ensure_ascii=False)
+    schema = json.dumps(response_format(response_model), sort_keys=True) if response_model else None
+    return LLMCache.make_key(model, system_prompt, user_prompt, temperature, schema)
+
+def _persona_messages(model: str, prompt: str, shared_prefix: bool = False) -> List[dict]:
+    if shared_prefix:
+        system_prompt = SHARED_PREFIX_SYSTEM_PROMPT
+    else:
+        system_prompt = f"You are creating a {model} persona based on website content."
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+def evaluate_personas(outputs: List[str], fallback: bool = True) -> tuple[str, List[float]]:
     """
     Evaluate the generated personas based on their relevance to the website content.
-    
+
     Args:
     outputs (List[str]): The list of generated personas.
-    
+    fallback (bool): When the evaluation fails, return the first persona
+        and a score of 1.0 for each, so a chain run goes on, and count the
+        failure in `llm_evaluation_failures_total`. Otherwise raise the error.
+
     Returns:
     tuple[str, List[float]]: The top response and a list of scores for each persona.
     """
-    evaluation_prompt = f"""
-    Evaluate the following personas based on how well they represent ideal users for the website. 
-    Consider factors such as relevance to the product/service, potential engagement, and likelihood of conversion.
-    Provide a score from 0 to 1 for each persona, where 1 is the most ideal.
+    return run_sync(_evaluate_steps(outputs, fallback))
 
-    Personas:
-    {outputs}
+async def aevaluate_personas(outputs: List[str], fallback: bool = True) -> tuple[str, List[float]]:
+    """
+    Asynchronous version of `evaluate_personas`.
 
-    Respond with a JSON array of scores, e.g., [0.8, 0.9, 0.7, 0.85]
+    Args:
+    outputs (List[str]): The list of generated personas.
+    fallback (bool): See `evaluate_personas`.
+
+    Returns:
+    tuple[str, List[float]]: The top response and a list of scores for each persona.
     """
-    
+    return await run_async(_evaluate_steps(outputs, fallback))
+
+def _evaluate_steps(outputs: List[str], fallback: bool = True) -> Steps:
+    content = None
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": evaluation_prompt}],
-            temperature=0.3,
+        content = yield from _complete_steps(
+            [{"role": "user", "content": _evaluation_prompt(outputs)}], temperature=0.3, label="evaluation",
+            priority=EVALUATION_PRIORITY, stage="evaluation",
         )
-        
-        content = response.choices[0].message.content.strip()
-        
-        # Try to parse the content as JSON
-        try:
-            scores = json.loads(content)
-        except json.JSONDecodeError:
-            # If JSON parsing fails, try to extract the scores using regex
-            import re
-            scores_match = re.search(r'\[([\d., ]+)\]', content)
-            if scores_match:
-                scores = [float(score.strip()) for score in scores_match.group(1).split(',')]
-            else:
-                raise ValueError("Unable to extract scores from the API response")
-        
-        if not isinstance(scores, list) or len(scores) != len(outputs):
-            raise ValueError(f"Expected {len(outputs)} scores, but got {len(scores) if isinstance(scores, list) else 'non-list'}")
-        
-        top_response = outputs[scores.index(max(scores))]
-        
-        return top_response, scores
+        content = (content or "").strip()
+        return _scores_to_result(outputs, content)
     except Exception as e:
+        if not fallback:
+            raise
+        metrics.inc("llm_evaluation_failures_total")
         print(f"Error in evaluate_personas: {str(e)}")
         print(f"API response content: {content}")
         # Return default values in case of error
         return outputs[0], [1.0] * len(outputs)
+
+def _evaluation_prompt(outputs: List[str]) -> str:
+    return f"""
+    Evaluate the following personas based on how well they represent ideal users for the website.
+    Consider factors such as relevance to the product/service, potential engagement, and likelihood of conversion.
+    Provide a score from 0 to 1 for each persona, where 1 is the most ideal.
+
+    Personas:
+    {[json.dumps(output) if isinstance(output, dict) else output for output in outputs]}
+
+    Respond with a JSON array of scores, e.g., [0.8, 0.9, 0.7, 0.85]
+    """
+
+def _scores_to_result(outputs: List[str], content: str) -> tuple[str, List[float]]:
+    # Try to parse the content as JSON
+    try:
+        scores = json.loads(content)
+    except json.JSONDecodeError:
+        # If JSON parsing fails, try to extract the scores using regex
+        scores_match = re.search(r'\[([\d., ]+)\]', content)
+        if scores_match:
+            scores = [float(score.strip()) for score in scores_match.group(1).split(',')]
+        else:
+            raise ValueError("Unable to extract scores from the API response")
+
+    if not isinstance(scores, list) or len(scores) != len(outputs):
+        raise ValueError(f"Expected {len(outputs)} scores, but got {len(scores) if isinstance(scores, list) else 'non-list'}")
+
+    top_response = outputs[scores.index(max(scores))]
+
+    return top_response, scores
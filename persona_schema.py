@@ -0,0 +1,178 @@
+import copy
+import json
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Type
+from pydantic import BaseModel, create_model
+
+# Each chain stage adds fields to the persona built by the previous one.
+# Field names match the keys Neo4jOperations stores.
+
+class PersonaBasics(BaseModel):
+    name: str
+    age: int
+    gender: str
+    ethnicity: str
+    location: str
+    occupation: str
+    income_level: str
+    education_level: str
+
+class PersonaPsychographics(PersonaBasics):
+    values_and_beliefs: List[str]
+    challenges: List[str]
+    needs: List[str]
+    frustrations: List[str]
+    goals: List[str]
+    behaviors: List[str]
+
+class PersonaHabits(PersonaPsychographics):
+    other_brands: List[str]
+    purchases: List[str]
+    lifestyle: List[str]
+    interests: List[str]
+    media_consumption: List[str]
+
+class PersonaProfile(PersonaHabits):
+    flashmark_insights: str
+
+# Response model per prompt of the persona chain, None for free text
+STAGE_MODELS: List[Optional[Type[BaseModel]]] = [
+    PersonaBasics, PersonaPsychographics, PersonaHabits, PersonaProfile, None,
+]
+
+@lru_cache(maxsize=None)
+def persona_batch_model(personalities: Tuple[str, ...]) -> Type[BaseModel]:
+    """
+    Build the response model of a batched call that writes several personas at once.
+
+    Each personality gets its own required field rather than a list entry,
+    so a strict schema guarantees exactly one profile per personality.
+
+    Args:
+    personalities (Tuple[str, ...]): The personality types, one field each.
+
+    Returns:
+    Type[BaseModel]: A model with a PersonaProfile field per personality.
+    """
+    return create_model("PersonaBatch", **{personality: (PersonaProfile, ...) for personality in personalities})
+
+# Key of the narrative in a persona's dict and JSON forms
+NARRATIVE_KEY = "A Day in the Life"
+
+@dataclass
+class PersonaRecord:
+    """
+    A finished persona, parsed once and passed as is from generation to storage.
+
+    The profile dict is the chain's parsed JSON, referenced rather than
+    copied, and the narrative is kept apart from it. Use `to_dict` or
+    `to_json` for the combined form.
+    """
+    __slots__ = ("model", "profile", "narrative")
+    model: str  # The seed personality the persona was generated with
+    profile: Dict[str, Any]  # The parsed persona JSON
+    narrative: Optional[str]  # The "A Day in the Life" narrative, None when it wasn't generated
+
+    @property
+    def name(self) -> str:
+        return self.profile.get("name", "")
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self.narrative is None:
+            return dict(self.profile)
+        return {**self.profile, NARRATIVE_KEY: self.narrative}
+
+    def to_json(self, indent: Optional[int] = 2) -> str:
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def __str__(self) -> str:
+        return self.to_json()
+
+def persona_dict(persona: Any) -> Dict[str, Any]:
+    """
+    Return a persona in dict form, whether it is a PersonaRecord, a JSON string or a dict.
+
+    Args:
+    persona: The persona.
+
+    Returns:
+    Dict[str, Any]: The persona's fields, including the narrative.
+    """
+    if isinstance(persona, PersonaRecord):
+        return persona.to_dict()
+    if isinstance(persona, str):
+        return json.loads(persona)
+    return persona
+
+class InvalidModelOutputError(ValueError):
+    """Raised when a model reply still isn't valid after the allowed repairs."""
+
+def strict_json_schema(model: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    Build the JSON schema of a pydantic model in the form strict structured outputs require.
+
+    Strict mode needs every object to list all of its properties as required
+    and to forbid additional properties.
+
+    Args:
+    model (Type[BaseModel]): The pydantic model.
+
+    Returns:
+    Dict[str, Any]: The JSON schema.
+    """
+    schema = copy.deepcopy(model.model_json_schema())
+
+    def tighten(node):
+        if isinstance(node, dict):
+            if node.get("type") == "object" and "properties" in node:
+                node["required"] = list(node["properties"])
+                node["additionalProperties"] = False
+            for value in node.values():
+                tighten(value)
+        elif isinstance(node, list):
+            for value in node:
+                tighten(value)
+
+    tighten(schema)
+    return schema
+
+def response_format(model: Type[BaseModel]) -> Dict[str, Any]:
+    """
+    Build the `response_format` request parameter for a pydantic model.
+
+    Args:
+    model (Type[BaseModel]): The pydantic model.
+
+    Returns:
+    Dict[str, Any]: A json_schema response format in strict mode.
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": model.__name__, "schema": strict_json_schema(model), "strict": True},
+    }
+
+def parse_json_reply(text: str) -> Any:
+    """
+    Parse JSON from a free-text model reply.
+
+    Tolerates markdown code fences and prose around a single JSON object.
+
+    Args:
+    text (str): The model reply.
+
+    Returns:
+    Any: The parsed JSON value.
+    """
+    text = text.strip()
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1).strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end <= start:
+            raise
+        return json.loads(text[start:end + 1])
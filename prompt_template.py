@@ -0,0 +1,111 @@
+import json
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+# Matches {{...}} placeholders in a prompt
+_PLACEHOLDER = re.compile(r"\{\{(.*?)\}\}")
+# Matches output references such as output[-1] and output[-2].name
+_OUTPUT_REF = re.compile(r"output\[-(\d+)\](?:\.(.+))?")
+
+class UnresolvedPlaceholderError(KeyError):
+    """Raised by a strict render when a placeholder has no value."""
+
+class PromptTemplate:
+    """
+    A prompt parsed once into literal text and placeholder segments.
+
+    Supported placeholders are `{{key}}` for context values, `{{output[-n]}}`
+    for the n-th previous output and `{{output[-n].key}}` for a key of a
+    previous dict output. Dict and list values are rendered as JSON.
+    Rendering walks the segments once and joins them, so substituted values
+    are never rescanned for placeholders.
+    """
+
+    __slots__ = ("source", "literals", "placeholders")
+
+    def __init__(self, source: str):
+        self.source = source
+        self.literals: List[str] = []
+        # Each placeholder is (raw text, context key or None, output offset or None, output key or None)
+        self.placeholders: List[Tuple[str, Optional[str], Optional[int], Optional[str]]] = []
+
+        position = 0
+        for match in _PLACEHOLDER.finditer(source):
+            self.literals.append(source[position:match.start()])
+            position = match.end()
+            name = match.group(1)
+            output_ref = _OUTPUT_REF.fullmatch(name)
+            if output_ref:
+                self.placeholders.append((match.group(0), None, int(output_ref.group(1)), output_ref.group(2)))
+            else:
+                self.placeholders.append((match.group(0), name, None, None))
+        self.literals.append(source[position:])
+
+    def render(self, context: Dict[str, Any], outputs: List[Any]) -> Tuple[str, List[str]]:
+        """
+        Fill the template from the context and the previous outputs.
+
+        Unresolved placeholders are left in the text unchanged.
+
+        Args:
+        context (Dict[str, Any]): Values for `{{key}}` placeholders.
+        outputs (List[Any]): Previous outputs, oldest first.
+
+        Returns:
+        Tuple[str, List[str]]: The filled prompt and the unresolved placeholders.
+        """
+        parts = [self.literals[0]]
+        unresolved = []
+        for (raw, key, offset, output_key), literal in zip(self.placeholders, self.literals[1:]):
+            value = _MISSING
+            if key is not None:
+                value = context.get(key, _MISSING)
+            elif 0 < offset <= len(outputs):
+                value = outputs[-offset]
+                if output_key is not None:
+                    value = value.get(output_key, _MISSING) if isinstance(value, dict) else _MISSING
+            if value is _MISSING:
+                unresolved.append(raw)
+                parts.append(raw)
+            else:
+                parts.append(_format(value))
+            parts.append(literal)
+        return "".join(parts), unresolved
+
+    def render_strict(self, context: Dict[str, Any], outputs: List[Any]) -> str:
+        """
+        Fill the template, raising if any placeholder has no value.
+
+        Args:
+        context (Dict[str, Any]): Values for `{{key}}` placeholders.
+        outputs (List[Any]): Previous outputs, oldest first.
+
+        Returns:
+        str: The filled prompt.
+        """
+        prompt, unresolved = self.render(context, outputs)
+        if unresolved:
+            raise UnresolvedPlaceholderError(", ".join(unresolved))
+        return prompt
+
+_MISSING = object()
+
+def _format(value: Any) -> str:
+    # Structured outputs are substituted as JSON so the model sees valid JSON
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+@lru_cache(maxsize=512)
+def compile_template(source: str) -> PromptTemplate:
+    """
+    Parse a prompt into a `PromptTemplate`, reusing earlier parses.
+
+    Args:
+    source (str): The prompt text with placeholders.
+
+    Returns:
+    PromptTemplate: The compiled template.
+    """
+    return PromptTemplate(source)
@@ -0,0 +1,327 @@
+import asyncio
+import bisect
+import itertools
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Optional, Tuple, Type
+
+# How often a waiter that is not first in line checks again, in seconds
+POLL_INTERVAL = 0.01
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate.
+
+    The bucket starts full and holds at most one minute's worth of tokens.
+    A reservation takes at most a full bucket. The level may go negative
+    when actual usage turns out higher than what was reserved, which delays
+    later requests until the debt is refilled.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """
+        Return how many seconds until `amount` tokens are available, 0 if they are now.
+
+        Requests larger than the capacity wait for a full bucket rather than forever.
+        """
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+    def take(self, amount: float):
+        # Debit at most a full bucket, matching what `wait_time` waited for
+        self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        # Give back (or charge) the difference between reserved and actual usage
+        self.level = min(self.capacity, self.level + amount)
+
+class RequestScheduler:
+    """
+    Client-side scheduler for rate-limited API calls.
+
+    Every call first reserves one request and its estimated tokens from the
+    requests-per-minute and tokens-per-minute buckets. Waiting calls are
+    served highest priority first, then first come first served, so callers
+    can give the later steps of in-flight work precedence over new work.
+    Calls that raise one of the `retry_on` errors are retried with jittered
+    exponential backoff, waiting at least as long as the error's Retry-After
+    header, which also pauses every other call. Exhausted quotas are raised
+    at once, since waiting does not replenish them.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        retry_on: Tuple[Type[BaseException], ...] = (),
+    ):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self._lock = threading.Lock()
+        self._waiting = []  # Sorted (-priority, ticket) pairs of the calls waiting for capacity
+        self._tickets = itertools.count()
+        self._paused_until = 0.0
+        self.calls = 0
+        self.retries = 0
+        self.wait_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, retry_on: Tuple[Type[BaseException], ...] = ()) -> "RequestScheduler":
+        """
+        Build a scheduler from the LLM_RPM, LLM_TPM and LLM_MAX_RETRIES environment variables.
+
+        Unset limits are not enforced.
+
+        Args:
+        retry_on (Tuple[Type[BaseException], ...]): The errors worth retrying.
+
+        Returns:
+        RequestScheduler: The scheduler.
+        """
+        rpm = os.getenv("LLM_RPM")
+        tpm = os.getenv("LLM_TPM")
+        max_retries = os.getenv("LLM_MAX_RETRIES")
+        return cls(
+            requests_per_minute=float(rpm) if rpm else None,
+            tokens_per_minute=float(tpm) if tpm else None,
+            max_retries=int(max_retries) if max_retries else 5,
+            retry_on=retry_on,
+        )
+
+    def acquire(self, tokens: float = 0, priority: int = 0):
+        """
+        Block until one request and `tokens` tokens may be spent.
+
+        Args:
+        tokens (float): The estimated tokens of the request.
+        priority (int): Higher priorities are served first.
+        """
+        ticket = self._enqueue(priority)
+        started = time.monotonic()
+        try:
+            while (delay := self._try_acquire(ticket, tokens)) > 0:
+                time.sleep(delay)
+        finally:
+            self._finish(ticket, started)
+
+    async def aacquire(self, tokens: float = 0, priority: int = 0):
+        """
+        Asynchronous version of `acquire`.
+
+        Args:
+        tokens (float): The estimated tokens of the request.
+        priority (int): Higher priorities are served first.
+        """
+        ticket = self._enqueue(priority)
+        started = time.monotonic()
+        try:
+            while (delay := self._try_acquire(ticket, tokens)) > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self._finish(ticket, started)
+
+    def call(
+        self,
+        fn: Callable[[], Any],
+        estimated_tokens: float = 0,
+        priority: int = 0,
+        count_tokens: Optional[Callable[[Any], Optional[int]]] = None,
+    ) -> Any:
+        """
+        Run `fn` within the rate limits, retrying transient errors.
+
+        Args:
+        fn (Callable[[], Any]): The API call.
+        estimated_tokens (float): Tokens to reserve before the call.
+        priority (int): Higher priorities are served first.
+        count_tokens (Callable, optional): Returns the tokens a result actually
+            used, so the token bucket can be corrected.
+
+        Returns:
+        Any: The result of `fn`.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(estimated_tokens, priority)
+            try:
+                result = fn()
+            except self.retry_on as e:
+                if attempt == self.max_retries or quota_exhausted(e):
+                    raise
+                time.sleep(self.backoff(attempt, e))
+                continue
+            self._settle(estimated_tokens, result, count_tokens)
+            return result
+
+    async def acall(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        estimated_tokens: float = 0,
+        priority: int = 0,
+        count_tokens: Optional[Callable[[Any], Optional[int]]] = None,
+    ) -> Any:
+        """
+        Asynchronous version of `call` for a coroutine function.
+
+        Args:
+        fn (Callable[[], Awaitable[Any]]): The API call.
+        estimated_tokens (float): Tokens to reserve before the call.
+        priority (int): Higher priorities are served first.
+        count_tokens (Callable, optional): See `call`.
+
+        Returns:
+        Any: The result of `fn`.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(estimated_tokens, priority)
+            try:
+                result = await fn()
+            except self.retry_on as e:
+                if attempt == self.max_retries or quota_exhausted(e):
+                    raise
+                await asyncio.sleep(self.backoff(attempt, e))
+                continue
+            self._settle(estimated_tokens, result, count_tokens)
+            return result
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        """
+        Return the delay before retrying after `error`.
+
+        Uses full-jitter exponential backoff, but never less than the error's
+        Retry-After, which also pauses every other call for that long.
+
+        Args:
+        attempt (int): The number of the failed attempt, starting at 0.
+        error (BaseException): The error raised by the call.
+
+        Returns:
+        float: The delay in seconds.
+        """
+        with self._lock:
+            self.retries += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        return delay
+
+    def stats(self) -> dict:
+        """
+        Return the call, retry and waiting counters.
+
+        Returns:
+        dict: calls, retries, wait_seconds and waiting.
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "wait_seconds": self.wait_seconds,
+                "waiting": len(self._waiting),
+            }
+
+    def _enqueue(self, priority: int) -> Tuple[int, int]:
+        ticket = (-priority, next(self._tickets))
+        with self._lock:
+            bisect.insort(self._waiting, ticket)
+        return ticket
+
+    def _try_acquire(self, ticket: Tuple[int, int], tokens: float) -> float:
+        # Returns 0 once the capacity is taken, else the seconds to wait before trying again
+        with self._lock:
+            if self._waiting[0] != ticket:
+                return POLL_INTERVAL
+            now = time.monotonic()
+            delay = self._paused_until - now
+            if self.request_bucket is not None:
+                delay = max(delay, self.request_bucket.wait_time(1, now))
+            if self.token_bucket is not None:
+                delay = max(delay, self.token_bucket.wait_time(tokens, now))
+            if delay > 0:
+                return delay
+            if self.request_bucket is not None:
+                self.request_bucket.take(1)
+            if self.token_bucket is not None:
+                self.token_bucket.take(tokens)
+            self._waiting.pop(0)
+            self.calls += 1
+            return 0.0
+
+    def _finish(self, ticket: Tuple[int, int], started: float):
+        with self._lock:
+            self.wait_seconds += time.monotonic() - started
+            # Still queued if the waiter was cancelled or interrupted
+            if ticket in self._waiting:
+                self._waiting.remove(ticket)
+
+    def _settle(self, estimated_tokens: float, result: Any, count_tokens: Optional[Callable[[Any], Optional[int]]]):
+        if self.token_bucket is None or count_tokens is None:
+            return
+        actual = count_tokens(result)
+        if actual is not None:
+            with self._lock:
+                reserved = min(estimated_tokens, self.token_bucket.capacity)
+                self.token_bucket.adjust(reserved - actual)
+
+def quota_exhausted(error: BaseException) -> bool:
+    """
+    Tell whether an error reports an exhausted quota rather than a temporary rate limit.
+
+    Args:
+    error (BaseException): The error, usually an API status error.
+
+    Returns:
+    bool: True for the `insufficient_quota` error code.
+    """
+    return getattr(error, "code", None) == "insufficient_quota"
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """
+    Read the Retry-After delay from the HTTP response attached to an error.
+
+    Understands retry-after-ms, and retry-after as seconds or an HTTP date.
+
+    Args:
+    error (BaseException): The error, usually an API status error.
+
+    Returns:
+    Optional[float]: The delay in seconds, or None if the response has none.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
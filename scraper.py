@@ -0,0 +1,230 @@
+import re
+import threading
+import time
+from typing import Optional
+import requests
+from bs4 import BeautifulSoup
+from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
+from fingerprint import content_hash, simhash
+from metrics import metrics
+from usage import CHARS_PER_TOKEN
+
+try:
+    import lxml  # noqa: F401
+    HTML_PARSER = "lxml"
+except ImportError:
+    # Fall back to the slower pure-Python parser
+    HTML_PARSER = "html.parser"
+
+# Stop downloading a page after this many bytes
+DEFAULT_MAX_BYTES = 2_000_000
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5, 20)
+# Seconds a whole download may take, as the read timeout only bounds the wait for each chunk
+DEFAULT_DEADLINE = 60
+# Approximate token budget for the extracted text, which goes into every chain prompt
+DEFAULT_MAX_TOKENS = 8000
+
+# Elements that never contribute useful page text
+BOILERPLATE_TAGS = [
+    "script", "style", "noscript", "template", "svg", "canvas", "iframe",
+    "nav", "header", "footer", "aside", "form",
+]
+
+# A scraped page with the validators and fingerprints used to detect changes
+class ScrapedPage(BaseModel):
+    url: str  # The requested URL
+    text: str = ""  # The extracted text, empty when not modified
+    not_modified: bool = False  # The server answered a conditional request with 304
+    etag: Optional[str] = None  # The ETag response header
+    last_modified: Optional[str] = None  # The Last-Modified response header
+    content_hash: Optional[str] = None  # SHA-256 of the normalized text
+    simhash: Optional[str] = None  # SimHash of the text, as 16 hex digits, None for too little text
+
+    def fingerprint(self) -> dict:
+        """Return the properties stored on the Website node."""
+        return {
+            "content_hash": self.content_hash,
+            "simhash": self.simhash,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+        }
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    """
+    Return the shared HTTP session, creating it on first use.
+
+    The session keeps connections alive and pooled across scrapes.
+
+    Returns:
+    requests.Session: The shared session.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = "persona-generator/1.0"
+            _session = session
+        return _session
+
+def fetch_html(
+    url: str, max_bytes: int = DEFAULT_MAX_BYTES, timeout=DEFAULT_TIMEOUT, deadline: float = DEFAULT_DEADLINE
+) -> bytes:
+    """
+    Download a page, streaming it and stopping at a byte cap.
+
+    Args:
+    url (str): The URL to fetch.
+    max_bytes (int): The maximum number of bytes to read.
+    timeout: Seconds, or a (connect, read) tuple, passed to requests.
+    deadline (float): Seconds after which the download is abandoned, even
+        if the server keeps sending slowly.
+
+    Returns:
+    bytes: The (possibly truncated) response body.
+
+    Raises:
+    requests.Timeout: If the download takes longer than `deadline`.
+    """
+    return _fetch(url, max_bytes, timeout, deadline)[1]
+
+def _fetch(url: str, max_bytes: int, timeout, deadline: float, headers: Optional[dict] = None):
+    # The response, for its status and headers, and its capped body, empty for 304 Not Modified
+    expires = time.monotonic() + deadline
+    with get_session().get(url, stream=True, timeout=timeout, headers=headers) as response:
+        if response.status_code == 304:
+            return response, b""
+        response.raise_for_status()
+        return response, _read_body(response, max_bytes, expires)
+
+def _read_body(response: requests.Response, max_bytes: int, expires: float = float("inf")) -> bytes:
+    # `expires` is a time.monotonic() value, checked after every chunk
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=64 * 1024):
+        if time.monotonic() > expires:
+            raise requests.Timeout(f"Downloading {response.url} took too long")
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            break
+    return b"".join(chunks)[:max_bytes]
+
+def extract_text(html, max_tokens: int = DEFAULT_MAX_TOKENS) -> str:
+    """
+    Extract the readable text of a page, without scripts, styles and navigation.
+
+    Args:
+    html (str | bytes): The page markup.
+    max_tokens (int): The approximate token budget for the result.
+
+    Returns:
+    str: The page text, truncated to the token budget.
+    """
+    soup = BeautifulSoup(html, HTML_PARSER)
+    for tag in soup(BOILERPLATE_TAGS):
+        tag.decompose()
+    lines = (re.sub(r"\s+", " ", line).strip() for line in soup.get_text(separator="\n").splitlines())
+    text = "\n".join(line for line in lines if line)
+    return truncate_to_token_budget(text, max_tokens)
+
+def truncate_to_token_budget(text: str, max_tokens: int) -> str:
+    """
+    Cut text to roughly `max_tokens` tokens, on a word boundary.
+
+    Args:
+    text (str): The text to truncate.
+    max_tokens (int): The approximate token budget.
+
+    Returns:
+    str: The text, unchanged if it already fits.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > 0 else max_chars]
+
+def scrape_website(
+    url: str,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    timeout=DEFAULT_TIMEOUT,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    deadline: float = DEFAULT_DEADLINE,
+) -> str:
+    """
+    Scrape the content of a given URL.
+
+    Args:
+    url (str): The URL of the website to scrape.
+    max_bytes (int): The maximum number of bytes to download.
+    timeout: Seconds, or a (connect, read) tuple, passed to requests.
+    max_tokens (int): The approximate token budget for the returned text.
+    deadline (float): Seconds after which the download is abandoned.
+
+    Returns:
+    str: The text content of the website.
+    """
+    with metrics.timer("scrape_fetch_seconds"):
+        html = fetch_html(url, max_bytes, timeout, deadline)
+    return _extract(html, max_tokens)
+
+def _extract(html: bytes, max_tokens: int) -> str:
+    metrics.inc("scrape_bytes_total", len(html))
+    with metrics.timer("scrape_extract_seconds"):
+        return extract_text(html, max_tokens)
+
+def scrape_page(
+    url: str,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    timeout=DEFAULT_TIMEOUT,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    etag: Optional[str] = None,
+    last_modified: Optional[str] = None,
+    deadline: float = DEFAULT_DEADLINE,
+) -> ScrapedPage:
+    """
+    Scrape a page with a conditional request and fingerprint its text.
+
+    Args:
+    url (str): The URL of the website to scrape.
+    max_bytes (int): The maximum number of bytes to download.
+    timeout: Seconds, or a (connect, read) tuple, passed to requests.
+    max_tokens (int): The approximate token budget for the returned text.
+    etag (str, optional): The ETag of the last scrape, sent as If-None-Match.
+    last_modified (str, optional): The Last-Modified of the last scrape, sent as If-Modified-Since.
+    deadline (float): Seconds after which the download is abandoned.
+
+    Returns:
+    ScrapedPage: The text, response validators and fingerprints, or
+    `not_modified` without text if the server reports no change.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    with metrics.timer("scrape_fetch_seconds"):
+        response, html = _fetch(url, max_bytes, timeout, deadline, headers)
+    if response.status_code == 304:
+        metrics.inc("scrape_not_modified_total")
+        return ScrapedPage(url=url, not_modified=True, etag=etag, last_modified=last_modified)
+    text = _extract(html, max_tokens)
+    fingerprint = simhash(text)
+    return ScrapedPage(
+        url=url,
+        text=text,
+        content_hash=content_hash(text),
+        # Pages with too little text get none, so they are never near-duplicates
+        simhash=None if fingerprint is None else f"{fingerprint:016x}",
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
@@ -0,0 +1,182 @@
+import heapq
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+class PersonaSimilarityIndex:
+    """
+    In-process index answering "which personas are most like this one".
+
+    Each persona is encoded as a sparse set of (relationship type, value)
+    features, and an inverted index maps every feature to the personas that
+    have it. A query walks only the postings of the query persona's
+    features, so personas that share nothing with the query cost nothing.
+    The postings of common values (a gender, a website) still hold most
+    personas, so those features dominate query time.
+
+    Personas are keyed by a stable id, e.g. the node's element id, since
+    names are not unique. Each id also keeps the persona's name.
+
+    Supported metrics:
+    - "jaccard": shared features / features of either persona
+    - "weighted": Jaccard with a per-relationship-type weight on each feature
+    - "shared_types": number of relationship types with at least one shared
+      value, the measure `Neo4jOperations.find_similar_personas` uses
+    """
+
+    METRICS = ("jaccard", "weighted", "shared_types")
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None):
+        self.weights = weights or {}
+        self._lock = threading.Lock()
+        self._feature_ids: Dict[Tuple[str, str], int] = {}
+        self._feature_types: List[int] = []  # Relationship type index per feature id
+        self._type_ids: Dict[str, int] = {}
+        self._type_names: List[str] = []
+        self._postings: Dict[int, set] = defaultdict(set)
+        self._personas: Dict[str, frozenset] = {}
+        self._weighted_sizes: Dict[str, float] = {}
+        self._names: Dict[str, Optional[str]] = {}
+        self._ids_by_name: Dict[Optional[str], set] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._personas)
+
+    def __contains__(self, persona_id: str) -> bool:
+        return persona_id in self._personas
+
+    def add(self, persona_id: str, attributes: Dict[str, Iterable[str]], name: Optional[str] = None):
+        """
+        Add a persona, replacing any persona indexed under the same id.
+
+        Args:
+        persona_id (str): The persona's id.
+        attributes (Dict[str, Iterable[str]]): Attribute values per relationship type.
+        name (str, optional): The persona's name.
+        """
+        with self._lock:
+            self._remove(persona_id)
+            features = frozenset(
+                self._feature_id(rel_type, str(value))
+                for rel_type, values in attributes.items()
+                for value in values
+            )
+            self._personas[persona_id] = features
+            self._weighted_sizes[persona_id] = sum(self._weight(f) for f in features)
+            self._names[persona_id] = name
+            self._ids_by_name[name].add(persona_id)
+            for feature in features:
+                self._postings[feature].add(persona_id)
+
+    def remove(self, persona_id: str):
+        """
+        Remove a persona from the index if present.
+
+        Args:
+        persona_id (str): The persona's id.
+        """
+        with self._lock:
+            self._remove(persona_id)
+
+    def name(self, persona_id: str) -> Optional[str]:
+        # The name a persona was added with
+        return self._names.get(persona_id)
+
+    def ids(self, name: str) -> List[str]:
+        # Ids of every indexed persona with this name
+        with self._lock:
+            return sorted(self._ids_by_name.get(name, ()))
+
+    def similar(
+        self, persona_id: str, k: Optional[int] = 10, metric: str = "jaccard", min_score: float = 0.0
+    ) -> List[Tuple[str, float]]:
+        """
+        Find the personas most similar to a persona.
+
+        Args:
+        persona_id (str): The id of the indexed persona to compare against.
+        k (int, optional): Number of results, or None for all matches.
+        metric (str): One of "jaccard", "weighted" or "shared_types".
+        min_score (float): Only return personas scoring at least this.
+
+        Returns:
+        List[Tuple[str, float]]: (persona id, score) pairs, best first.
+        """
+        if metric not in self.METRICS:
+            raise ValueError(f"Unknown metric {metric!r}, expected one of {', '.join(self.METRICS)}")
+
+        with self._lock:
+            features = self._personas.get(persona_id)
+            if features is None:
+                return []
+
+            # Accumulate the overlap with every persona sharing a feature
+            overlap: Dict[str, float] = defaultdict(float)
+            shared_types: Dict[str, int] = defaultdict(int)
+            for feature in features:
+                weight = self._weight(feature) if metric == "weighted" else 1.0
+                type_bit = 1 << self._feature_types[feature]
+                for other in self._postings[feature]:
+                    if other != persona_id:
+                        overlap[other] += weight
+                        shared_types[other] |= type_bit
+
+            scores = []
+            for other, shared in overlap.items():
+                if metric == "shared_types":
+                    score = bin(shared_types[other]).count("1")
+                elif metric == "weighted":
+                    union = self._weighted_sizes[persona_id] + self._weighted_sizes[other] - shared
+                    score = shared / union if union else 0.0
+                else:
+                    union = len(features) + len(self._personas[other]) - shared
+                    score = shared / union if union else 0.0
+                if score >= min_score:
+                    scores.append((other, score))
+
+        if k is None:
+            return sorted(scores, key=lambda item: (-item[1], item[0]))
+        return heapq.nsmallest(k, scores, key=lambda item: (-item[1], item[0]))
+
+    def all_similar(
+        self, k: int = 10, metric: str = "jaccard", min_score: float = 0.0
+    ) -> Dict[str, List[Tuple[str, float]]]:
+        """
+        Compute the top-k similar personas for every indexed persona.
+
+        Args:
+        k (int): Number of results per persona.
+        metric (str): One of "jaccard", "weighted" or "shared_types".
+        min_score (float): Only keep pairs scoring at least this.
+
+        Returns:
+        Dict[str, List[Tuple[str, float]]]: Similar personas keyed by persona id.
+        """
+        return {persona_id: self.similar(persona_id, k, metric, min_score) for persona_id in list(self._personas)}
+
+    def _remove(self, persona_id: str):
+        features = self._personas.pop(persona_id, None)
+        if features is None:
+            return
+        self._weighted_sizes.pop(persona_id, None)
+        name = self._names.pop(persona_id, None)
+        self._ids_by_name[name].discard(persona_id)
+        if not self._ids_by_name[name]:
+            del self._ids_by_name[name]
+        for feature in features:
+            self._postings[feature].discard(persona_id)
+
+    def _feature_id(self, rel_type: str, value: str) -> int:
+        key = (rel_type, value)
+        feature = self._feature_ids.get(key)
+        if feature is None:
+            if rel_type not in self._type_ids:
+                self._type_ids[rel_type] = len(self._type_names)
+                self._type_names.append(rel_type)
+            feature = len(self._feature_types)
+            self._feature_ids[key] = feature
+            self._feature_types.append(self._type_ids[rel_type])
+        return feature
+
+    def _weight(self, feature: int) -> float:
+        return self.weights.get(self._type_names[self._feature_types[feature]], 1.0)
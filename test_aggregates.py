@@ -0,0 +1,40 @@
+import unittest
+from aggregates import AggregateIndex
+
+JANE = {"IN_AGE_GROUP": ["25-34"], "VALUES": ["Innovation"], "FACES": ["Time management", "Budget"],
+        "PREFERS": ["Apple"], "INTERESTED_IN": ["Hiking", "Design"], "LIVES_IN": ["Seattle"]}
+JOHN = {"IN_AGE_GROUP": ["25-34"], "VALUES": ["Innovation", "Family"], "FACES": ["Budget"],
+        "PREFERS": ["Apple", "Patagonia"], "INTERESTED_IN": ["Hiking"], "LIVES_IN": ["Denver"]}
+ANA = {"IN_AGE_GROUP": ["35-44"], "VALUES": ["Family"], "FACES": ["Budget"],
+       "PREFERS": ["Patagonia"], "INTERESTED_IN": ["Design", "Design"], "LIVES_IN": ["Seattle"]}
+
+class TestAggregateIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = AggregateIndex()
+        for attributes in (JANE, JOHN, ANA):
+            self.index.add(attributes)
+
+    def test_facet_counts(self):
+        self.assertEqual(self.index.top_n("INTERESTED_IN", n=None), [("Design", 2), ("Hiking", 2)])
+        self.assertEqual(self.index.top_n("INTERESTED_IN", min_count=3), [])
+
+    def test_materialized_cross_counts(self):
+        self.assertEqual(
+            self.index.top_n("FACES", by="IN_AGE_GROUP", value="25-34"), [("Budget", 2), ("Time management", 1)]
+        )
+        self.assertEqual(self.index.top_n("PREFERS", by="VALUES", value="Family"), [("Patagonia", 2), ("Apple", 1)])
+
+    def test_other_facets_use_postings(self):
+        self.assertEqual(self.index.top_n("PREFERS", by="LIVES_IN", value="Seattle", n=1), [("Apple", 1)])
+        self.assertEqual(self.index.top_n("PREFERS", by="LIVES_IN", value="Paris"), [])
+
+    def test_counts_stay_current_on_add(self):
+        self.index.add(dict(JANE))
+
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.counts("PREFERS")["Apple"], 3)
+        self.assertEqual(self.index.top_n("FACES", by="IN_AGE_GROUP", value="25-34")[0], ("Budget", 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import unittest
+from unittest.mock import patch
+from backends import BackendRouter, OpenAICompatibleBackend, StubBackend
+from persona_generator import call_openai, usage_log
+from persona_schema import PersonaHabits, response_format
+
+class FailingBackend(StubBackend):
+    def complete(self, request):
+        raise ConnectionError("down")
+
+class TestStubBackend(unittest.TestCase):
+
+    def test_structured_replies_fill_the_schema_deterministically(self):
+        backend = StubBackend()
+        request = {"messages": [{"role": "user", "content": "Persona please"}],
+                   "response_format": response_format(PersonaHabits)}
+
+        first = backend.complete(request).choices[0].message.content
+        second = asyncio.run(backend.acomplete(request)).choices[0].message.content
+
+        self.assertEqual(first, second)
+        persona = PersonaHabits.model_validate(json.loads(first))
+        self.assertTrue(persona.interests)
+
+    def test_text_replies_and_usage(self):
+        backend = StubBackend(reply=lambda messages: "[0.5, 0.9]")
+
+        response = backend.complete({"messages": [{"role": "user", "content": "x" * 400}]})
+
+        self.assertEqual(response.choices[0].message.content, "[0.5, 0.9]")
+        self.assertEqual(response.usage.prompt_tokens, 100)
+
+class TestBackendRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.fast = StubBackend("fast", prompt_price=10.0)
+        self.strong = StubBackend("strong")
+        self.router = BackendRouter([self.fast, self.strong], routes={"narrative": ["strong"]},
+                                    failure_threshold=2, cooldown=60.0)
+
+    def names(self, stage=None):
+        return [backend.name for backend in self.router.candidates(stage)]
+
+    def test_routes_restrict_backends_per_stage(self):
+        self.assertEqual(self.names("narrative"), ["strong"])
+        self.assertEqual(self.names("basics"), ["fast", "strong"])
+
+    def test_fastest_measured_backend_goes_first(self):
+        self.router.record_success("fast", 2.0)
+        self.assertEqual(self.names(), ["strong", "fast"])  # Unmeasured backends are tried first
+
+        self.router.record_success("strong", 0.5)
+        self.assertEqual(self.names(), ["strong", "fast"])
+        self.router.record_success("fast", 0.1)
+        self.router.record_success("fast", 0.1)
+        self.assertLess(self.router.stats()["fast"]["stages"][""]["latency_ewma"], 2.0)
+
+    def test_backends_are_ranked_by_their_latency_on_the_stage(self):
+        # Narratives are long and slow on every backend, so they must not make a backend look slow on short stages
+        router = BackendRouter([self.fast, self.strong])
+        router.record_success("fast", 0.2, stage="basics")
+        router.record_success("fast", 4.0, stage="narrative")
+        router.record_success("strong", 0.5, stage="basics")
+        router.record_success("strong", 6.0, stage="narrative")
+
+        self.assertEqual([backend.name for backend in router.candidates("basics")], ["fast", "strong"])
+        self.assertEqual([backend.name for backend in router.candidates("narrative")], ["fast", "strong"])
+        router.record_success("fast", 20.0, stage="narrative")
+        self.assertEqual([backend.name for backend in router.candidates("narrative")], ["strong", "fast"])
+        self.assertEqual([backend.name for backend in router.candidates("basics")], ["fast", "strong"])
+        self.assertEqual(router.stats()["fast"]["requests"], 3)
+
+    def test_cost_weight_trades_latency_for_price(self):
+        self.router.cost_weight = 1000.0
+        self.router.record_success("fast", 0.2, cost=0.01)
+        self.router.record_success("strong", 0.5, cost=0.0)
+
+        self.assertEqual(self.names(), ["strong", "fast"])
+
+    def test_failing_backend_cools_down(self):
+        failing = FailingBackend("failing")
+        router = BackendRouter([failing, self.strong], failure_threshold=2, cooldown=60.0)
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                router.call(failing, {"messages": []})
+
+        self.assertEqual([backend.name for backend in router.candidates()], ["strong", "failing"])
+        self.assertEqual(router.stats()["failing"]["failures"], 2)
+
+    def test_call_records_latency_and_cost(self):
+        self.router.call(self.fast, {"messages": [{"role": "user", "content": "x" * 4000}]}, stage="basics")
+
+        stats = self.router.stats()["fast"]
+        self.assertEqual(stats["requests"], 1)
+        self.assertAlmostEqual(stats["stages"]["basics"]["cost_ewma"], 1000 * 10.0 / 1_000_000)
+
+    def test_from_config(self):
+        config = {
+            "backends": [
+                {"name": "local", "type": "openai_compatible", "model": "llama3",
+                 "base_url": "http://localhost:8000/v1", "structured_outputs": False, "rpm": 60},
+                {"name": "stub", "type": "stub"},
+            ],
+            "routes": {"narrative": ["local", "stub"]},
+            "default": ["stub"],
+        }
+
+        router = BackendRouter.from_config(config, default_backend=self.strong)
+
+        local = router.backends["local"]
+        self.assertIsInstance(local, OpenAICompatibleBackend)
+        self.assertEqual(router.signature()["backends"]["local"][2], "http://localhost:8000/v1")
+        self.assertIsNone(local.client)  # Built on first use
+        self.assertEqual(str(local.get_client().base_url), "http://localhost:8000/v1/")
+        self.assertNotIn("response_format", local.prepare({"messages": [], "response_format": {}}))
+        self.assertEqual(set(router.backends), {"strong", "local", "stub"})
+        self.assertEqual([backend.name for backend in router.candidates("basics")], ["stub"])
+        with self.assertRaises(ValueError):
+            BackendRouter.from_config({"routes": {"narrative": ["missing"]}})
+
+class TestPersonaGeneratorRouting(unittest.TestCase):
+
+    def test_calls_fail_over_and_use_the_stage_route(self):
+        stub = StubBackend("stub", model="stub-model")
+        router = BackendRouter([FailingBackend("down"), stub], routes={"narrative": ["stub"]})
+
+        with patch('persona_generator.backend_router', router), patch('persona_generator.response_cache', None):
+            basics = call_openai("analytical", "Persona please", response_model=PersonaHabits, stage="basics")
+            call_openai("analytical", "Narrative please", stage="narrative")
+
+        self.assertIn("interests", basics)
+        self.assertEqual(router.stats()["down"]["failures"], 1)
+        self.assertEqual(router.stats()["stub"]["requests"], 2)
+        self.assertEqual(set(router.stats()["stub"]["stages"]), {"basics", "narrative"})
+        self.assertEqual(usage_log.records[-1].model, "stub-model")
+
+if __name__ == '__main__':
+    unittest.main()
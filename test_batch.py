@@ -0,0 +1,148 @@
+import asyncio
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+from backends import BackendRouter, StubBackend
+from batch import BatchPipeline, read_urls
+from checkpoint import CheckpointStore
+from persona_generator import usage_log
+
+class TestBatchPipeline(unittest.TestCase):
+
+    @patch('batch.agenerate_personas')
+    @patch('batch.scrape_website')
+    def test_run_processes_every_url(self, mock_scrape, mock_generate):
+        mock_scrape.side_effect = lambda url: f"content of {url}"
+
+        async def fake_generate(scraped_text, progress=True, checkpoint=None):
+            await asyncio.sleep(0.01)
+            return [f'{{"name": "{scraped_text}"}}']
+
+        mock_generate.side_effect = fake_generate
+        neo4j_ops = MagicMock()
+        urls = [f"https://example.com/{i}" for i in range(10)]
+
+        pipeline = BatchPipeline(neo4j_ops, scrape_concurrency=2, generate_concurrency=3,
+                                 save_concurrency=1, queue_size=2)
+        report = asyncio.run(pipeline.run(urls))
+
+        self.assertEqual(report.urls_completed, 10)
+        self.assertEqual(report.failures, {})
+        self.assertEqual(neo4j_ops.save_personas.call_count, 10)
+        self.assertEqual([stage.processed for stage in report.stages], [10, 10, 10])
+        self.assertTrue(all(stage.max_queue_depth <= 2 for stage in report.stages))
+
+    @patch('batch.agenerate_personas')
+    @patch('batch.scrape_website')
+    def test_failed_url_is_reported(self, mock_scrape, mock_generate):
+        def scrape(url):
+            if url.endswith("bad"):
+                raise ConnectionError("unreachable")
+            return "content"
+
+        async def fake_generate(scraped_text, progress=True, checkpoint=None):
+            return ['{"name": "Jane"}']
+
+        mock_scrape.side_effect = scrape
+        mock_generate.side_effect = fake_generate
+
+        report = asyncio.run(BatchPipeline(MagicMock()).run(["https://ok", "https://bad"]))
+
+        self.assertEqual(report.urls_completed, 1)
+        self.assertEqual(report.failures, {"https://bad": "scrape: unreachable"})
+
+    @patch('batch.agenerate_personas')
+    def test_dedup_skips_unchanged_and_duplicate_pages(self, mock_generate):
+        actions = {"https://same": "unchanged", "https://mirror": "duplicate", "https://new": "generate"}
+        dedup = MagicMock()
+        dedup.scrape.side_effect = lambda url: (MagicMock(text=f"content of {url}"), MagicMock(action=actions[url]))
+
+        async def fake_generate(scraped_text, progress=True, checkpoint=None):
+            return ['{"name": "Jane"}']
+
+        mock_generate.side_effect = fake_generate
+        neo4j_ops = MagicMock()
+
+        report = asyncio.run(BatchPipeline(neo4j_ops, dedup=dedup).run(list(actions)))
+
+        dedup.load.assert_called_once()
+        self.assertEqual(report.urls_completed, 1)
+        self.assertEqual(report.skipped, {"https://same": "unchanged", "https://mirror": "duplicate"})
+        self.assertEqual(report.stages[0].skipped, 2)
+        mock_generate.assert_called_once_with("content of https://new", progress=False, checkpoint=None)
+        neo4j_ops.save_personas.assert_called_once_with("https://new", ['{"name": "Jane"}'])
+        self.assertEqual(dedup.record.call_args.args[0], "https://new")
+
+    @patch('batch.agenerate_personas')
+    @patch('batch.scrape_website')
+    def test_one_writer_without_uniqueness_constraints(self, mock_scrape, mock_generate):
+        mock_scrape.return_value = "content"
+
+        async def fake_generate(scraped_text, progress=True, checkpoint=None):
+            return ['{"name": "Jane"}']
+
+        mock_generate.side_effect = fake_generate
+        neo4j_ops = MagicMock()
+        neo4j_ops.missing_constraints.return_value = ["Interest.name"]
+
+        with patch('builtins.print') as mock_print:
+            report = asyncio.run(BatchPipeline(neo4j_ops, save_concurrency=3).run(["https://a", "https://b"]))
+
+        self.assertEqual(report.urls_completed, 2)
+        self.assertEqual(report.stages[-1].concurrency, 1)
+        self.assertIn("Interest.name", mock_print.call_args.args[0])
+        neo4j_ops.missing_constraints.return_value = []
+        report = asyncio.run(BatchPipeline(neo4j_ops, save_concurrency=3).run(["https://a"]))
+        self.assertEqual(report.stages[-1].concurrency, 3)
+
+    @patch('batch.agenerate_personas')
+    def test_pages_without_personas_are_not_fingerprinted(self, mock_generate):
+        dedup = MagicMock()
+        dedup.scrape.return_value = (MagicMock(text="content"), MagicMock(action="generate"))
+
+        async def fake_generate(scraped_text, progress=True, checkpoint=None):
+            return []
+
+        mock_generate.side_effect = fake_generate
+
+        report = asyncio.run(BatchPipeline(MagicMock(), dedup=dedup).run(["https://empty"]))
+
+        self.assertEqual(report.urls_completed, 1)
+        dedup.record.assert_not_called()
+
+    @patch('batch.scrape_website')
+    def test_failed_save_is_retried_from_the_journal(self, mock_scrape):
+        mock_scrape.return_value = "Hiking boots for every trail"
+        neo4j_ops = MagicMock()
+        neo4j_ops.save_personas.side_effect = [ConnectionError("database unavailable"), None]
+        router = BackendRouter([StubBackend(reply=lambda messages: "[0.5, 0.9, 0.7, 0.6]")])
+        options = {"mode": "combined", "narrative": False}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = CheckpointStore(os.path.join(tmpdir, "checkpoints.sqlite"))
+            with patch('persona_generator.backend_router', router), \
+                    patch('persona_generator.checkpoint_store', store), \
+                    patch('persona_generator.response_cache', None):
+                usage_log.clear()
+                failed = asyncio.run(BatchPipeline(neo4j_ops, generate_options=options).run(["https://example.com"]))
+                paid_calls = len(usage_log.records)
+                rerun = asyncio.run(BatchPipeline(neo4j_ops, generate_options=options).run(["https://example.com"]))
+                journaled = store._conn.execute("SELECT COUNT(*) FROM steps").fetchone()[0]
+            store.close()
+
+        self.assertEqual(failed.failures, {"https://example.com": "save: database unavailable"})
+        self.assertEqual(rerun.urls_completed, 1)
+        self.assertGreater(paid_calls, 0)
+        self.assertEqual(len(usage_log.records), paid_calls)  # The rerun replayed every call
+        self.assertEqual(neo4j_ops.save_personas.call_args_list[0], neo4j_ops.save_personas.call_args_list[1])
+        self.assertEqual(journaled, 0)
+
+    def test_read_urls_skips_blanks_and_comments(self):
+        stream = io.StringIO("https://a\n\n# comment\n  https://b  \n")
+
+        self.assertEqual(list(read_urls(stream)), ["https://a", "https://b"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import json
+import os
+import tempfile
+import argparse
+import unittest
+from unittest.mock import patch
+from backends import BackendRouter, StubBackend
+from benchmark import BenchmarkResult, bench_generation_modes, compare, main, parse_modes, parse_scale
+
+def result(name, ops_per_second, p95_ms):
+    return BenchmarkResult(
+        name=name, scale=1000, operations=10, seconds=1.0, ops_per_second=ops_per_second,
+        p50_ms=p95_ms / 2, p95_ms=p95_ms, max_ms=p95_ms,
+    )
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_parse_scale_accepts_suffixes(self):
+        self.assertEqual([parse_scale(v) for v in ["1k", "100K", "1m", "250"]], [1000, 100000, 1000000, 250])
+
+    def test_compare_flags_throughput_and_latency_regressions(self):
+        baseline = [result("graph_write", 100.0, 10.0), result("graph_read", 50.0, 5.0)]
+        current = [result("graph_write", 85.0, 10.5), result("graph_read", 49.0, 8.0)]
+
+        regressions = compare(current, baseline, tolerance=0.1)
+
+        self.assertEqual(len(regressions), 2)
+        self.assertIn("graph_write@1000: throughput", regressions[0])
+        self.assertIn("graph_read@1000: p95", regressions[1])
+
+    def test_main_writes_machine_readable_results(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "results.json")
+            exit_code = main(["--scales", "200", "--iterations", "2", "--queries", "4", "--output", path])
+            with open(path) as f:
+                report = json.load(f)
+
+        self.assertEqual(exit_code, 0)
+        names = [entry["name"] for entry in report["results"]]
+        self.assertEqual(names, ["template_fill", "fusion_chain", "finalize_personas", "graph_write", "graph_read"])
+        self.assertIn("python", report["environment"])
+
+    def test_parse_modes_rejects_unknown_modes(self):
+        self.assertEqual(parse_modes("chained, batched"), ["chained", "batched"])
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_modes("chained,parallel")
+
+    def test_generation_modes_report_calls_tokens_and_scores(self):
+        router = BackendRouter([StubBackend(reply=lambda messages: "[0.5, 0.5, 0.5, 0.5]")])
+        with patch('persona_generator.backend_router', router), patch('persona_generator.response_cache', None), \
+                patch('persona_generator.checkpoint_store', None):
+            results = bench_generation_modes("Hiking boots for every trail", ["chained", "batched"])
+
+        chained, batched = results
+        self.assertEqual([chained.name, batched.name], ["generate_chained", "generate_batched"])
+        # Five prompts or a batch call and four narratives, plus the evaluation
+        self.assertEqual(chained.details["calls"], 21)
+        self.assertEqual(batched.details["calls"], 6)
+        self.assertLess(batched.details["prompt_tokens"], chained.details["prompt_tokens"])
+        self.assertEqual(batched.details["mean_score"], 0.5)
+        self.assertEqual(batched.details["failed_evaluations"], 0)
+
+    def test_failed_evaluations_are_not_scored(self):
+        router = BackendRouter([StubBackend(reply=lambda messages: "no scores here")])
+        with patch('persona_generator.backend_router', router), patch('persona_generator.response_cache', None), \
+                patch('persona_generator.checkpoint_store', None):
+            combined, = bench_generation_modes("Hiking boots for every trail", ["combined"], runs=2, narrative=False)
+
+        self.assertEqual(combined.details["failed_evaluations"], 2)
+        self.assertEqual(combined.details["mean_score"], 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
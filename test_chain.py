@@ -0,0 +1,241 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import unittest
+from chain import FusionChain, MinimalChainable
+from checkpoint import CheckpointStore
+from prompt_template import UnresolvedPlaceholderError
+
+def echo_model(model, prompt):
+    return f"{model}: {prompt}"
+
+def first_wins(outputs):
+    return outputs[0], [1.0] * len(outputs)
+
+class TestMinimalChainable(unittest.TestCase):
+
+    def test_run_fills_context_and_outputs(self):
+        outputs, prompts = MinimalChainable.run(
+            {"topic": "shoes"}, "m", echo_model, ["About {{topic}}", "Expand {{output[-1]}}"]
+        )
+
+        self.assertEqual(prompts, ["About shoes", "Expand m: About shoes"])
+        self.assertEqual(outputs[-1], "m: Expand m: About shoes")
+
+    def test_run_fills_model_placeholder(self):
+        outputs, prompts = MinimalChainable.run({}, "creative", echo_model, ["A {{model}} persona"])
+
+        self.assertEqual(prompts, ["A creative persona"])
+
+    def test_run_fails_on_unresolved_placeholders(self):
+        calls = []
+
+        with self.assertRaisesRegex(UnresolvedPlaceholderError, "topic"):
+            MinimalChainable.run({}, "m", lambda model, prompt: calls.append(prompt), ["About {{topic}}"])
+        self.assertEqual(calls, [])
+
+    def test_run_passes_step_to_callables_that_accept_it(self):
+        def stepped_model(model, prompt, step):
+            return {"step": step}
+
+        outputs, _ = MinimalChainable.run({}, "m", stepped_model, ["a", "b {{output[-1].step}}"])
+
+        self.assertEqual(outputs, [{"step": 0}, {"step": 1}])
+
+class TestFusionChain(unittest.TestCase):
+
+    def test_concurrent_run_keeps_model_order(self):
+        models = ["slow", "medium", "fast"]
+        delays = {"slow": 0.05, "medium": 0.02, "fast": 0.0}
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def delayed_model(model, prompt):
+            with lock:
+                running.append(model)
+                peak.append(len(running))
+            time.sleep(delays[model])
+            with lock:
+                running.remove(model)
+            return model
+
+        result = FusionChain.run(
+            context={}, models=models, callable=delayed_model, prompts=["a", "b"],
+            evaluator=first_wins, get_model_name=lambda model: model, max_workers=3,
+        )
+
+        self.assertEqual(result.used_model_names, models)
+        self.assertEqual(result.all_prompt_responses, [[m, m] for m in models])
+        self.assertGreater(max(peak), 1)
+
+    def test_failed_model_does_not_discard_others(self):
+        def flaky_model(model, prompt):
+            if model == "broken":
+                raise RuntimeError("boom")
+            return model
+
+        result = FusionChain.run(
+            context={}, models=["ok", "broken", "fine"], callable=flaky_model, prompts=["a"],
+            evaluator=first_wins, get_model_name=lambda model: model, max_workers=2,
+        )
+
+        self.assertEqual(result.used_model_names, ["ok", "fine"])
+        self.assertEqual(result.all_prompt_responses, [["ok"], ["fine"]])
+        self.assertEqual(result.model_errors, {"broken": "boom"})
+
+    def test_all_models_failing_raises(self):
+        def broken_model(model, prompt):
+            raise RuntimeError(model)
+
+        with self.assertRaises(RuntimeError):
+            FusionChain.run(
+                context={}, models=["a", "b"], callable=broken_model, prompts=["x"],
+                evaluator=first_wins, get_model_name=lambda model: model,
+            )
+
+    def test_prune_schedule_drops_weak_models_early(self):
+        calls = []
+
+        def tracked_model(model, prompt):
+            calls.append((model, prompt))
+            return f"{model}:{prompt}"
+
+        def prefer_later_models(outputs):
+            scores = [float(i) for i in range(len(outputs))]
+            return outputs[-1], scores
+
+        result = FusionChain.run(
+            context={}, models=["a", "b", "c", "d"], callable=tracked_model,
+            prompts=["p1", "p2 {{output[-1]}}", "p3"], evaluator=prefer_later_models,
+            get_model_name=lambda model: model, max_workers=4, prune_schedule={0: 3, 1: 2},
+        )
+
+        self.assertEqual(result.used_model_names, ["c", "d"])
+        self.assertEqual(result.pruned_models, {"a": 0, "b": 1})
+        self.assertEqual(result.all_prompt_responses[0], ["c:p1", "c:p2 c:p1", "c:p3"])
+        self.assertEqual(result.all_context_filled_prompts[0], ["p1", "p2 c:p1", "p3"])
+        self.assertEqual(len(calls), 4 + 3 + 2)
+
+    def test_invalid_prune_schedules_are_rejected(self):
+        def model(model, prompt):
+            raise AssertionError("no model should be called")
+
+        for schedule in ({0: 0}, {5: 2}, {-1: 2}):
+            with self.assertRaises(ValueError):
+                FusionChain.run(
+                    context={}, models=["a", "b"], callable=model, prompts=["p1", "p2"],
+                    evaluator=lambda outputs: (outputs[0], [1.0] * len(outputs)),
+                    get_model_name=lambda model: model, prune_schedule=schedule,
+                )
+
+    def test_context_filled_prompts_can_be_hashed_or_dropped(self):
+        def run(keep_prompts):
+            return FusionChain.run(
+                context={"page": "long page"}, models=["a"], callable=lambda model, prompt: prompt,
+                prompts=["{{page}}"], evaluator=first_wins, get_model_name=lambda model: model,
+                keep_prompts=keep_prompts,
+            )
+
+        self.assertEqual(run("hash").all_context_filled_prompts, [[hashlib.sha256(b"long page").hexdigest()]])
+        dropped = run("none")
+        self.assertEqual(dropped.all_context_filled_prompts, [[]])
+        self.assertEqual(dropped.all_prompt_responses, [["long page"]])
+        with self.assertRaises(ValueError):
+            run("weak")
+
+class TestCheckpointedChain(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.checkpoint = CheckpointStore(os.path.join(self.tmpdir.name, "checkpoints.sqlite")).run("run")
+
+    def test_rerun_resumes_from_last_completed_step(self):
+        calls = []
+        failing = {"b"}
+
+        def flaky(model, prompt):
+            if model in failing and prompt == "p3":
+                raise ConnectionError("timed out")
+            calls.append((model, prompt))
+            return f"{model}:{prompt}"
+
+        def run():
+            return FusionChain.run(
+                context={}, models=["a", "b"], callable=flaky, prompts=["p1", "p2", "p3"],
+                evaluator=first_wins, get_model_name=lambda model: model, checkpoint=self.checkpoint,
+            )
+
+        first = run()
+        self.assertEqual(first.model_errors, {"b": "timed out"})
+        failing.clear()
+        calls.clear()
+
+        second = run()
+
+        # Only b's failed step is called again, everything else is replayed
+        self.assertEqual(calls, [("b", "p3")])
+        self.assertEqual(second.used_model_names, ["a", "b"])
+        self.assertEqual(second.all_prompt_responses[1], ["b:p1", "b:p2", "b:p3"])
+
+    def test_journaled_evaluations_keep_pruning_stable(self):
+        evaluations = []
+
+        def score_by_call(outputs):
+            evaluations.append(len(outputs))
+            # Favours different models each time it is called
+            scores = [float((i + len(evaluations)) % len(outputs)) for i in range(len(outputs))]
+            return outputs[0], scores
+
+        def run():
+            return FusionChain.run(
+                context={}, models=["a", "b", "c"], callable=lambda model, prompt: f"{model}:{prompt}",
+                prompts=["p1", "p2"], evaluator=score_by_call, get_model_name=lambda model: model,
+                prune_schedule={0: 1}, checkpoint=self.checkpoint,
+            )
+
+        first = run()
+        second = run()
+
+        self.assertEqual(evaluations, [3, 1])
+        self.assertEqual(second.used_model_names, first.used_model_names)
+        self.assertEqual(second.pruned_models, first.pruned_models)
+
+class TestAsyncChain(unittest.TestCase):
+
+    def test_arun_accepts_coroutine_callables(self):
+        async def async_echo(model, prompt):
+            await asyncio.sleep(0)
+            return f"{model}: {prompt}"
+
+        result = asyncio.run(FusionChain.arun(
+            context={"topic": "shoes"}, models=["a", "b"], callable=async_echo,
+            prompts=["About {{topic}}"], evaluator=first_wins, get_model_name=lambda model: model,
+            max_concurrency=1,
+        ))
+
+        self.assertEqual(result.all_prompt_responses, [["a: About shoes"], ["b: About shoes"]])
+        self.assertEqual(result.all_context_filled_prompts, [["About shoes"], ["About shoes"]])
+
+    def test_arun_prunes_between_stages(self):
+        async def async_echo(model, prompt):
+            return model
+
+        async def prefer_first(outputs):
+            return outputs[0], [1.0 - 0.1 * i for i in range(len(outputs))]
+
+        result = asyncio.run(FusionChain.arun(
+            context={}, models=["a", "b", "c"], callable=async_echo, prompts=["p1", "p2"],
+            evaluator=prefer_first, get_model_name=lambda model: model, prune_schedule={0: 1},
+        ))
+
+        self.assertEqual(result.used_model_names, ["a"])
+        self.assertEqual(result.pruned_models, {"b": 0, "c": 0})
+        self.assertEqual(result.all_prompt_responses, [["a", "a"]])
+
+if __name__ == '__main__':
+    unittest.main()
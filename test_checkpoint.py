@@ -0,0 +1,46 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from checkpoint import CheckpointStore
+
+class TestCheckpointStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "checkpoints.sqlite")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_steps_persist_across_instances(self):
+        run = CheckpointStore(self.path).run("run-1")
+        run.record("analytical", 0, {"name": "Jane"})
+        run.record("analytical", 1, "A day in Jane's life...")
+        run.record("creative", 0, {"name": "John"})
+
+        self.assertEqual(CheckpointStore(self.path).steps("run-1", "analytical"),
+                         {0: {"name": "Jane"}, 1: "A day in Jane's life..."})
+        self.assertEqual(CheckpointStore(self.path).steps("run-2", "analytical"), {})
+
+    def test_clear_and_expiry(self):
+        store = CheckpointStore(self.path)
+        with patch('checkpoint.time.time', return_value=1000.0):
+            store.record("old", "analytical", 0, "reply")
+        store.record("new", "analytical", 0, "reply")
+        store.record("other", "analytical", 0, "reply")
+        store.clear("other")
+
+        reopened = CheckpointStore(self.path, ttl_seconds=60)
+        self.assertEqual(reopened.steps("old", "analytical"), {})
+        self.assertEqual(reopened.steps("new", "analytical"), {0: "reply"})
+        self.assertEqual(reopened.steps("other", "analytical"), {})
+
+    def test_run_key_depends_on_every_part(self):
+        key = CheckpointStore.run_key("gpt-4o-mini", ["p1"], "content")
+
+        self.assertEqual(key, CheckpointStore.run_key("gpt-4o-mini", ["p1"], "content"))
+        self.assertNotEqual(key, CheckpointStore.run_key("gpt-4o-mini", ["p1"], "changed content"))
+
+if __name__ == '__main__':
+    unittest.main()
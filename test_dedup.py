@@ -0,0 +1,75 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from dedup import ContentDeduplicator
+from scraper import ScrapedPage
+
+def page(url, text_hash="h1", simhash="00000000000000ff", **kwargs):
+    return ScrapedPage(url=url, text="text", content_hash=text_hash, simhash=simhash, **kwargs)
+
+def stored(content_hash="h1", has_personas=True, etag='"v1"'):
+    return {"content_hash": content_hash, "simhash": "00000000000000ff", "etag": etag,
+            "last_modified": None, "has_personas": has_personas}
+
+class TestContentDeduplicator(unittest.TestCase):
+
+    def setUp(self):
+        self.neo4j_ops = MagicMock()
+        self.neo4j_ops.fetch_website_fingerprints.return_value = [("https://canonical", "00000000000000fe")]
+        self.dedup = ContentDeduplicator(self.neo4j_ops, max_distance=3)
+        self.dedup.load()
+
+    def test_unchanged_content_is_skipped(self):
+        self.assertEqual(self.dedup.decide("https://a", page("https://a"), stored()).action, "unchanged")
+        not_modified = ScrapedPage(url="https://a", not_modified=True)
+        self.assertEqual(self.dedup.decide("https://a", not_modified, stored()).action, "unchanged")
+
+    def test_changed_or_unsaved_content_is_generated(self):
+        far = "ffffffffffffff00"
+        self.assertEqual(self.dedup.decide("https://a", page("https://a", "h2", far), stored()).action, "generate")
+        # A page with personas is regenerated even when it changed into a near-duplicate
+        self.assertEqual(self.dedup.decide("https://a", page("https://a", "h2"), stored()).action, "generate")
+        # A hash stored without personas means the last save didn't finish
+        self.assertEqual(
+            self.dedup.decide("https://a", page("https://a", simhash=far), stored(has_personas=False)).action,
+            "generate",
+        )
+
+    def test_near_duplicate_points_at_canonical_website(self):
+        decision = self.dedup.decide("https://mirror", page("https://mirror"), None)
+
+        self.assertEqual(decision.action, "duplicate")
+        self.assertEqual(decision.duplicate_of, "https://canonical")
+        self.assertEqual(decision.distance, 1)
+
+    @patch('dedup.scrape_page')
+    def test_scrape_sends_validators(self, mock_scrape_page):
+        self.neo4j_ops.get_website_fingerprint.return_value = stored(content_hash="old")
+        mock_scrape_page.return_value = page("https://a", "h2")
+
+        _, decision = self.dedup.scrape("https://a", max_tokens=100)
+
+        mock_scrape_page.assert_called_once_with("https://a", etag='"v1"', last_modified=None, max_tokens=100)
+        self.assertEqual(decision.action, "generate")
+        self.neo4j_ops.link_duplicate_website.assert_not_called()
+
+    @patch('dedup.scrape_page')
+    def test_scrape_links_duplicates(self, mock_scrape_page):
+        self.neo4j_ops.get_website_fingerprint.return_value = None
+        mock_scrape_page.return_value = page("https://mirror", "h2")
+
+        scraped, decision = self.dedup.scrape("https://mirror")
+
+        self.assertEqual(decision.action, "duplicate")
+        self.neo4j_ops.link_duplicate_website.assert_called_once_with(
+            "https://mirror", "https://canonical", 1, scraped.fingerprint()
+        )
+
+    def test_record_indexes_the_page(self):
+        self.dedup.record("https://new", page("https://new", simhash="ffffffffffffff00"))
+
+        self.neo4j_ops.unlink_duplicate_website.assert_called_once_with("https://new")
+        self.neo4j_ops.record_fingerprint.assert_called_once()
+        self.assertIn("https://new", self.dedup.index)
+
+if __name__ == '__main__':
+    unittest.main()
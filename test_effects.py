@@ -0,0 +1,38 @@
+import asyncio
+import threading
+import unittest
+from effects import Effect, run_async, run_sync
+
+def lookup_with_fallback():
+    # Reads a value off the caller's thread, falling back when the first read fails
+    try:
+        value = yield Effect(lambda: {}["missing"])
+    except KeyError:
+        value = yield Effect(threading.get_ident, lambda: asyncio.sleep(0, result="awaited"))
+    return value
+
+class TestEffects(unittest.TestCase):
+
+    def test_sync_driver_calls_effects_in_place(self):
+        self.assertEqual(run_sync(lookup_with_fallback()), threading.get_ident())
+
+    def test_async_driver_awaits_async_effects(self):
+        self.assertEqual(asyncio.run(run_async(lookup_with_fallback())), "awaited")
+
+    def test_async_driver_runs_blocking_effects_on_a_worker_thread(self):
+        def steps():
+            return (yield Effect(threading.get_ident))
+
+        self.assertNotEqual(asyncio.run(run_async(steps())), threading.get_ident())
+
+    def test_unhandled_errors_reach_the_caller(self):
+        def steps():
+            yield Effect(lambda: 1 / 0)
+
+        with self.assertRaises(ZeroDivisionError):
+            run_sync(steps())
+        with self.assertRaises(ZeroDivisionError):
+            asyncio.run(run_async(steps()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+from export import export_personas, import_personas
+
+def persona_record(i):
+    return {
+        "id": f"4:db:{i}",
+        "properties": {"name": f"Persona {i}", "age": 30 + i, "gender": "Female", "location": "Seattle"},
+        "attributes": [["IN_AGE_GROUP", "25-34"], ["HAS_GENDER", "Female"], ["LIVES_IN", "Seattle"],
+                       ["INTERESTED_IN", "Hiking"], ["INTERESTED_IN", "Design"]],
+        "insights": ['{"decision_making": "Reads reviews"}'],
+        "day_in_life": [f"Persona {i} wakes up..."],
+    }
+
+def website(url, duplicate_of=None, distance=None):
+    return {"url": url, "content_hash": f"hash of {url}", "simhash": "00000000000000ff", "etag": None,
+            "last_modified": None, "duplicate_of": duplicate_of, "distance": distance}
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.source = MagicMock()
+        self.source.fetch_websites.return_value = [
+            website("https://example.com"), website("https://mirror.example.com", "https://example.com", 2),
+        ]
+        records = [persona_record(i) for i in range(5)]
+
+        def fetch_persona_page(url, after=None, limit=1000):
+            start = 0 if after is None else int(after.rsplit(":", 1)[1]) + 1
+            return records[start:start + limit]
+
+        self.source.fetch_persona_page.side_effect = fetch_persona_page
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def round_trip(self, format):
+        exported = export_personas(self.source, self.directory.name, format=format, page_size=2)
+        target = MagicMock()
+        target.missing_constraints.return_value = []
+        imported = import_personas(target, self.directory.name)
+        return exported, imported, target
+
+    def test_csv_round_trip(self):
+        exported, imported, target = self.round_trip("csv")
+
+        self.assertEqual((exported.websites, exported.duplicates, exported.personas), (1, 1, 5))
+        self.assertEqual(exported.attributes, 25)
+        # Two full pages and a last short one, each a personas and an attributes part
+        self.assertEqual(exported.files, 1 + 3 * 2)
+        self.assertEqual(self.source.fetch_persona_page.call_args.kwargs["after"], "4:db:3")
+        self.assertTrue(os.path.isdir(os.path.join(self.directory.name, "personas", "website=https%3A%2F%2Fexample.com")))
+
+        self.assertEqual((imported.websites, imported.duplicates, imported.personas), (1, 1, 5))
+        url, personas = target.save_personas.call_args.args
+        self.assertEqual(url, "https://example.com")
+        self.assertEqual(personas[0], {
+            "name": "Persona 0", "age": 30, "gender": "Female", "location": "Seattle", "age_group": "25-34",
+            "interests": ["Hiking", "Design"], "flashmark_insights": '{"decision_making": "Reads reviews"}',
+            "A Day in the Life": "Persona 0 wakes up...",
+        })
+        target.link_duplicate_website.assert_called_once_with(
+            "https://mirror.example.com", "https://example.com", 2,
+            {"content_hash": "hash of https://mirror.example.com", "simhash": "00000000000000ff",
+             "etag": None, "last_modified": None},
+        )
+        target.record_fingerprint.assert_called_once()
+
+    def test_parquet_round_trip(self):
+        exported, imported, target = self.round_trip("parquet")
+
+        self.assertEqual(imported.personas, exported.personas)
+        self.assertEqual(target.save_personas.call_args.args[1][4]["age"], 34)
+
+    def test_import_uses_one_writer_without_uniqueness_constraints(self):
+        export_personas(self.source, self.directory.name, format="csv")
+        target = MagicMock()
+        target.missing_constraints.return_value = ["Interest.name"]
+
+        with patch('export.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as executor, patch('builtins.print'):
+            import_personas(target, self.directory.name, max_workers=4)
+            target.missing_constraints.return_value = []
+            import_personas(target, self.directory.name, max_workers=4)
+
+        self.assertEqual([call.kwargs["max_workers"] for call in executor.call_args_list], [1, 4])
+
+    def test_parquet_without_pyarrow_suggests_csv(self):
+        with patch.dict(sys.modules, {"pyarrow": None, "pyarrow.parquet": None}):
+            with self.assertRaisesRegex(ImportError, "format='csv'"):
+                export_personas(self.source, self.directory.name)
+
+    def test_unknown_format_is_rejected(self):
+        with self.assertRaises(ValueError):
+            export_personas(self.source, self.directory.name, format="xlsx")
+        self.source.fetch_websites.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
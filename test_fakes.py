@@ -0,0 +1,70 @@
+import json
+import unittest
+from chain import FusionChain
+from fakes import FakeLLM, FakeLLMError, InMemoryGraphStore, synthetic_persona, synthetic_personas
+
+class TestFakeLLM(unittest.TestCase):
+
+    def test_replies_follow_the_persona_chain(self):
+        llm = FakeLLM(narrative_words=50)
+
+        basics = json.loads(llm("creative", "prompt", step=0))
+        habits = json.loads(llm("creative", "prompt", step=2))
+        story = llm("creative", "prompt", step=4)
+
+        self.assertNotIn("interests", basics)
+        self.assertEqual(habits["name"], basics["name"])
+        self.assertIn("interests", habits)
+        self.assertIn(basics["name"], story)
+        self.assertEqual(len(story.split("\n\n", 1)[1].split()), 50)
+
+    def test_error_rate_is_reproducible(self):
+        def failures(seed):
+            llm = FakeLLM(error_rate=0.3, seed=seed)
+            outcomes = []
+            for _ in range(200):
+                try:
+                    llm("analytical", "prompt")
+                    outcomes.append(False)
+                except FakeLLMError:
+                    outcomes.append(True)
+            return outcomes
+
+        self.assertEqual(failures(7), failures(7))
+        self.assertAlmostEqual(sum(failures(7)) / 200, 0.3, delta=0.1)
+
+    def test_drives_fusion_chain(self):
+        llm = FakeLLM()
+
+        result = FusionChain.run({}, ["a", "b"], llm, ["{{model}}"] * 5, llm.evaluate, lambda model: model)
+
+        self.assertEqual(llm.calls, 10)
+        self.assertEqual(len(result.all_prompt_responses), 2)
+
+class TestInMemoryGraphStore(unittest.TestCase):
+
+    def test_reads_match_the_saved_personas(self):
+        store = InMemoryGraphStore()
+        personas = list(synthetic_personas(50))
+
+        store.save_personas("https://example.com", personas, batch_size=20)
+
+        self.assertEqual(store.statements, 3)
+        interests = dict(store.find_common_interests(min_count=1))
+        expected = sum(len(persona["interests"]) for persona in personas)
+        self.assertEqual(sum(interests.values()), expected)
+
+    def test_similar_personas_count_shared_relationship_types(self):
+        store = InMemoryGraphStore()
+        jane = synthetic_persona(1)
+        twin = dict(jane, name="Twin")
+        store.save_personas("https://example.com", [jane, twin])
+
+        similar = store.find_similar_personas(jane["name"], min_similarity=1)
+
+        # Everything but the name is shared, including the website-independent age group
+        self.assertEqual(similar[0][0], "Twin")
+        self.assertEqual(similar[0][1], len([values for values in store.links[0].values() if values]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from fingerprint import SimHashIndex, content_hash, hamming_distance, simhash
+
+ARTICLE = " ".join(
+    f"Our trail shoes number {i} are built for hikers who cover long distances on rough ground."
+    for i in range(20)
+)
+
+class TestFingerprint(unittest.TestCase):
+
+    def test_content_hash_ignores_case_and_whitespace(self):
+        self.assertEqual(content_hash("Trail  shoes\nfor hikers"), content_hash("trail shoes for HIKERS"))
+        self.assertNotEqual(content_hash("trail shoes"), content_hash("road shoes"))
+
+    def test_simhash_is_close_for_small_edits(self):
+        edited = ARTICLE.replace("number 7 are", "number 7 were")
+        unrelated = " ".join(f"Quarterly tax filing checklist item {i} for small accounting firms." for i in range(20))
+
+        self.assertLessEqual(hamming_distance(simhash(ARTICLE), simhash(edited)), 3)
+        self.assertGreater(hamming_distance(simhash(ARTICLE), simhash(unrelated)), 10)
+
+    def test_simhash_needs_enough_text(self):
+        # Empty and near-empty pages would otherwise all share one fingerprint
+        self.assertIsNone(simhash(""))
+        self.assertIsNone(simhash("Loading..."))
+        self.assertIsNone(simhash("Please enable JavaScript to run this app."))
+        self.assertIsNotNone(simhash(ARTICLE))
+
+class TestSimHashIndex(unittest.TestCase):
+
+    def test_near_finds_fingerprints_within_distance(self):
+        index = SimHashIndex(max_distance=3)
+        index.add("a", 0b1011)
+        index.add("b", 0b1011 ^ (1 << 40) ^ (1 << 63))
+        index.add("c", 0b1011 ^ 0b1111 << 20)
+
+        self.assertEqual(index.near(0b1011), [("a", 0), ("b", 2)])
+        self.assertEqual(index.near(0b1011, exclude="a"), [("b", 2)])
+
+    def test_add_replaces_and_remove_forgets(self):
+        index = SimHashIndex(max_distance=2)
+        index.add("a", 0)
+        index.add("a", (1 << 64) - 1)
+
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.near(0), [])
+        index.remove("a")
+        self.assertNotIn("a", index)
+
+if __name__ == '__main__':
+    unittest.main()
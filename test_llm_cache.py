@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from llm_cache import LLMCache
+
+class TestLLMCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_set_and_counters(self):
+        cache = LLMCache(self.path)
+        key = LLMCache.make_key("gpt-4o-mini", "system", "user", 0.7)
+
+        self.assertIsNone(cache.get(key))
+        cache.set(key, "reply")
+        self.assertEqual(cache.get(key), "reply")
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "hit_rate": 0.5, "entries": 1})
+        cache.close()
+
+    def test_key_depends_on_every_input(self):
+        base = LLMCache.make_key("gpt-4o-mini", "system", "user", 0.7)
+
+        self.assertNotEqual(base, LLMCache.make_key("gpt-4o", "system", "user", 0.7))
+        self.assertNotEqual(base, LLMCache.make_key("gpt-4o-mini", "other", "user", 0.7))
+        self.assertNotEqual(base, LLMCache.make_key("gpt-4o-mini", "system", "other", 0.7))
+        self.assertNotEqual(base, LLMCache.make_key("gpt-4o-mini", "system", "user", 0.3))
+
+    def test_entries_persist_across_instances(self):
+        LLMCache(self.path).set("k", "reply")
+
+        self.assertEqual(LLMCache(self.path).get("k"), "reply")
+
+    def test_expired_entries_are_misses(self):
+        cache = LLMCache(self.path, ttl_seconds=60)
+        with patch('llm_cache.time.time', return_value=1000.0):
+            cache.set("k", "reply")
+        with patch('llm_cache.time.time', return_value=1061.0):
+            self.assertIsNone(cache.get("k"))
+        self.assertEqual(len(cache), 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = LLMCache(self.path, max_entries=2)
+        with patch('llm_cache.time.time', side_effect=[1.0, 2.0, 3.0, 4.0]):
+            cache.set("a", "1")
+            cache.set("b", "2")
+            cache.get("a")  # "b" is now the least recently used entry
+            cache.set("c", "3")
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "1")
+
+    def test_bypass_skips_reads_and_writes(self):
+        cache = LLMCache(self.path, bypass=True)
+        cache.set("k", "reply")
+
+        self.assertIsNone(cache.get("k"))
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import os
+import tempfile
+import unittest
+from chain import MinimalChainable
+from metrics import MetricsRegistry, metrics
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_timer_keeps_count_sum_and_max_per_label_set(self):
+        registry = MetricsRegistry()
+        registry.observe("chain_prompt_seconds", 0.5, model="creative", step=0)
+        registry.observe("chain_prompt_seconds", 1.5, model="creative", step=0)
+        registry.observe("chain_prompt_seconds", 2.0, model="analytical", step=0)
+
+        timers = {timer["labels"]["model"]: timer for timer in registry.snapshot()["timers"]}
+
+        self.assertEqual((timers["creative"]["count"], timers["creative"]["sum"]), (2, 2.0))
+        self.assertEqual(timers["creative"]["max"], 1.5)
+        self.assertEqual(timers["analytical"]["labels"], {"model": "analytical", "step": "0"})
+
+    def test_timer_records_when_the_body_raises(self):
+        registry = MetricsRegistry()
+
+        with self.assertRaises(ValueError):
+            with registry.timer("scrape_fetch_seconds"):
+                raise ValueError("boom")
+
+        self.assertEqual(registry.snapshot()["timers"][0]["count"], 1)
+
+    def test_prometheus_export_groups_series_by_family(self):
+        registry = MetricsRegistry()
+        registry.inc("llm_prompt_tokens_total", 120, label="creative")
+        registry.inc("llm_prompt_tokens_total", 80, label="creative")
+        registry.observe("llm_request_seconds", 1.25, label='say "hi"')
+
+        text = registry.to_prometheus()
+
+        self.assertIn("# TYPE persona_llm_prompt_tokens_total counter", text)
+        self.assertIn('persona_llm_prompt_tokens_total{label="creative"} 200', text)
+        self.assertIn('persona_llm_request_seconds_count{label="say \\"hi\\""} 1', text)
+        lines = text.splitlines()
+        self.assertLess(lines.index("# TYPE persona_llm_request_seconds_max gauge"),
+                        lines.index('persona_llm_request_seconds_max{label="say \\"hi\\""} 1.25'))
+
+    def test_json_summary_includes_extra_entries(self):
+        registry = MetricsRegistry()
+        registry.inc("scrape_bytes_total", 2048)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "run.json")
+            registry.write_json(path, usage={"calls": 3})
+            with open(path) as f:
+                summary = json.load(f)
+
+        self.assertEqual(summary["usage"], {"calls": 3})
+        self.assertEqual(summary["counters"][0]["value"], 2048)
+        self.assertGreaterEqual(summary["elapsed_seconds"], 0)
+
+    def test_chain_times_each_prompt(self):
+        metrics.clear()
+
+        MinimalChainable.run({}, "creative", lambda model, prompt: prompt, ["a", "b"])
+
+        steps = sorted(timer["labels"]["step"] for timer in metrics.snapshot()["timers"]
+                       if timer["name"] == "chain_prompt_seconds")
+        self.assertEqual(steps, ["0", "1"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,299 @@
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+from neo4j import READ_ACCESS, WRITE_ACCESS
+from neo4j.exceptions import Neo4jError
+from fakes import InMemoryGraphStore
+from persona_schema import PersonaRecord
+from neo4j_operations import (
+    Neo4jOperations, INGEST_QUERY, SCHEMA_STATEMENTS, get_age_group, persona_attributes, persona_row,
+)
+
+SAMPLE_PERSONA = {
+    "name": "Jane Smith",
+    "age": 29,
+    "gender": "Female",
+    "ethnicity": "Asian",
+    "location": "Seattle",
+    "occupation": "Designer",
+    "income_level": "Middle",
+    "education_level": "Bachelor's",
+    "values_and_beliefs": ["Innovation", "Sustainability"],
+    "challenges": ["Time management"],
+    "needs": ["Efficiency"],
+    "frustrations": ["Slow tools"],
+    "goals": ["Get promoted"],
+    "behaviors": ["Researches online"],
+    "other_brands": ["Apple"],
+    "purchases": ["Laptop"],
+    "lifestyle": ["Urban"],
+    "interests": ["Design", "Hiking"],
+    "media_consumption": ["Podcasts"],
+    "flashmark_insights": {"decision_making": "Reads reviews"},
+    "A Day in the Life": "Jane wakes up...",
+}
+
+def query_result(records):
+    # A fake driver Result that can be iterated and consumed
+    result = MagicMock()
+    result.__iter__.side_effect = lambda: iter(records)
+    return result
+
+class TestNeo4jOperations(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('neo4j_operations.GraphDatabase.driver')
+        self.mock_driver = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = self.mock_driver.return_value.session.return_value.__enter__.return_value
+        # Managed transactions just call the work function with a fake tx
+        self.tx = MagicMock()
+        self.session.execute_read.side_effect = lambda work, *args, **kwargs: work(self.tx, *args, **kwargs)
+        self.session.execute_write.side_effect = lambda work, *args, **kwargs: work(self.tx, *args, **kwargs)
+
+    def test_personas_are_written_in_one_statement(self):
+        tx = MagicMock()
+        other = dict(SAMPLE_PERSONA, name="John Doe")
+
+        record = PersonaRecord(
+            model="creative", profile={k: v for k, v in SAMPLE_PERSONA.items() if k != "A Day in the Life"},
+            narrative="Jane wakes up...",
+        )
+
+        Neo4jOperations._create_and_link_personas(tx, "https://example.com", [record, other])
+
+        tx.run.assert_called_once()
+        query, = tx.run.call_args.args
+        rows = tx.run.call_args.kwargs["personas"]
+        self.assertEqual(query, INGEST_QUERY)
+        self.assertEqual(tx.run.call_args.kwargs["url"], "https://example.com")
+        self.assertEqual([row["properties"]["name"] for row in rows], ["Jane Smith", "John Doe"])
+        self.assertEqual(rows[0]["attributes"]["IN_AGE_GROUP"], ["25-34"])
+        self.assertEqual(rows[0]["attributes"]["INTERESTED_IN"], ["Design", "Hiking"])
+        self.assertEqual(rows[0]["insights"], ['{"decision_making": "Reads reviews"}'])
+        self.assertEqual(rows[0]["day_in_life"], ["Jane wakes up..."])
+
+    def test_nested_properties_are_stored_as_json(self):
+        row = persona_row(dict(SAMPLE_PERSONA, location={"city": "Oslo", "country": "Norway"}))
+
+        self.assertEqual(row["properties"]["location"], '{"city": "Oslo", "country": "Norway"}')
+        self.assertEqual(row["properties"]["age"], 29)
+
+    def test_missing_attributes_become_empty_lists(self):
+        attributes = persona_attributes({"name": "Sparse", "gender": "Male"})
+
+        self.assertEqual(attributes["HAS_GENDER"], ["Male"])
+        self.assertEqual(attributes["IN_AGE_GROUP"], [])
+        self.assertEqual(attributes["PREFERS"], [])
+
+    def test_pool_settings_are_passed_to_driver(self):
+        neo4j_ops = Neo4jOperations("neo4j://db", "user", "pw", database="personas",
+                                    max_connection_pool_size=20, fetch_size=500)
+
+        self.mock_driver.assert_called_once_with("neo4j://db", auth=("user", "pw"), max_connection_pool_size=20)
+        neo4j_ops.find_common_interests()
+        self.mock_driver.return_value.session.assert_called_with(
+            default_access_mode=READ_ACCESS, database="personas", fetch_size=500
+        )
+
+    def test_reads_and_writes_use_managed_transactions(self):
+        self.tx.run.side_effect = [
+            query_result([{"interest": "Hiking", "persona_count": 3}]),
+            query_result([{"id": "4:a:1"}, {"id": "4:a:2"}]),
+            query_result([{"id": "4:a:3"}]),
+        ]
+
+        with Neo4jOperations("bolt://db", "user", "pw") as neo4j_ops:
+            self.assertEqual(neo4j_ops.find_common_interests(), [("Hiking", 3)])
+            neo4j_ops.save_personas("https://example.com", [SAMPLE_PERSONA] * 3, batch_size=2)
+            metrics = neo4j_ops.pool_metrics()
+
+        self.session.execute_read.assert_called_once()
+        self.assertEqual(self.session.execute_write.call_count, 2)
+        self.mock_driver.return_value.session.assert_called_with(default_access_mode=WRITE_ACCESS)
+        self.mock_driver.return_value.close.assert_called_once()
+        self.assertEqual(metrics["acquisitions"], 3)
+        self.assertEqual(metrics["active_sessions"], 0)
+
+    def test_pool_metrics_without_pool_internals(self):
+        del self.mock_driver.return_value._pool
+
+        metrics = Neo4jOperations("bolt://db", "user", "pw").pool_metrics()
+
+        self.assertIsNone(metrics["in_use_connections"])
+        self.assertIsNone(metrics["idle_connections"])
+        self.assertIsNone(metrics["max_connection_pool_size"])
+        self.assertEqual(metrics["acquisitions"], 0)
+
+    def test_aggregates_answer_insight_queries_without_reads(self):
+        self.tx.run.return_value = query_result([
+            {"id": "4:a:1", "name": "John Doe", "rel_type": "INTERESTED_IN", "value": "Design"},
+            {"id": "4:a:2", "name": "John Doe", "rel_type": "INTERESTED_IN", "value": "Design"},
+        ])
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+        neo4j_ops.enable_aggregates()
+
+        neo4j_ops.save_personas("https://example.com", [SAMPLE_PERSONA])
+
+        # Two personas named John Doe are counted apart
+        self.assertEqual(neo4j_ops.find_common_interests(), [("Design", 3)])
+        self.assertEqual(neo4j_ops.find_brands_by_value("Innovation"), [("Apple", 1)])
+        self.assertEqual(neo4j_ops.top_n("FACES", by="LIVES_IN", value="Seattle"), [("Time management", 1)])
+        self.session.execute_read.assert_called_once()
+
+    def test_aggregates_count_like_the_graph(self):
+        # Generated lists can repeat a value, which must count once on both paths
+        personas = [
+            dict(SAMPLE_PERSONA, interests=["Design", "Design", "Hiking"], challenges=["Budget", "Budget"]),
+            dict(SAMPLE_PERSONA, name="John Doe", other_brands=["Apple", "Apple", "Patagonia"]),
+        ]
+        graph = InMemoryGraphStore()
+        graph.save_personas("https://example.com", personas)
+        self.tx.run.return_value = query_result([])
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+        neo4j_ops.enable_aggregates()
+
+        neo4j_ops.save_personas("https://example.com", personas)
+
+        rows = self.tx.run.call_args.kwargs["personas"]
+        self.assertEqual(rows[0]["attributes"]["INTERESTED_IN"], ["Design", "Hiking"])
+        self.assertEqual(sorted(neo4j_ops.find_common_interests(min_count=1)),
+                         sorted(graph.find_common_interests(min_count=1)))
+        self.assertEqual(sorted(neo4j_ops.find_challenges_by_age_group("25-34")),
+                         sorted(graph.find_challenges_by_age_group("25-34")))
+        self.assertEqual(sorted(neo4j_ops.find_brands_by_value("Innovation")),
+                         sorted(graph.find_brands_by_value("Innovation")))
+        self.assertEqual(dict(neo4j_ops.find_common_interests(min_count=1)), {"Design": 2, "Hiking": 2})
+
+    def test_top_n_builds_query_from_known_relationship_types(self):
+        self.tx.run.return_value = query_result([{"value": "Apple", "count": 4}])
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+
+        self.assertEqual(neo4j_ops.top_n("PREFERS", by="LIVES_IN", value="Seattle", n=5), [("Apple", 4)])
+        query = self.tx.run.call_args.args[0]
+        self.assertIn("MATCH (p)-[:LIVES_IN]->(:Location {name: $value})", query)
+        self.assertIn("LIMIT $n", query)
+        with self.assertRaises(ValueError):
+            neo4j_ops.top_n("PREFERS) DETACH DELETE (p")
+
+    def test_similarity_index_is_built_and_kept_current(self):
+        self.tx.run.side_effect = [
+            query_result([
+                {"id": "4:a:1", "name": "John Doe", "rel_type": "INTERESTED_IN", "value": "Design"},
+                {"id": "4:a:1", "name": "John Doe", "rel_type": "HAS_GENDER", "value": "Male"},
+                {"id": "4:a:1", "name": "John Doe", "rel_type": "GENERATED_FOR", "value": "https://example.com"},
+                {"id": "4:a:2", "name": "John Doe", "rel_type": "INTERESTED_IN", "value": "Cooking"},
+            ]),
+            query_result([{"id": "4:a:3"}]),
+        ]
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+        neo4j_ops.enable_similarity_index()
+
+        neo4j_ops.save_personas("https://example.com", [json.dumps(SAMPLE_PERSONA)])
+
+        # Personas are indexed by element id, so the two John Does stay apart
+        self.assertEqual(len(neo4j_ops.similarity_index), 3)
+        self.assertEqual(neo4j_ops.similarity_index.ids("Jane Smith"), ["4:a:3"])
+        self.assertEqual(neo4j_ops.find_similar_personas("Jane Smith", min_similarity=2), [("John Doe", 2)])
+        self.session.execute_read.assert_called_once()
+
+    def test_similar_to_edges_are_matched_by_element_id(self):
+        self.tx.run.return_value = query_result([
+            {"id": "4:a:1", "name": "John Doe", "rel_type": "INTERESTED_IN", "value": "Design"},
+            {"id": "4:a:2", "name": "John Doe", "rel_type": "INTERESTED_IN", "value": "Design"},
+        ])
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+        neo4j_ops.enable_similarity_index()
+
+        self.assertEqual(neo4j_ops.write_similar_to_edges(), 2)
+        query = self.tx.run.call_args.args[0]
+        self.assertIn("WHERE elementId(a) = row.source", query)
+        self.assertEqual(
+            [(row["source"], row["target"]) for row in self.tx.run.call_args.kwargs["rows"]],
+            [("4:a:1", "4:a:2"), ("4:a:2", "4:a:1")],
+        )
+
+    def test_website_fingerprints_are_read_and_duplicates_linked(self):
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+        self.tx.run.return_value = query_result([])
+        self.assertIsNone(neo4j_ops.get_website_fingerprint("https://new"))
+
+        self.tx.run.return_value = query_result([{"personas": 4}])
+        fingerprint = {"content_hash": "h", "simhash": "00000000000000ff", "etag": None, "last_modified": None}
+
+        self.assertEqual(neo4j_ops.link_duplicate_website("https://mirror", "https://example.com", 2, fingerprint), 4)
+        query = self.tx.run.call_args.args[0]
+        self.assertIn("MERGE (w)-[d:DUPLICATE_OF]->(c)", query)
+        self.assertIn("MERGE (p)-[:GENERATED_FOR]->(w)", query)
+        self.assertEqual(self.tx.run.call_args.kwargs["canonical_url"], "https://example.com")
+        self.session.execute_write.assert_called_once()
+
+        self.tx.run.return_value = query_result([{"unlinked": 4}])
+        self.assertEqual(neo4j_ops.unlink_duplicate_website("https://mirror"), 4)
+        self.assertIn("DELETE d", self.tx.run.call_args.args[0])
+
+    def test_persona_pages_start_after_the_previous_page(self):
+        self.tx.run.return_value = query_result([{"id": "4:db:7", "properties": {"name": "Jane"}, "attributes": [],
+                                                  "insights": [], "day_in_life": []}])
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+
+        page = neo4j_ops.fetch_persona_page("https://example.com", after="4:db:3", limit=50)
+
+        self.assertEqual(page[0]["id"], "4:db:7")
+        kwargs = self.tx.run.call_args.kwargs
+        self.assertEqual((kwargs["url"], kwargs["after"], kwargs["limit"]), ("https://example.com", "4:db:3", 50))
+        self.assertIn("INTERESTED_IN", kwargs["rel_types"])
+        self.session.execute_read.assert_called_once()
+
+    def test_ensure_schema_reports_created_items(self):
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+        session = self.session
+        # Only the first statement creates something, the rest already exist
+        created = MagicMock(constraints_added=1, indexes_added=0)
+        existing = MagicMock(constraints_added=0, indexes_added=0)
+        session.run.return_value.consume.side_effect = (
+            [MagicMock(counters=created)] + [MagicMock(counters=existing)] * (len(SCHEMA_STATEMENTS) - 1)
+        )
+
+        self.assertEqual(neo4j_ops.ensure_schema(), ["website_url_unique"])
+        self.assertEqual(session.run.call_count, len(SCHEMA_STATEMENTS))
+        self.assertTrue(all("IF NOT EXISTS" in statement for _, statement in SCHEMA_STATEMENTS))
+
+    def test_ensure_schema_skips_conflicting_constraints(self):
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+        conflict = Neo4jError("Unable to create Constraint: duplicate nodes")
+        existing = MagicMock(counters=MagicMock(constraints_added=0, indexes_added=1))
+        self.session.run.return_value.consume.side_effect = (
+            [conflict] + [existing] * (len(SCHEMA_STATEMENTS) - 1)
+        )
+
+        with patch('builtins.print') as mock_print:
+            created = neo4j_ops.ensure_schema()
+
+        self.assertNotIn("website_url_unique", created)
+        self.assertEqual(len(created), len(SCHEMA_STATEMENTS) - 1)
+        self.assertIn("website_url_unique", mock_print.call_args.args[0])
+
+    def test_missing_constraints(self):
+        neo4j_ops = Neo4jOperations("bolt://db", "user", "pw")
+        self.tx.run.return_value = [
+            {"type": "UNIQUENESS", "labelsOrTypes": ["Website"], "properties": ["url"]},
+            {"type": "NODE_PROPERTY_UNIQUENESS", "labelsOrTypes": ["Interest"], "properties": ["name"]},
+            {"type": "NODE_PROPERTY_EXISTENCE", "labelsOrTypes": ["Brand"], "properties": ["name"]},
+        ]
+
+        missing = neo4j_ops.missing_constraints()
+
+        self.assertIn("Brand.name", missing)
+        self.assertNotIn("Website.url", missing)
+        self.assertNotIn("Interest.name", missing)
+        self.session.execute_read.side_effect = Neo4jError("Unknown command")
+        self.assertIn("Website.url", neo4j_ops.missing_constraints())
+
+
+        self.assertEqual(get_age_group(17), "Under 18")
+        self.assertEqual(get_age_group(34), "25-34")
+        self.assertEqual(get_age_group(70), "65+")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,31 @@
+import asyncio
+import json
+import os
+import tempfile
 import unittest
-from unittest.mock import patch, MagicMock
-from persona_generator import generate_personas, call_openai, evaluate_personas
+from unittest.mock import patch, AsyncMock, MagicMock
+from backends import BackendRouter, StubBackend
+from checkpoint import CheckpointStore
+from llm_cache import LLMCache
+from metrics import MetricsRegistry
+from chain import MinimalChainable
+from persona_schema import NARRATIVE_KEY, InvalidModelOutputError, PersonaBasics
+from persona_generator import (
+    PREFIX_PERSONA_PROMPTS, SEED_PERSONALITIES, SHARED_PREFIX_SYSTEM_PROMPT, generate_personas, agenerate_personas,
+    call_openai, acall_openai, evaluate_personas, finish_run, openai_backend, run_checkpoint, usage_log,
+)
 
 class TestPersonaGenerator(unittest.TestCase):
 
+    def setUp(self):
+        # Stand-in API clients, so the tests need no key and make no requests
+        for name in ("client", "aclient"):
+            patcher = patch.object(openai_backend, name, MagicMock())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     @patch('persona_generator.FusionChain.run')
-    @patch('persona_generator.client.chat.completions.create')
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
     def test_generate_personas(self, mock_create, mock_run):
         # Mock the FusionChain.run method
         mock_run.return_value = MagicMock(
@@ -13,7 +33,10 @@ class TestPersonaGenerator(unittest.TestCase):
                 ['{"name": "John Doe"}', '{"name": "John Doe", "age": 30}', '{"name": "John Doe", "age": 30, "habits": {}}', '{"name": "John Doe", "age": 30, "habits": {}, "insights": {}}', "A day in John's life..."],
                 ['{"name": "Jane Smith"}', '{"name": "Jane Smith", "age": 25}', '{"name": "Jane Smith", "age": 25, "habits": {}}', '{"name": "Jane Smith", "age": 25, "habits": {}, "insights": {}}', "A day in Jane's life..."],
             ],
-            performance_scores=[0.9, 0.8]
+            performance_scores=[0.9, 0.8],
+            used_model_names=["analytical", "creative"],
+            model_errors={},
+            pruned_models={},
         )
 
         # Mock the OpenAI API call for evaluate_personas
@@ -21,11 +44,32 @@ class TestPersonaGenerator(unittest.TestCase):
 
         result = generate_personas("Sample website content")
 
-        self.assertEqual(len(result), 4)  # Now expecting 4 personas
-        self.assertIn("John Doe", result[0])
-        self.assertIn("Jane Smith", result[1])
+        self.assertEqual(len(result), 2)  # One persona per chain that ran
+        self.assertEqual(result[0].name, "John Doe")
+        self.assertEqual(result[0].model, "analytical")
+        self.assertEqual(result[1].narrative, "A day in Jane's life...")
+        self.assertEqual(json.loads(str(result[1]))["A Day in the Life"], "A day in Jane's life...")
+        self.assertEqual(mock_run.call_args.kwargs["keep_prompts"], "none")
+
+    @patch('persona_generator.FusionChain.run')
+    def test_generate_personas_checkpoints_by_content(self, mock_run):
+        mock_run.return_value = MagicMock(all_prompt_responses=[], used_model_names=[], model_errors={},
+                                          pruned_models={})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = CheckpointStore(os.path.join(tmpdir, "checkpoints.sqlite"))
+            with patch('persona_generator.checkpoint_store', store):
+                run_ids = []
+                for content, run_id in [("page", None), ("page", None), ("changed page", None), ("page", "mine")]:
+                    generate_personas(content, run_id=run_id)
+                    run_ids.append(mock_run.call_args.kwargs["checkpoint"].run_id)
+            store.close()
+
+        self.assertEqual(run_ids[0], run_ids[1])
+        self.assertNotEqual(run_ids[0], run_ids[2])
+        self.assertEqual(run_ids[3], "mine")
 
-    @patch('persona_generator.client.chat.completions.create')
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
     def test_call_openai(self, mock_create):
         mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content='{"name": "Test Persona"}'))])
 
@@ -41,7 +85,113 @@ class TestPersonaGenerator(unittest.TestCase):
             temperature=0.7,
         )
 
-    @patch('persona_generator.client.chat.completions.create')
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
+    def test_call_openai_uses_response_cache(self, mock_create):
+        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content='{"name": "Test Persona"}'))])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = LLMCache(os.path.join(tmpdir, "cache.sqlite"))
+            with patch('persona_generator.response_cache', cache):
+                first = call_openai("analytical", "Generate a persona")
+                second = call_openai("analytical", "Generate a persona")
+                call_openai("creative", "Generate a persona")
+            cache.close()
+
+        self.assertEqual(first, second)
+        self.assertEqual(mock_create.call_count, 2)
+        self.assertEqual(cache.hits, 1)
+
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
+    def test_empty_replies_are_not_cached(self, mock_create):
+        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content=None))])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = LLMCache(os.path.join(tmpdir, "cache.sqlite"))
+            with patch('persona_generator.response_cache', cache):
+                call_openai("analytical", "Generate a persona")
+                call_openai("analytical", "Generate a persona")
+            cache.close()
+
+        self.assertEqual(mock_create.call_count, 2)
+        self.assertEqual(cache.hits, 0)
+
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
+    def test_call_openai_records_cached_tokens(self, mock_create):
+        usage = MagicMock(prompt_tokens=1200, completion_tokens=80, prompt_tokens_details=MagicMock(cached_tokens=1024))
+        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content='{}'))], usage=usage)
+        usage_log.clear()
+
+        call_openai("analytical", "Generate a persona", shared_prefix=True)
+
+        record, = usage_log.records
+        self.assertEqual((record.label, record.prompt_tokens, record.cached_tokens), ("analytical", 1200, 1024))
+        self.assertAlmostEqual(usage_log.totals()["cached_ratio"], 1024 / 1200)
+        system_message = mock_create.call_args.kwargs["messages"][0]
+        self.assertEqual(system_message["content"], SHARED_PREFIX_SYSTEM_PROMPT)
+
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
+    def test_token_counters_are_labelled_by_model_and_stage(self, mock_create):
+        usage = MagicMock(prompt_tokens=1200, completion_tokens=80, prompt_tokens_details=MagicMock(cached_tokens=0))
+        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content='{}'))], usage=usage)
+        registry = MetricsRegistry()
+
+        with patch('persona_generator.metrics', registry):
+            call_openai("analytical", "Generate a persona", stage="narrative")
+
+        counters = {c["name"]: c for c in registry.snapshot()["counters"]}
+        prompt_tokens = counters["llm_prompt_tokens_total"]
+        self.assertEqual(prompt_tokens["labels"], {"label": "analytical", "model": "gpt-4o-mini", "stage": "narrative"})
+        self.assertEqual(prompt_tokens["value"], 1200)
+
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
+    def test_call_openai_repairs_invalid_structured_reply(self, mock_create):
+        basics = {
+            "name": "Jane", "age": 34, "gender": "female", "ethnicity": "Hispanic", "location": "Denver",
+            "occupation": "Nurse", "income_level": "middle", "education_level": "BSc",
+        }
+        mock_create.side_effect = [
+            MagicMock(choices=[MagicMock(message=MagicMock(content='{"name": "Jane"}'))]),
+            MagicMock(choices=[MagicMock(message=MagicMock(content=json.dumps(basics)))]),
+        ]
+
+        result = call_openai("analytical", "Generate a persona", response_model=PersonaBasics)
+
+        self.assertEqual(result, basics)
+        first, repair = mock_create.call_args_list
+        self.assertEqual(first.kwargs["response_format"]["json_schema"]["name"], "PersonaBasics")
+        self.assertEqual(repair.kwargs["messages"][2], {"role": "assistant", "content": '{"name": "Jane"}'})
+
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
+    def test_call_openai_gives_up_after_max_repairs(self, mock_create):
+        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content='not json'))])
+
+        with self.assertRaises(InvalidModelOutputError):
+            call_openai("analytical", "Generate a persona", response_model=PersonaBasics, max_repairs=1)
+        self.assertEqual(mock_create.call_count, 2)
+
+    def test_prefix_layout_shares_website_prefix_across_models(self):
+        context = {"website_content": "Trail shoes for hikers. " * 50}
+        outputs = [{"name": "Jane"}]
+
+        filled = [
+            MinimalChainable.fill_prompt(prompt, {"model": model, **context}, outputs)
+            for model in ["analytical", "creative"] for prompt in PREFIX_PERSONA_PROMPTS
+        ]
+
+        prefix = os.path.commonprefix(filled)
+        self.assertIn(context["website_content"], prefix)
+        self.assertNotIn("analytical", prefix)
+
+    @patch('persona_generator.openai_backend.aclient.chat.completions.create', new_callable=AsyncMock)
+    def test_acall_openai(self, mock_create):
+        mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content='{"name": "Test Persona"}'))])
+
+        result = asyncio.run(acall_openai("analytical", "Generate a persona"))
+
+        self.assertEqual(result, '{"name": "Test Persona"}')
+        mock_create.assert_awaited_once()
+
+    @patch('persona_generator.openai_backend.client.chat.completions.create')
     def test_evaluate_personas(self, mock_create):
         mock_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content='[0.8, 0.9]'))])
 
@@ -52,5 +202,103 @@ class TestPersonaGenerator(unittest.TestCase):
         self.assertEqual(scores, [0.8, 0.9])
         mock_create.assert_called_once()
 
+class TestGenerationModes(unittest.TestCase):
+
+    def setUp(self):
+        self.router = BackendRouter([StubBackend(reply=lambda messages: "[0.5, 0.9, 0.7, 0.6]")])
+        for patcher in [patch('persona_generator.backend_router', self.router),
+                        patch('persona_generator.response_cache', None),
+                        patch('persona_generator.checkpoint_store', None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        usage_log.clear()
+
+    def labels(self):
+        return [record.label for record in usage_log.records]
+
+    def test_combined_mode_writes_each_profile_in_one_call(self):
+        personas = generate_personas("Hiking boots for every trail", mode="combined")
+
+        self.assertEqual(len(personas), len(SEED_PERSONALITIES))
+        self.assertIn("flashmark_insights", personas[0].profile)
+        self.assertTrue(personas[0].narrative)
+        # A profile and a narrative call per persona, and the evaluation
+        self.assertEqual(self.labels().count("analytical"), 2)
+        self.assertEqual(len(self.labels()), 2 * len(SEED_PERSONALITIES) + 1)
+
+    def test_batched_mode_writes_every_profile_in_one_call(self):
+        personas = generate_personas("Hiking boots for every trail", mode="batched", narrative=False)
+
+        self.assertEqual([persona.model for persona in personas], SEED_PERSONALITIES)
+        self.assertEqual(len({persona.name for persona in personas}), len(SEED_PERSONALITIES))
+        self.assertIsNone(personas[0].narrative)
+        self.assertNotIn(NARRATIVE_KEY, personas[0].to_dict())
+        self.assertEqual(self.labels(), ["batch", "evaluation"])
+
+    def test_batched_mode_prunes_before_narratives(self):
+        personas = asyncio.run(agenerate_personas(
+            "Hiking boots for every trail", progress=False, mode="batched", prune_schedule={0: 2},
+        ))
+
+        # Scores 0.9 and 0.7 are kept
+        self.assertEqual([persona.model for persona in personas], ["creative", "practical"])
+        self.assertEqual(self.labels().count("batch"), 1)
+        self.assertEqual(self.labels().count("creative"), 1)
+
+    def test_batched_reply_missing_a_persona_fails_only_that_chain(self):
+        def reply(messages):
+            if "personality types" in messages[-1]["content"]:
+                return json.dumps({personality: {"name": personality.title()} for personality in SEED_PERSONALITIES[1:]})
+            return "[0.5, 0.9, 0.7]"
+        self.router.backends["stub"].reply = reply
+
+        personas = generate_personas("Hiking boots", mode="batched", structured=False, narrative=False)
+
+        self.assertEqual([persona.name for persona in personas], ["Creative", "Practical", "Enthusiastic"])
+
+    def test_saved_runs_are_cleared_and_keyed_by_backends(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = CheckpointStore(os.path.join(tmpdir, "checkpoints.sqlite"))
+            journaled = lambda: store._conn.execute("SELECT COUNT(*) FROM steps").fetchone()[0]
+            with patch('persona_generator.checkpoint_store', store):
+                checkpoint = run_checkpoint("Hiking boots", mode="combined", narrative=False)
+                generate_personas("Hiking boots", mode="combined", narrative=False, checkpoint=checkpoint)
+                self.assertGreater(journaled(), 0)  # Kept until the personas are saved
+                finish_run(checkpoint)
+                self.assertEqual(journaled(), 0)
+                # Running the page again calls the models instead of replaying the saved run
+                generate_personas("Hiking boots", mode="combined", narrative=False)
+                run_id = run_checkpoint("Hiking boots").run_id
+                with patch('persona_generator.backend_router', BackendRouter([StubBackend("other", model="other")])):
+                    other_run_id = run_checkpoint("Hiking boots").run_id
+            store.close()
+
+        self.assertEqual(self.labels().count("analytical"), 2)
+        self.assertNotEqual(run_id, other_run_id)
+
+    def test_runs_with_a_failed_chain_are_kept(self):
+        def reply(messages):
+            if "personality types" in messages[-1]["content"]:
+                return json.dumps({personality: {"name": personality.title()} for personality in SEED_PERSONALITIES[1:]})
+            return "[0.5, 0.9, 0.7]"
+        self.router.backends["stub"].reply = reply
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = CheckpointStore(os.path.join(tmpdir, "checkpoints.sqlite"))
+            with patch('persona_generator.checkpoint_store', store):
+                checkpoint = run_checkpoint("Hiking boots", mode="batched", structured=False, narrative=False)
+                generate_personas(
+                    "Hiking boots", mode="batched", structured=False, narrative=False, checkpoint=checkpoint,
+                )
+                finish_run(checkpoint)
+                self.assertTrue(checkpoint.failed)
+                self.assertNotEqual(checkpoint.steps("creative"), {})
+            store.close()
+
+    def test_unknown_mode_is_rejected(self):
+        with self.assertRaises(ValueError):
+            generate_personas("Hiking boots", mode="parallel")
+        self.assertEqual(self.labels(), [])
+
 if __name__ == '__main__':
     unittest.main()
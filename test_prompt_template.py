@@ -0,0 +1,37 @@
+import unittest
+from prompt_template import PromptTemplate, UnresolvedPlaceholderError, compile_template
+
+class TestPromptTemplate(unittest.TestCase):
+
+    def test_render_context_and_outputs(self):
+        template = PromptTemplate("{{site}} | {{output[-2]}} | {{output[-1].name}} | {{output[-1]}}")
+        outputs = ["first", {"name": "Jane"}]
+
+        prompt, unresolved = template.render({"site": "shop"}, outputs)
+
+        self.assertEqual(prompt, 'shop | first | Jane | {"name": "Jane"}')
+        self.assertEqual(unresolved, [])
+
+    def test_substituted_values_are_not_rescanned(self):
+        template = PromptTemplate("Content: {{website_content}}")
+
+        prompt, unresolved = template.render({"website_content": "literal {{output[-1]}}"}, ["x"])
+
+        self.assertEqual(prompt, "Content: literal {{output[-1]}}")
+        self.assertEqual(unresolved, [])
+
+    def test_unresolved_placeholders_are_reported(self):
+        template = PromptTemplate("{{missing}} {{output[-3]}} {{output[-1].age}}")
+
+        prompt, unresolved = template.render({}, [{"name": "Jane"}])
+
+        self.assertEqual(prompt, "{{missing}} {{output[-3]}} {{output[-1].age}}")
+        self.assertEqual(unresolved, ["{{missing}}", "{{output[-3]}}", "{{output[-1].age}}"])
+        with self.assertRaises(UnresolvedPlaceholderError):
+            template.render_strict({}, [])
+
+    def test_compile_template_reuses_parses(self):
+        self.assertIs(compile_template("Hi {{name}}"), compile_template("Hi {{name}}"))
+
+if __name__ == '__main__':
+    unittest.main()
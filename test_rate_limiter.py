@@ -0,0 +1,108 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+from rate_limiter import RequestScheduler, TokenBucket, quota_exhausted, retry_after_seconds
+
+class Throttled(Exception):
+    def __init__(self, headers, code=None):
+        super().__init__("429 Too Many Requests")
+        self.response = SimpleNamespace(headers=headers)
+        self.code = code
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_wait_time_reflects_refill_rate(self):
+        bucket = TokenBucket(per_minute=600)  # 10 tokens per second
+        now = bucket.updated
+        bucket.take(600)
+
+        self.assertAlmostEqual(bucket.wait_time(5, now), 0.5)
+        self.assertEqual(bucket.wait_time(5, now + 1), 0.0)
+
+    def test_oversized_request_waits_for_full_bucket(self):
+        bucket = TokenBucket(per_minute=60)
+        now = bucket.updated
+
+        self.assertEqual(bucket.wait_time(1000, now), 0.0)
+        bucket.take(1000)
+        self.assertAlmostEqual(bucket.wait_time(1, now), 1.0)
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def test_retries_honor_retry_after(self):
+        scheduler = RequestScheduler(base_delay=0.001, retry_on=(Throttled,))
+        attempts = []
+
+        def flaky():
+            attempts.append(time.monotonic())
+            if len(attempts) < 3:
+                raise Throttled({"retry-after-ms": "30"})
+            return "ok"
+
+        self.assertEqual(scheduler.call(flaky), "ok")
+        self.assertEqual(scheduler.stats()["retries"], 2)
+        self.assertGreaterEqual(attempts[1] - attempts[0], 0.03)
+
+    def test_gives_up_after_max_retries(self):
+        scheduler = RequestScheduler(max_retries=1, base_delay=0.001, retry_on=(Throttled,))
+        attempts = []
+
+        def always_throttled():
+            attempts.append(1)
+            raise Throttled({})
+
+        with self.assertRaises(Throttled):
+            scheduler.call(always_throttled)
+        self.assertEqual(len(attempts), 2)
+
+    def test_exhausted_quota_is_not_retried(self):
+        scheduler = RequestScheduler(base_delay=0.001, retry_on=(Throttled,))
+        attempts = []
+
+        def out_of_quota():
+            attempts.append(1)
+            raise Throttled({}, code="insufficient_quota")
+
+        with self.assertRaises(Throttled):
+            scheduler.call(out_of_quota)
+        self.assertEqual(len(attempts), 1)
+        self.assertTrue(quota_exhausted(Throttled({}, code="insufficient_quota")))
+        self.assertFalse(quota_exhausted(Throttled({}, code="rate_limit_exceeded")))
+
+    def test_other_errors_are_not_retried(self):
+        scheduler = RequestScheduler(base_delay=0.001, retry_on=(Throttled,))
+
+        with self.assertRaises(KeyError):
+            scheduler.call(lambda: {}["missing"])
+        self.assertEqual(scheduler.stats()["retries"], 0)
+
+    def test_higher_priority_waiters_go_first(self):
+        scheduler = RequestScheduler(requests_per_minute=1200)  # One request per 50ms
+        scheduler.request_bucket.level = 0
+        order = []
+
+        async def worker(name, priority):
+            await scheduler.aacquire(priority=priority)
+            order.append(name)
+
+        async def main():
+            await asyncio.gather(worker("new chain", 0), worker("in-flight chain", 3))
+
+        asyncio.run(main())
+
+        self.assertEqual(order, ["in-flight chain", "new chain"])
+
+    def test_token_bucket_is_corrected_with_actual_usage(self):
+        scheduler = RequestScheduler(tokens_per_minute=1000)
+
+        scheduler.call(lambda: "reply", estimated_tokens=400, count_tokens=lambda reply: 100)
+
+        self.assertAlmostEqual(scheduler.token_bucket.level, 900, delta=1)
+
+    def test_retry_after_accepts_seconds(self):
+        self.assertEqual(retry_after_seconds(Throttled({"retry-after": "2"})), 2.0)
+        self.assertIsNone(retry_after_seconds(ValueError()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import requests
+from scraper import extract_text, fetch_html, scrape_page, scrape_website, truncate_to_token_budget
+
+PAGE = b"""<html><head><title>Shop</title><style>body { color: red; }</style></head>
+<body><nav>Home | About</nav><script>var tracking = 1;</script>
+<main><h1>Trail shoes</h1><p>Built   for   hikers.</p></main>
+<footer>Copyright</footer></body></html>"""
+
+def mock_response(chunks, status_code=200, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    response.__enter__.return_value = response
+    response.iter_content.return_value = iter(chunks)
+    return response
+
+class TestScraper(unittest.TestCase):
+
+    def test_extract_text_strips_boilerplate(self):
+        text = extract_text(PAGE)
+
+        self.assertEqual(text, "Shop\nTrail shoes\nBuilt for hikers.")
+
+    def test_truncate_to_token_budget_cuts_on_word_boundary(self):
+        self.assertEqual(truncate_to_token_budget("alpha beta gamma", max_tokens=3), "alpha beta")
+        self.assertEqual(truncate_to_token_budget("short", max_tokens=3), "short")
+
+    @patch('scraper.get_session')
+    def test_fetch_html_stops_at_byte_cap(self, mock_get_session):
+        response = mock_response([b"a" * 10, b"b" * 10, b"c" * 10])
+        mock_get_session.return_value.get.return_value = response
+
+        html = fetch_html("https://example.com", max_bytes=15, timeout=3)
+
+        self.assertEqual(html, b"a" * 10 + b"b" * 5)
+        mock_get_session.return_value.get.assert_called_once_with("https://example.com", stream=True, timeout=3, headers=None)
+        response.raise_for_status.assert_called_once()
+
+    @patch('scraper.time.monotonic')
+    @patch('scraper.get_session')
+    def test_fetch_html_gives_up_after_the_deadline(self, mock_get_session, mock_monotonic):
+        # Every chunk arrives within the read timeout, but the whole page takes 40 seconds
+        mock_monotonic.side_effect = [0, 10, 20, 30, 40]
+        mock_get_session.return_value.get.return_value = mock_response([b"a"] * 4)
+
+        with self.assertRaises(requests.Timeout):
+            fetch_html("https://example.com", deadline=25)
+
+    @patch('scraper.get_session')
+    def test_scrape_website(self, mock_get_session):
+        mock_get_session.return_value.get.return_value = mock_response([PAGE])
+
+        self.assertIn("Trail shoes", scrape_website("https://example.com"))
+
+    @patch('scraper.get_session')
+    def test_scrape_page_fingerprints_text_and_keeps_validators(self, mock_get_session):
+        mock_get_session.return_value.get.return_value = mock_response([PAGE], headers={"ETag": '"v1"'})
+
+        page = scrape_page("https://example.com")
+
+        self.assertEqual(page.text, "Shop\nTrail shoes\nBuilt for hikers.")
+        self.assertEqual(page.etag, '"v1"')
+        self.assertIsNone(page.simhash)  # Too little text to compare
+        self.assertFalse(page.not_modified)
+
+        long_page = PAGE.replace(b"Built   for   hikers.", b"Built for hikers who cover long distances. " * 5)
+        mock_get_session.return_value.get.return_value = mock_response([long_page])
+        self.assertEqual(len(scrape_page("https://example.com").simhash), 16)
+
+    @patch('scraper.get_session')
+    def test_scrape_page_sends_conditional_request(self, mock_get_session):
+        response = mock_response([], status_code=304)
+        mock_get_session.return_value.get.return_value = response
+
+        page = scrape_page("https://example.com", etag='"v1"', last_modified="Mon, 05 Oct 2026 10:00:00 GMT")
+
+        self.assertTrue(page.not_modified)
+        self.assertEqual(page.text, "")
+        headers = mock_get_session.return_value.get.call_args.kwargs["headers"]
+        self.assertEqual(headers, {"If-None-Match": '"v1"', "If-Modified-Since": "Mon, 05 Oct 2026 10:00:00 GMT"})
+        response.raise_for_status.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from similarity import PersonaSimilarityIndex
+
+class TestPersonaSimilarityIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = PersonaSimilarityIndex(weights={"HAS_GENDER": 0.1})
+        self.index.add("Jane", {"HAS_GENDER": ["Female"], "INTERESTED_IN": ["Hiking", "Design"], "PREFERS": ["Apple"]})
+        self.index.add("Ann", {"HAS_GENDER": ["Female"], "INTERESTED_IN": ["Hiking", "Design"], "PREFERS": ["Apple"]})
+        self.index.add("Bob", {"HAS_GENDER": ["Female"], "INTERESTED_IN": ["Cooking"]})
+        self.index.add("Cal", {"HAS_GENDER": ["Male"], "INTERESTED_IN": ["Golf"]})
+
+    def test_jaccard_ranks_closest_first(self):
+        similar = self.index.similar("Jane", k=2)
+
+        self.assertEqual(similar, [("Ann", 1.0), ("Bob", 0.2)])
+
+    def test_personas_sharing_nothing_are_excluded(self):
+        self.assertNotIn("Cal", [name for name, _ in self.index.similar("Jane", k=None)])
+
+    def test_weighted_metric_discounts_hub_attributes(self):
+        _, jaccard = self.index.similar("Bob", k=1)[0]
+        _, weighted = self.index.similar("Bob", k=1, metric="weighted")[0]
+
+        self.assertLess(weighted, jaccard)
+
+    def test_shared_types_counts_relationship_types(self):
+        self.assertEqual(self.index.similar("Jane", k=None, metric="shared_types", min_score=2), [("Ann", 3)])
+
+    def test_readding_a_persona_replaces_it(self):
+        self.index.add("Ann", {"INTERESTED_IN": ["Golf"]})
+
+        self.assertEqual(self.index.similar("Cal", k=None), [("Ann", 0.5)])
+        self.assertEqual(len(self.index), 4)
+
+    def test_personas_sharing_a_name_are_kept_apart(self):
+        self.index.add("4:a:1", {"INTERESTED_IN": ["Golf"]}, name="Dee")
+        self.index.add("4:a:2", {"INTERESTED_IN": ["Golf", "Chess"]}, name="Dee")
+
+        self.assertEqual(self.index.ids("Dee"), ["4:a:1", "4:a:2"])
+        self.assertEqual(self.index.similar("4:a:1", k=None), [("4:a:2", 0.5), ("Cal", 0.5)])
+        self.assertEqual(self.index.name("4:a:2"), "Dee")
+
+    def test_unknown_persona_and_metric(self):
+        self.assertEqual(self.index.similar("Nobody"), [])
+        with self.assertRaises(ValueError):
+            self.index.similar("Jane", metric="cosine")
+
+if __name__ == '__main__':
+    unittest.main()
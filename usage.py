@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List
+from pydantic import BaseModel
+
+# Rough characters-per-token ratio for English text, for budgets and estimates before a call is billed
+CHARS_PER_TOKEN = 4
+
+# Token usage of a single API call
+class UsageRecord(BaseModel):
+    label: str  # What the call was for, e.g. the persona personality or "evaluation"
+    model: str  # The API model name
+    prompt_tokens: int = 0  # Input tokens billed
+    cached_tokens: int = 0  # Input tokens served from the provider's prompt cache
+    completion_tokens: int = 0  # Output tokens billed
+    timestamp: float = 0.0  # Unix time the call completed
+
+class UsageLog:
+    """
+    Thread-safe log of per-call token usage with running totals.
+
+    Only the most recent `max_records` calls are kept individually, the
+    totals cover every call since the last `clear()`.
+    """
+
+    def __init__(self, max_records: int = 10000):
+        self._lock = threading.Lock()
+        self._records = deque(maxlen=max_records)
+        self._totals = self._empty_totals()
+
+    def record(self, label: str, model: str, usage: Any) -> UsageRecord:
+        """
+        Record the `usage` field of an API response.
+
+        Args:
+        label (str): What the call was for.
+        model (str): The API model name.
+        usage: The response's usage object, may be None.
+
+        Returns:
+        UsageRecord: The stored record.
+        """
+        details = getattr(usage, "prompt_tokens_details", None)
+        record = UsageRecord(
+            label=label,
+            model=model,
+            prompt_tokens=_token_count(getattr(usage, "prompt_tokens", 0)),
+            cached_tokens=_token_count(getattr(details, "cached_tokens", 0)),
+            completion_tokens=_token_count(getattr(usage, "completion_tokens", 0)),
+            timestamp=time.time(),
+        )
+        with self._lock:
+            self._records.append(record)
+            self._totals["calls"] += 1
+            self._totals["prompt_tokens"] += record.prompt_tokens
+            self._totals["cached_tokens"] += record.cached_tokens
+            self._totals["completion_tokens"] += record.completion_tokens
+        return record
+
+    @property
+    def records(self) -> List[UsageRecord]:
+        with self._lock:
+            return list(self._records)
+
+    def totals(self) -> Dict[str, float]:
+        """
+        Return the summed usage of every recorded call.
+
+        Returns:
+        Dict[str, float]: calls, prompt, cached and completion tokens, and the
+        share of prompt tokens served from the prompt cache.
+        """
+        with self._lock:
+            totals = dict(self._totals)
+        totals["cached_ratio"] = totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+        return totals
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._totals = self._empty_totals()
+
+    @staticmethod
+    def _empty_totals():
+        return {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+
+def _token_count(value) -> int:
+    # Usage fields are missing on some providers and on cached replies
+    return value if isinstance(value, int) else 0